@@ -0,0 +1,316 @@
+"""
+Columnar store for redditadvice2019.jsonl, so tools can memmap just the columns they need instead of running
+json.loads over the whole file.
+
+Convert it once with
+
+python -m data.advice_store -in redditadvice2019.jsonl -out redditadvice2019.store
+
+then pass the .store directory wherever the tools want the jsonl. Use iter_advice() to read either one.
+
+Layout: posts and their good_comments are two tables. Each column is a file (or two) in the directory:
+ int64 / float64 / bool columns are flat arrays,
+ str columns are a utf-8 heap plus int64 offsets,
+ anything else (lists, missing values, mixed types) becomes a json column, which is stored like a str column with
+ an empty entry when the row doesn't have that field.
+posts.comment_offsets.bin says which comments go with each post, and there's an index for each split + the post ids.
+"""
+import argparse
+import array
+import json
+import os
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+sys.path.append('../')
+
+ADVICE_STORE_VERSION = 1
+TABLES = ('posts', 'comments')
+_ARRAY_DTYPES = {'int64': np.int64, 'float64': np.float64, 'bool': np.bool_}
+_ARRAY_TYPECODES = {'int64': 'q', 'float64': 'd', 'bool': 'b'}
+
+
+def _memmap(fn, dtype, shape):
+    """ np.memmap won't map empty files"""
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode='r', shape=shape)
+
+
+def _infer_type(seen_types, num_present, num_rows):
+    """ Works out how to store a column, given the python types it has"""
+    if num_present == num_rows and len(seen_types) == 1:
+        t = next(iter(seen_types))
+        if t is bool:
+            return 'bool'
+        if t is int:
+            return 'int64'
+        if t is float:
+            return 'float64'
+        if t is str:
+            return 'str'
+    return 'json'
+
+
+class _ColumnWriter(object):
+    def __init__(self, prefix, col_type):
+        self.col_type = col_type
+        self.prefix = prefix
+        if col_type in _ARRAY_DTYPES:
+            self.values = array.array(_ARRAY_TYPECODES[col_type])
+        else:
+            self.heap = open(prefix + '.heap', 'wb')
+            self.offsets = array.array('q', [0])
+
+    def append(self, item, key):
+        if self.col_type in _ARRAY_DTYPES:
+            self.values.append(item[key])
+            return
+        if key not in item:
+            data = b''
+        elif self.col_type == 'str':
+            data = item[key].encode('utf-8')
+        else:
+            data = json.dumps(item[key]).encode('utf-8')
+        self.heap.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def close(self):
+        if self.col_type in _ARRAY_DTYPES:
+            np.frombuffer(self.values, dtype=self.values.typecode).astype(_ARRAY_DTYPES[self.col_type]).tofile(
+                self.prefix + '.bin')
+        else:
+            self.heap.close()
+            np.frombuffer(self.offsets, dtype=np.int64).tofile(self.prefix + '.offsets')
+
+
+def convert_jsonl(jsonl_fn, out_dir):
+    """
+    Converts redditadvice2019.jsonl (or anything made by create_redditadvice_2019.py) to a store. We go over the file
+    twice, once to figure out the column types and once to write them, so memory use stays small.
+    """
+    # First pass: what are the columns
+    stats = {table: {} for table in TABLES}
+    num_rows = {table: 0 for table in TABLES}
+    with open(jsonl_fn, 'r') as f:
+        for l in tqdm(f, desc='Finding columns'):
+            post = json.loads(l)
+            comments = post.pop('good_comments', [])
+            for table, items in (('posts', [post]), ('comments', comments)):
+                for item in items:
+                    num_rows[table] += 1
+                    for k, v in item.items():
+                        seen_types, num_present = stats[table].get(k, (set(), 0))
+                        seen_types.add(type(v))
+                        stats[table][k] = (seen_types, num_present + 1)
+    columns = {table: {k: _infer_type(seen_types, num_present, num_rows[table])
+                       for k, (seen_types, num_present) in stats[table].items()} for table in TABLES}
+
+    # Second pass: write everything
+    os.makedirs(out_dir, exist_ok=True)
+    writers = {table: {k: _ColumnWriter(os.path.join(out_dir, '{}.{}'.format(table, k)), col_type)
+                       for k, col_type in columns[table].items()} for table in TABLES}
+    comment_offsets = array.array('q', [0])
+    with open(jsonl_fn, 'r') as f:
+        for l in tqdm(f, desc='Writing columns', total=num_rows['posts']):
+            post = json.loads(l)
+            comments = post.pop('good_comments', [])
+            for table, items in (('posts', [post]), ('comments', comments)):
+                for item in items:
+                    for k, writer in writers[table].items():
+                        writer.append(item, k)
+            comment_offsets.append(comment_offsets[-1] + len(comments))
+    for table in TABLES:
+        for writer in writers[table].values():
+            writer.close()
+    np.frombuffer(comment_offsets, dtype=np.int64).tofile(os.path.join(out_dir, 'posts.comment_offsets.bin'))
+
+    meta = {'version': ADVICE_STORE_VERSION, 'num_rows': num_rows, 'columns': columns, 'splits': {}}
+    store = AdviceStore(out_dir, _meta=meta)
+
+    # Indexes: rows in each split, and rows sorted by id
+    if columns['posts'].get('split') == 'str':
+        splits = store.column('split')
+        split_rows = {}
+        for i in range(len(store)):
+            split_rows.setdefault(splits[i], array.array('q')).append(i)
+        for split, rows in split_rows.items():
+            np.frombuffer(rows, dtype=np.int64).tofile(os.path.join(out_dir, 'split.{}.bin'.format(split)))
+            meta['splits'][split] = len(rows)
+    if columns['posts'].get('id') == 'str':
+        ids = store.column('id')
+        np.array(sorted(range(len(store)), key=lambda i: ids[i]), dtype=np.int64).tofile(
+            os.path.join(out_dir, 'posts.id_order.bin'))
+
+    # Last, so a half-written store doesn't look finished
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return AdviceStore(out_dir)
+
+
+class StringColumn(object):
+    """ A memmapped heap of strings (or json), indexed by row"""
+
+    def __init__(self, prefix, num_rows, is_json=False):
+        self.offsets = _memmap(prefix + '.offsets', np.int64, (num_rows + 1,))
+        self.heap = _memmap(prefix + '.heap', np.uint8, (int(self.offsets[-1]) if num_rows > 0 else 0,))
+        self.is_json = is_json
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def has(self, i):
+        """ False if it's a json column and this row didn't have the field"""
+        return not self.is_json or self.offsets[i + 1] > self.offsets[i]
+
+    def __getitem__(self, i):
+        data = self.heap[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+        return json.loads(data) if self.is_json else data
+
+
+class AdviceStore(object):
+    def __init__(self, path, _meta=None):
+        """
+        Opens a store made by convert_jsonl. Columns get memmapped the first time they're used.
+        :param path: the store directory
+        """
+        self.path = path
+        if _meta is None:
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                _meta = json.load(f)
+            if _meta['version'] != ADVICE_STORE_VERSION:
+                raise ValueError("{} is version {}, expected {}".format(path, _meta['version'], ADVICE_STORE_VERSION))
+        self.meta = _meta
+        self.columns = self.meta['columns']
+        self._columns = {}
+        self.comment_offsets = _memmap(os.path.join(path, 'posts.comment_offsets.bin'), np.int64,
+                                       (self.meta['num_rows']['posts'] + 1,))
+        self._id_order = None
+
+    def __len__(self):
+        return self.meta['num_rows']['posts']
+
+    @property
+    def splits(self):
+        return sorted(self.meta['splits'])
+
+    def column(self, name, table='posts'):
+        """
+        :return: a numpy memmap for int64 / float64 / bool columns, otherwise a StringColumn
+        """
+        if (table, name) not in self._columns:
+            if name not in self.columns[table]:
+                raise KeyError("{} has no {} column {}".format(self.path, table, name))
+            col_type = self.columns[table][name]
+            prefix = os.path.join(self.path, '{}.{}'.format(table, name))
+            num_rows = self.meta['num_rows'][table]
+            if col_type in _ARRAY_DTYPES:
+                self._columns[(table, name)] = _memmap(prefix + '.bin', _ARRAY_DTYPES[col_type], (num_rows,))
+            else:
+                self._columns[(table, name)] = StringColumn(prefix, num_rows, is_json=col_type == 'json')
+        return self._columns[(table, name)]
+
+    def _row(self, table, i, fields):
+        row = {}
+        for k in (self.columns[table] if fields is None else fields):
+            if k not in self.columns[table]:
+                # Like a jsonl, where nothing has that field
+                continue
+            column = self.column(k, table=table)
+            if isinstance(column, StringColumn):
+                if column.has(i):
+                    row[k] = column[i]
+            else:
+                row[k] = column[i].item()
+        return row
+
+    def get(self, i, fields=None, comment_fields=None):
+        """
+        :param i: row number
+        :param fields: which post fields to get, or None for all of them. Include good_comments to get those. Ones
+                       the store doesn't have get left out
+        :param comment_fields: which fields to get for each of the good_comments, or None for all of them
+        :return: the post as a dict, like a line of the jsonl
+        """
+        post_fields = None if fields is None else [k for k in fields if k != 'good_comments']
+        post = self._row('posts', i, post_fields)
+        if fields is None or 'good_comments' in fields:
+            post['good_comments'] = [self._row('comments', j, comment_fields)
+                                     for j in range(self.comment_offsets[i], self.comment_offsets[i + 1])]
+        return post
+
+    def split_rows(self, split):
+        """ :return: the rows (as an int64 array) that are in this split"""
+        if split not in self.meta['splits']:
+            raise KeyError("{} has no split {}".format(self.path, split))
+        return _memmap(os.path.join(self.path, 'split.{}.bin'.format(split)), np.int64, (self.meta['splits'][split],))
+
+    def iter_posts(self, fields=None, comment_fields=None, split=None):
+        """ Yields posts in file order, optionally just the ones in one split (none, if no post is in it)"""
+        if split is not None and split not in self.meta['splits']:
+            return
+        rows = range(len(self)) if split is None else self.split_rows(split)
+        for i in rows:
+            yield self.get(int(i), fields=fields, comment_fields=comment_fields)
+
+    def find(self, post_id):
+        """ :return: the row of the post with this id, by binary search. Raises KeyError if it's not there"""
+        if self._id_order is None:
+            self._id_order = _memmap(os.path.join(self.path, 'posts.id_order.bin'), np.int64, (len(self),))
+        ids = self.column('id')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if ids[self._id_order[mid]] < post_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and ids[self._id_order[lo]] == post_id:
+            return int(self._id_order[lo])
+        raise KeyError(post_id)
+
+    def get_by_id(self, post_id, fields=None, comment_fields=None):
+        return self.get(self.find(post_id), fields=fields, comment_fields=comment_fields)
+
+
+def _select(item, fields, comment_fields):
+    """ Same field selection as AdviceStore.get, for posts from a jsonl"""
+    if fields is not None:
+        item = {k: item[k] for k in fields if k in item}
+    if comment_fields is not None and 'good_comments' in item:
+        item['good_comments'] = [{k: x[k] for k in comment_fields if k in x} for x in item['good_comments']]
+    return item
+
+
+def iter_advice(fn, fields=None, comment_fields=None, split=None):
+    """
+    Iterates over the posts in either redditadvice2019.jsonl or a store made from it.
+    :param fn: jsonl file or store directory
+    :param fields: which post fields we need (include good_comments for the comments). None for all of them. Posts
+                   that don't have one of these just come without it
+    :param comment_fields: which fields we need from each comment, None for all of them
+    :param split: only these posts. If none of them are in this split, we yield nothing
+    :return: generator over dicts
+    """
+    if os.path.isdir(fn):
+        yield from AdviceStore(fn).iter_posts(fields=fields, comment_fields=comment_fields, split=split)
+        return
+
+    with open(fn, 'r') as f:
+        for l in f:
+            item = json.loads(l)
+            if split is not None and item.get('split') != split:
+                continue
+            yield _select(item, fields, comment_fields)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert redditadvice2019.jsonl to a columnar store')
+    parser.add_argument('-in', dest='in_fn', type=str, default='redditadvice2019.jsonl')
+    parser.add_argument('-out', dest='out_dir', type=str, default='redditadvice2019.store')
+    args = parser.parse_args()
+    store = convert_jsonl(args.in_fn, args.out_dir)
+    print("{} posts, {} comments, splits {}".format(len(store), store.meta['num_rows']['comments'],
+                                                    store.meta['splits']), flush=True)
@@ -0,0 +1,71 @@
+"""Tests for data.advice_store."""
+
+import json
+import os
+import tempfile
+
+from absl.testing import absltest
+
+from data.advice_store import convert_jsonl, AdviceStore, iter_advice
+
+
+def _make_posts():
+    posts = []
+    for i in range(50):
+        post = {
+            'created_utc': 1500000000 + i, 'subreddit': 'Advice', 'score': 10 * i, 'title': 'Help \U0001F600 #{}'.format(i),
+            'selftext': 'What should I do?\n\n' * (i % 4), 'id': 'p{:03d}'.format((i * 7) % 50), 'gilded': i % 5 == 0,
+            'split': ['train', 'val', 'test'][i % 3], 'tokens': [{'context': [1, 2, i], 'target': [3]}] * (i % 2),
+            'good_comments': [{'id': 'c{}_{}'.format(i, j), 'body': 'Talk to them. ' * j, 'score': j, 'gilded': False}
+                              for j in range(i % 4)],
+        }
+        if i % 10 == 0:
+            post['retrieved_on'] = 1600000000
+        posts.append(post)
+    return posts
+
+
+class AdviceStoreTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.posts = _make_posts()
+        self.jsonl_fn = os.path.join(self.tmp_dir.name, 'redditadvice2019.jsonl')
+        with open(self.jsonl_fn, 'w') as f:
+            for post in self.posts:
+                f.write(json.dumps(post) + '\n')
+        self.store_dir = os.path.join(self.tmp_dir.name, 'redditadvice2019.store')
+        convert_jsonl(self.jsonl_fn, self.store_dir)
+        self.store = AdviceStore(self.store_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_roundtrip(self):
+        self.assertEqual(list(self.store.iter_posts()), self.posts)
+        self.assertEqual(self.store.columns['posts']['created_utc'], 'int64')
+        self.assertEqual(self.store.columns['posts']['retrieved_on'], 'json')
+
+    def test_split_and_fields(self):
+        kwargs = {'fields': ['id', 'good_comments'], 'comment_fields': ['body'], 'split': 'val'}
+        from_store = list(iter_advice(self.store_dir, **kwargs))
+        self.assertEqual(from_store, list(iter_advice(self.jsonl_fn, **kwargs)))
+        self.assertLen(from_store, len([x for x in self.posts if x['split'] == 'val']))
+        self.assertEqual(set(from_store[1]), {'id', 'good_comments'})
+
+    def test_missing_fields_and_splits(self):
+        for fn in [self.store_dir, self.jsonl_fn]:
+            posts = list(iter_advice(fn, fields=['id', 'nope', 'good_comments'], comment_fields=['body', 'nope']))
+            self.assertEqual(posts, [{'id': x['id'], 'good_comments': [{'body': c['body']} for c in x['good_comments']]}
+                                     for x in self.posts])
+            self.assertEqual(list(iter_advice(fn, fields=['id'], split='nope')), [])
+
+    def test_get_by_id(self):
+        for post in self.posts:
+            self.assertEqual(self.store.get_by_id(post['id'], fields=['title'])['title'], post['title'])
+        with self.assertRaises(KeyError):
+            self.store.find('nope')
+
+
+if __name__ == '__main__':
+    absltest.main()
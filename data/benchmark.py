@@ -0,0 +1,164 @@
+"""
+Micro-benchmarks for the data prep code. Run from the repo root like
+
+python -m data.benchmark bpe
+"""
+import argparse
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+sys.path.append('../')
+from data.encoder import get_encoder
+
+
+def _time_it(fn, repeats=3):
+    """ Returns the best wall-clock time, in seconds, over a few runs"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_bpe(args):
+    """ Pathological long pretokens: URLs, emoji runs and repeated punctuation"""
+    from data.encoder_test import _reference_bpe
+    encoder = get_encoder(cache_size=None)
+    rng = random.Random(123456)
+
+    def _random_str(alphabet, length):
+        return ''.join(rng.choice(alphabet) for _ in range(length))
+
+    cases = {
+        'url': 'https://www.example.com/' + _random_str(string.ascii_letters, args.length),
+        'emoji': _random_str('\U0001F600\U0001F602\U0001F914\u2764\U0001F44D', args.length // 4),
+        'punct': _random_str('!?.,*-~', args.length),
+        'repeat': 'aaaaaaaaab' * (args.length // 10),
+        'short': ' '.join(_random_str(string.ascii_lowercase, 6) for _ in range(args.length // 7)),
+    }
+    print('{:>8s} {:>10s} {:>12s} {:>12s} {:>8s}'.format('case', 'len', 'heap (ms)', 'loop (ms)', 'speedup'))
+    for name, text in cases.items():
+        pretokens = [t.encode('utf-8').decode('latin-1').translate(encoder.byte_translation)
+                     for t in encoder.pat.findall(text)]
+
+        def _heap():
+            for t in pretokens:
+                encoder.cache.clear()
+                encoder.bpe(t)
+
+        def _loop():
+            for t in pretokens:
+                _reference_bpe(encoder, t)
+
+        heap_time = _time_it(_heap)
+        loop_time = _time_it(_loop)
+        print('{:>8s} {:>10d} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+            name, sum(len(t) for t in pretokens), heap_time * 1000, loop_time * 1000, loop_time / heap_time))
+
+
+def bench_clean(args):
+    """ Throughput of clean_reddit_text, on selftexts + comment bodies from a jsonl file (or the golden test inputs)"""
+    from data.encoder import clean_reddit_text
+    texts = []
+    if args.jsonl is None:
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'clean_reddit_text_golden.jsonl')
+        with open(fn, 'r') as f:
+            texts = [json.loads(l)['text'] for l in f]
+    else:
+        with open(args.jsonl, 'r') as f:
+            for i, l in enumerate(f):
+                if i >= args.max_items:
+                    break
+                item = json.loads(l)
+                texts.extend(item[k] for k in ('text', 'selftext', 'body') if k in item)
+                texts.extend(x['body'] for x in item.get('good_comments', []))
+    num_mb = sum(len(x.encode('utf-8')) for x in texts) / 1e6
+
+    def _clean():
+        for x in texts:
+            clean_reddit_text(x)
+
+    elapsed = _time_it(_clean)
+    print('clean_reddit_text: {} texts, {:.2f} MB in {:.3f}s -> {:.2f} MB/s'.format(
+        len(texts), num_mb, elapsed, num_mb / elapsed))
+
+
+def bench_links(args):
+    """ contains_links vs rendering everything with mistune. Prints the keep/drop disagreements, if there are any"""
+    import mistune
+    from data.encoder import contains_links
+
+    def _render_check(text):
+        html_format = mistune.markdown(text)
+        return '<a>' in html_format or 'http://' in html_format or 'https://' in html_format
+
+    if args.jsonl is None:
+        fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data', 'clean_reddit_text_golden.jsonl')
+        with open(fn, 'r') as f:
+            texts = [json.loads(l)['text'] for l in f]
+    else:
+        texts = []
+        with open(args.jsonl, 'r') as f:
+            for i, l in enumerate(f):
+                if i >= args.max_items:
+                    break
+                texts.append(json.loads(l)['selftext'])
+
+    fast_time = _time_it(lambda: [contains_links(x) for x in texts], repeats=1)
+    render_time = _time_it(lambda: [_render_check(x) for x in texts], repeats=1)
+    disagreements = [x for x in texts if contains_links(x) != _render_check(x)]
+    print('{} posts, {} with links. contains_links {:.3f}s, mistune {:.3f}s ({:.1f}x). {} disagreements'.format(
+        len(texts), sum(contains_links(x) for x in texts), fast_time, render_time, render_time / fast_time,
+        len(disagreements)))
+    for x in disagreements:
+        print('----\ncontains_links={} mistune={}\n{}'.format(contains_links(x), _render_check(x), x))
+
+
+def bench_import(args):
+    """ Time `import data.encoder' in a fresh interpreter, failing if it's over budget"""
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = 'import time; start = time.perf_counter(); import data.encoder; print(time.perf_counter() - start)'
+    times = []
+    for _ in range(args.repeats):
+        out = subprocess.run([sys.executable, '-c', code], cwd=repo_root, check=True, stdout=subprocess.PIPE)
+        times.append(float(out.stdout.decode('utf-8').strip()))
+    best = min(times)
+    print('import data.encoder: best {:.3f}s, median {:.3f}s (budget {:.3f}s)'.format(
+        best, sorted(times)[len(times) // 2], args.budget))
+    if best > args.budget:
+        print('OVER BUDGET', flush=True)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    bpe_parser = subparsers.add_parser('bpe', help='Heap-based BPE merges vs the old loop')
+    bpe_parser.add_argument('-length', type=int, default=2000, help='Approx length of each pathological token')
+    bpe_parser.set_defaults(fn=bench_bpe)
+
+    clean_parser = subparsers.add_parser('clean', help='clean_reddit_text throughput in MB/s')
+    clean_parser.add_argument('-jsonl', type=str, default=None, help='e.g. redditadvice2019.jsonl')
+    clean_parser.add_argument('-max_items', type=int, default=20000)
+    clean_parser.set_defaults(fn=bench_clean)
+
+    links_parser = subparsers.add_parser('links', help='Fast link detection vs mistune, with a disagreement report')
+    links_parser.add_argument('-jsonl', type=str, default=None, help='jsonl of posts with a selftext field')
+    links_parser.add_argument('-max_items', type=int, default=20000)
+    links_parser.set_defaults(fn=bench_links)
+
+    import_parser = subparsers.add_parser('import', help='How long it takes to import data.encoder')
+    import_parser.add_argument('-repeats', type=int, default=5)
+    import_parser.add_argument('-budget', type=float, default=0.5, help='Fail if the best import time (s) is over this')
+    import_parser.set_defaults(fn=bench_import)
+
+    args = parser.parse_args()
+    args.fn(args)
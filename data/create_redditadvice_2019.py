@@ -7,24 +7,50 @@ posts
 
 comments
  created_utc,subreddit,author,parent_id,link_id,score,body,id,gilded,retrieved_on
+
+By default, everything gets loaded into memory and joined there. With -streaming, posts and comments get sorted
+on disk (by post id and link_id) and then merge-joined, so memory doesn't grow with the size of the dump. Both modes
+produce the same file.
+
+Loading / cleaning / link filtering and tokenizing happen in a pool of -num_workers processes, a chunk at a time.
+Results come back in order and the trimming randomness is seeded per post, so the output doesn't depend on the number
+of workers.
 """
 
+import argparse
+import glob
+import heapq
+import itertools
 import json
+import multiprocessing
+import os
 import sys
-from collections import defaultdict, OrderedDict
+import tempfile
+from collections import defaultdict
 
 from tqdm import tqdm
 
 sys.path.append('../')
-from data.encoder import get_encoder, clean_reddit_text, tokenize_for_grover_advice_training
-from data.tfrecord_utils import S3TFRecordWriter, int64_list_feature
-import mistune
+from data.encoder import get_encoder, clean_reddit_text, tokenize_for_grover_advice_training, contains_links
+from data.token_cache import get_token_cache
 from datetime import datetime
 import random
-import tensorflow as tf
 
-encoder = get_encoder()
-random.seed(123456)
+parser = argparse.ArgumentParser()
+parser.add_argument('-posts', type=str, default='/home/rowan/datasets2/redditscraper/posts-advice.jsonl',
+                    help='Posts dump. Can be a glob or a comma separated list, e.g. one file per month')
+parser.add_argument('-comments', type=str, default='/home/rowan/datasets2/redditscraper/comments-advice.jsonl',
+                    help='Comments dump. Can be a glob or a comma separated list, e.g. one file per month')
+parser.add_argument('-out', type=str, default='redditadvice.jsonl')
+parser.add_argument('-clean_only', type=str, default=None, choices=['posts', 'comments'],
+                    help='Just load + clean (+ filter) the posts or comments, and write those to -out')
+parser.add_argument('-cleaned', action='store_true', help='-posts and -comments were made with -clean_only')
+parser.add_argument('-streaming', action='store_true', help='Sort + join on disk, using bounded memory')
+parser.add_argument('-run_size', type=int, default=200000, help='Items per sorted run when streaming')
+parser.add_argument('-tmp_dir', type=str, default=None, help='Where to put the sorted runs when streaming')
+parser.add_argument('-num_workers', type=int, default=os.cpu_count(), help='Processes to use for cleaning + tokenizing')
+parser.add_argument('-chunk_size', type=int, default=256, help='Items sent to a worker at a time')
+parser.add_argument('-seed', type=int, default=123456)
 
 
 def _load_item(l):
@@ -64,46 +90,100 @@ def _load_item(l):
     return item
 
 
-print("POSTS", flush=True)
-postid_to_post = {}
-postid_to_comments = defaultdict(list)
-with open('/home/rowan/datasets2/redditscraper/posts-advice.jsonl', 'r') as f:
-    for l in tqdm(f):
-        item = _load_item(l)
+def _post_is_ok(item):
+    """ Filter out META posts and posts with links"""
+    if 'META' in item['title']:
+        return False
 
-        if 'META' in item['title']:
-            continue
+    # It's probably OK if updates are included, but maybe we won't respond to them in testing? idk.
+    # if item['title'].lower().startswith(('update', '[update]', '(update)', '“update')) or 'UPDATE' in item['title']:
+    #     return False
 
-        # It's probably OK if updates are included, but maybe we won't respond to them in testing? idk.
-        # if item['title'].lower().startswith(('update', '[update]', '(update)', '“update')) or 'UPDATE' in item['title']:
-        #     continue
+    # if 'update' in item['title'].lower():
+    #     return False
 
-        # if 'update' in item['title'].lower():
-        #     continue
+    return not contains_links(item['selftext'])
 
-        html_format = mistune.markdown(item['selftext'])
-        if '<a>' in html_format or 'http://' in html_format or 'https://' in html_format:
-            continue
 
-        postid_to_post[item['id']] = item
+def _load_post(l):
+    item = _load_item(l)
+    return item if _post_is_ok(item) else None
 
-print("COMMENTS", flush=True)
-with open('/home/rowan/datasets2/redditscraper/comments-advice.jsonl', 'r') as f:
-    for l in tqdm(f):
-        item = _load_item(l)
-        postid_to_comments[item['link_id']].append(item)
 
-
-def merge_post_with_comments(post_id):
+def parallel_map(pool, fn, items, chunk_size, num_workers=1):
+    """
+    Like pool.imap(fn, items), but only reads ahead one block of items at a time (pool.imap would pull everything
+    into its task queue straight away).
+    :param pool: multiprocessing pool, or None to just do everything in this process
+    :param num_workers: how many processes the pool has
+    :return: generator over (item, fn(item)) in the same order as items
+    """
+    if pool is None:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    # Enough to keep every worker busy
+    block_size = chunk_size * num_workers * 4
+    items = iter(items)
+    while True:
+        block = list(itertools.islice(items, block_size))
+        if not block:
+            return
+        yield from zip(block, pool.map(fn, block, chunksize=chunk_size))
+
+
+def expand_fns(fns):
+    """ Comma separated list of files and/or globs -> list of files, in order"""
+    expanded = []
+    for fn in fns.split(','):
+        matches = sorted(glob.glob(fn))
+        if not matches:
+            raise ValueError("{} doesnt exist".format(fn))
+        expanded.extend(matches)
+    return expanded
+
+
+def _iter_lines(fns):
+    for fn in expand_fns(fns):
+        with open(fn, 'r') as f:
+            yield from f
+
+
+def load_posts(fns, pool=None, chunk_size=256, cleaned=False, num_workers=1):
+    """
+    :param fns: see expand_fns. Multiple files are the same as if they were concatenated
+    :param cleaned: if the files were made with -clean_only, so we can just read them
+    :param num_workers: how many processes pool has
+    """
+    print("POSTS", flush=True)
+    if cleaned:
+        yield from map(json.loads, tqdm(_iter_lines(fns)))
+        return
+    for _, item in parallel_map(pool, _load_post, tqdm(_iter_lines(fns)), chunk_size=chunk_size,
+                                num_workers=num_workers):
+        if item is not None:
+            yield item
+
+
+def load_comments(fns, pool=None, chunk_size=256, cleaned=False, num_workers=1):
+    print("COMMENTS", flush=True)
+    if cleaned:
+        yield from map(json.loads, tqdm(_iter_lines(fns)))
+        return
+    for _, item in parallel_map(pool, _load_item, tqdm(_iter_lines(fns)), chunk_size=chunk_size,
+                                num_workers=num_workers):
+        yield item
+
+
+def merge_post_with_comments(post, comments):
     """
     Connects posts with good comments.
-    :param post_id: The post ID
+    :param post: The post
+    :param comments: All comments whose link_id is the post's ID, in the order they were loaded
     :return: None if not found else an item
     """
-    post = postid_to_post.get(post_id, None)
-    if post is None:
-        return None
-    top_lvl_comments = [x for x in postid_to_comments[post_id] if x['parent_id'] == x['link_id']]
+    top_lvl_comments = [x for x in comments if x['parent_id'] == x['link_id']]
     if len(top_lvl_comments) == 0:
         return None
 
@@ -128,53 +208,243 @@ def merge_post_with_comments(post_id):
     return return_dict
 
 
-training_examples = [merge_post_with_comments(id) for id in tqdm(postid_to_post)]
-training_examples = [x for x in training_examples if x is not None]
-
-# Sort from new -> old.
-# Could use datetime.utcfromtimestamp
-training_examples_sorted = sorted(training_examples, key=lambda x: -x['created_utc'])
-
-print("TOKENIZING AND TRIMMING", flush=True)
-num_test = 8192
-num_val = 8192
-num_entries = 0
-for x in tqdm(training_examples_sorted):
-    if num_entries < num_test:
-        x['split'] = 'test'
-        budget = num_test - num_entries
-    elif num_entries < (num_test + num_val):
-        x['split'] = 'val'
-        budget = num_test + num_val - num_entries
-    else:
-        x['split'] = 'train'
-        budget = 10
+def join_in_memory(posts, comments):
+    """
+    Joins posts with their comments using dicts.
+    :return: generator over (order, post, comments), where `order' is the index of the first time we saw the post ID.
+             If a post ID appears more than once we use the last version.
+    """
+    postid_to_post = {}
+    postid_to_order = {}
+    postid_to_comments = defaultdict(list)
+    for i, item in enumerate(posts):
+        postid_to_order.setdefault(item['id'], i)
+        postid_to_post[item['id']] = item
 
-    x['tokens'] = []
+    for item in comments:
+        postid_to_comments[item['link_id']].append(item)
+
+    for post_id, post in postid_to_post.items():
+        yield postid_to_order[post_id], post, postid_to_comments[post_id]
+
+
+def _external_sort(keyed_items, run_size, tmp_dir):
+    """
+    Sorts (key, item) pairs that might not fit in memory. Sorted runs of run_size items get written to disk, then
+    merged. Keys and items need to be JSON serializable.
+    :return: generator over (key, item) in sorted order
+    """
+    run_fns = []
+    buffer = []
+
+    def _spill():
+        buffer.sort(key=lambda x: x[0])
+        run_fn = os.path.join(tmp_dir, 'run{:05d}.jsonl'.format(len(run_fns)))
+        with open(run_fn, 'w') as f:
+            for key, item in buffer:
+                f.write(json.dumps([key, item]) + '\n')
+        run_fns.append(run_fn)
+        buffer.clear()
+
+    for key, item in keyed_items:
+        buffer.append((list(key), item))
+        if len(buffer) >= run_size:
+            _spill()
+
+    if not run_fns:
+        buffer.sort(key=lambda x: x[0])
+        yield from buffer
+        return
+    if buffer:
+        _spill()
+
+    run_files = [open(fn, 'r') for fn in run_fns]
+    try:
+        for key, item in heapq.merge(*[map(json.loads, f) for f in run_files], key=lambda x: x[0]):
+            yield key, item
+    finally:
+        for f in run_files:
+            f.close()
+
+
+def join_streaming(posts, comments, run_size, tmp_dir):
+    """
+    Same as join_in_memory, but posts and comments are sorted on disk by ID, then merge-joined.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as posts_dir, tempfile.TemporaryDirectory(dir=tmp_dir) as comments_dir:
+        sorted_posts = _external_sort((((item['id'], i), item) for i, item in enumerate(posts)),
+                                      run_size=run_size, tmp_dir=posts_dir)
+        sorted_comments = _external_sort((((item['link_id'], i), item) for i, item in enumerate(comments)),
+                                         run_size=run_size, tmp_dir=comments_dir)
+
+        comment_groups = itertools.groupby(sorted_comments, key=lambda x: x[0][0])
+        link_id, comment_group = next(comment_groups, (None, None))
+        for post_id, post_group in itertools.groupby(sorted_posts, key=lambda x: x[0][0]):
+            post_group = list(post_group)
+
+            while (link_id is not None) and (link_id < post_id):
+                link_id, comment_group = next(comment_groups, (None, None))
+
+            comments_this_post = [item for _, item in comment_group] if link_id == post_id else []
+            yield post_group[0][0][1], post_group[-1][1], comments_this_post
+
+
+def sort_new_to_old(joined, streaming=False, run_size=None, tmp_dir=None):
+    """
+    Merges everything and sorts from new -> old. Ties keep the order that posts were loaded in.
+    :param joined: generator over (order, post, comments)
+    :return: generator over merged training examples
+    """
+    def _keyed_examples():
+        for order, post, comments in tqdm(joined):
+            x = merge_post_with_comments(post, comments)
+            if x is not None:
+                yield (-x['created_utc'], order), x
+
+    keyed_examples = _keyed_examples()
+    # Could use datetime.utcfromtimestamp
+    if not streaming:
+        for _, x in sorted(keyed_examples, key=lambda x: x[0]):
+            yield x
+        return
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as examples_dir:
+        for _, x in _external_sort(keyed_examples, run_size=run_size, tmp_dir=examples_dir):
+            yield x
+
+
+# Set in each worker process (or in the main process, without workers)
+_worker_encoder = None
+_worker_seed = None
+
+
+def init_worker(encoder, seed):
+    global _worker_encoder, _worker_seed
+    _worker_encoder = encoder
+    _worker_seed = seed
+
+
+def _tokenize_example(x):
+    """ Tokenizes each of the good comments. Trimming is seeded by the post ID so we get the same thing anywhere"""
+    rng = random.Random('{}-{}'.format(_worker_seed, x['id']))
+    tokens = []
     for comment in x['good_comments']:
         tokenized_comment = tokenize_for_grover_advice_training(
-            encoder,
+            _worker_encoder,
             date=datetime.utcfromtimestamp(x['created_utc']),
             subreddit=x['subreddit'],
             selftext=x['selftext'],
             title=x['title'],
             body=comment['body'],
-            desired_len=1536)
+            desired_len=1536,
+            rng=rng)
         if tokenized_comment is not None:
-            x['tokens'].append(tokenized_comment)
-    x['tokens'] = x['tokens'][:budget]
-    num_entries += len(x['tokens'])
-
-lowest_val_utc = min([x['created_utc'] for x in training_examples_sorted if x['split'] == 'val'])
-print("Val starts {}".format(datetime.utcfromtimestamp(lowest_val_utc)), flush=True)
-lowest_test_utc = min([x['created_utc'] for x in training_examples_sorted if x['split'] == 'test'])
-print("Test starts {}".format(datetime.utcfromtimestamp(lowest_test_utc)), flush=True)
-highest_test_utc = max([x['created_utc'] for x in training_examples_sorted if x['split'] == 'test'])
-print("Test ends {}".format(datetime.utcfromtimestamp(highest_test_utc)), flush=True)
-
-random.shuffle(training_examples_sorted)
-
-# Cache to a static file
-with open('redditadvice.jsonl', 'w') as f:
-    for item in training_examples_sorted:
-        f.write(json.dumps(item) + '\n')
\ No newline at end of file
+            tokens.append(tokenized_comment)
+    return tokens
+
+
+def tokenize_and_split(training_examples_sorted, pool=None, chunk_size=256, num_test=8192, num_val=8192,
+                       num_workers=1):
+    """
+    Assigns splits (newest stuff goes to test, then val, then train) and tokenizes each of the good comments.
+    :param training_examples_sorted: generator over training examples, from new -> old
+    :param pool: Pool to tokenize in (set up with init_worker). If None, we use this process.
+    :param num_workers: how many processes pool has
+    :return: generator over the same examples with `split' and `tokens' filled in
+    """
+    print("TOKENIZING AND TRIMMING", flush=True)
+    num_entries = 0
+    split_utcs = {}
+    for x, tokens in parallel_map(pool, _tokenize_example, tqdm(training_examples_sorted), chunk_size=chunk_size,
+                                  num_workers=num_workers):
+        if num_entries < num_test:
+            x['split'] = 'test'
+            budget = num_test - num_entries
+        elif num_entries < (num_test + num_val):
+            x['split'] = 'val'
+            budget = num_test + num_val - num_entries
+        else:
+            x['split'] = 'train'
+            budget = 10
+
+        x['tokens'] = tokens[:budget]
+        num_entries += len(x['tokens'])
+
+        utc_range = split_utcs.setdefault(x['split'], [x['created_utc'], x['created_utc']])
+        utc_range[0] = min(utc_range[0], x['created_utc'])
+        utc_range[1] = max(utc_range[1], x['created_utc'])
+        yield x
+
+    print("Val starts {}".format(datetime.utcfromtimestamp(split_utcs['val'][0])), flush=True)
+    print("Test starts {}".format(datetime.utcfromtimestamp(split_utcs['test'][0])), flush=True)
+    print("Test ends {}".format(datetime.utcfromtimestamp(split_utcs['test'][1])), flush=True)
+
+
+def write_shuffled_streaming(items, out_fn, tmp_dir=None):
+    """
+    Writes items in the same order as random.shuffle(list(items)) would, but only keeps file offsets in memory.
+    """
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as unshuffled_dir:
+        unshuffled_fn = os.path.join(unshuffled_dir, 'unshuffled.jsonl')
+        offsets = []
+        with open(unshuffled_fn, 'wb') as f:
+            for item in items:
+                offsets.append(f.tell())
+                f.write((json.dumps(item) + '\n').encode('utf-8'))
+
+        # The permutation only depends on the length, so this matches shuffling the items themselves
+        random.shuffle(offsets)
+        with open(unshuffled_fn, 'rb') as f_in, open(out_fn, 'wb') as f_out:
+            for offset in offsets:
+                f_in.seek(offset)
+                f_out.write(f_in.readline())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # Reruns on mostly the same data can reuse the tokens from last time, see data/token_cache.py
+    encoder = get_encoder(token_cache=get_token_cache())
+    random.seed(args.seed)
+
+    init_worker(encoder, args.seed)
+    pool = None
+    if args.num_workers > 1:
+        pool = multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(encoder, args.seed))
+
+    if args.clean_only is not None:
+        # One dump at a time, so that data/pipeline.py only needs to redo the ones that changed
+        load_fn = load_posts if args.clean_only == 'posts' else load_comments
+        with open(args.out, 'w') as f:
+            for item in load_fn(getattr(args, args.clean_only), pool=pool, chunk_size=args.chunk_size,
+                                num_workers=args.num_workers):
+                f.write(json.dumps(item) + '\n')
+        if pool is not None:
+            pool.close()
+            pool.join()
+        sys.exit(0)
+
+    posts = load_posts(args.posts, pool=pool, chunk_size=args.chunk_size, cleaned=args.cleaned,
+                       num_workers=args.num_workers)
+    comments = load_comments(args.comments, pool=pool, chunk_size=args.chunk_size, cleaned=args.cleaned,
+                             num_workers=args.num_workers)
+    if args.streaming:
+        joined = join_streaming(posts, comments, run_size=args.run_size, tmp_dir=args.tmp_dir)
+    else:
+        joined = join_in_memory(posts, comments)
+
+    training_examples_sorted = tokenize_and_split(
+        sort_new_to_old(joined, streaming=args.streaming, run_size=args.run_size, tmp_dir=args.tmp_dir),
+        pool=pool, chunk_size=args.chunk_size, num_workers=args.num_workers)
+
+    # Cache to a static file
+    if args.streaming:
+        write_shuffled_streaming(training_examples_sorted, args.out, tmp_dir=args.tmp_dir)
+    else:
+        training_examples_sorted = list(training_examples_sorted)
+        random.shuffle(training_examples_sorted)
+        with open(args.out, 'w') as f:
+            for item in training_examples_sorted:
+                f.write(json.dumps(item) + '\n')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
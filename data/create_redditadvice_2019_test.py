@@ -0,0 +1,104 @@
+"""Tests for data.create_redditadvice_2019."""
+
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+
+from absl.testing import absltest
+
+from data.create_redditadvice_2019 import load_posts, load_comments, join_in_memory, join_streaming, \
+    sort_new_to_old, init_worker, tokenize_and_split
+from data.encoder import get_encoder
+
+
+def _make_dump(dir):
+    """
+    Writes a small posts + comments dump, in the scraper's format. It has the awkward bits: posts that show up twice,
+    ties in created_utc, comments on posts we don't have, replies, and posts that get filtered out.
+    :return: posts fn, comments fn
+    """
+    rng = random.Random(1337)
+    post_ids = ['p{:02d}'.format(i) for i in range(30)]
+    rng.shuffle(post_ids)
+
+    posts = []
+    for i, post_id in enumerate(post_ids + post_ids[:5]):
+        title = 'META: rules' if i % 11 == 0 else 'Help #{}'.format(i)
+        selftext = 'see https://example.com' if i % 13 == 0 else 'What should I do? ' * (i % 3 + 1)
+        if i % 4 == 1:
+            # Too long, so it gets trimmed (at random)
+            selftext = '\n\n'.join('This is part {} of what happened. '.format(j) * 10 for j in range(40))
+        posts.append({'created_utc': str(1500000000 + i // 4), 'subreddit': 'Advice', 'author': 'u{}'.format(i),
+                      'num_comments': '3', 'score': str(i), 'title': title, 'selftext': selftext, 'id': post_id,
+                      'gilded': str(int(i % 7 == 0)), 'retrieved_on': '1600000000'})
+
+    comments = []
+    for i in range(300):
+        link_id = rng.choice(post_ids + ['gone1', 'gone2'])
+        top_level = rng.random() < 0.8
+        comments.append({'created_utc': str(1500000000 + i), 'subreddit': 'Advice', 'author': 'c{}'.format(i),
+                         'parent_id': 't3_' + link_id if top_level else 't1_c{}'.format(i - 1),
+                         'link_id': 't3_' + link_id, 'score': str(rng.randint(0, 100)),
+                         'body': 'Talk to them about how you feel. ' * rng.randint(1, 3), 'id': 'c{}'.format(i % 280),
+                         'gilded': str(int(rng.random() < 0.05)), 'retrieved_on': '1600000000'})
+
+    fns = []
+    for name, items in [('posts', posts), ('comments', comments)]:
+        fn = os.path.join(dir, '{}.jsonl'.format(name))
+        with open(fn, 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+        fns.append(fn)
+    return fns
+
+
+class JoinTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.tmp_dir.name
+        self.posts_fn, self.comments_fn = _make_dump(self.dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _load(self):
+        return load_posts(self.posts_fn), load_comments(self.comments_fn)
+
+    def test_streaming_matches_in_memory(self):
+        joined = sorted(join_in_memory(*self._load()), key=lambda x: x[0])
+        # Small enough that every sort spills several runs, which then get merged
+        joined_streaming = sorted(join_streaming(*self._load(), run_size=4, tmp_dir=self.dir), key=lambda x: x[0])
+        self.assertGreater(len(joined), 10)
+        self.assertEqual(joined_streaming, joined)
+
+        examples = list(sort_new_to_old(join_in_memory(*self._load())))
+        examples_streaming = list(sort_new_to_old(join_streaming(*self._load(), run_size=4, tmp_dir=self.dir),
+                                                  streaming=True, run_size=4, tmp_dir=self.dir))
+        self.assertGreater(len(examples), 5)
+        self.assertEqual(examples_streaming, examples)
+        # All the runs got cleaned up
+        self.assertCountEqual(os.listdir(self.dir), ['posts.jsonl', 'comments.jsonl'])
+
+    def test_tokenize_doesnt_depend_on_num_workers(self):
+        encoder = get_encoder()
+        seed = 123456
+        examples = list(sort_new_to_old(join_in_memory(*self._load())))
+
+        def _tokenize(num_workers):
+            if num_workers == 1:
+                init_worker(encoder, seed)
+                return list(tokenize_and_split([dict(x) for x in examples], num_test=4, num_val=4))
+            with multiprocessing.Pool(num_workers, initializer=init_worker, initargs=(encoder, seed)) as pool:
+                return list(tokenize_and_split([dict(x) for x in examples], pool=pool, chunk_size=2, num_test=4,
+                                               num_val=4, num_workers=num_workers))
+
+        tokenized = _tokenize(1)
+        self.assertTrue(any(x['tokens'] for x in tokenized))
+        self.assertEqual(_tokenize(3), tokenized)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -5,12 +5,17 @@ Some functions are adapted from OpenAI but with modifications
 https://github.com/openai/gpt-2
 """
 
+import gc
+import hashlib
+import heapq
 import html
 import json
+import multiprocessing
 import os
 import random
 import sys
 import unicodedata
+from collections import OrderedDict
 from datetime import datetime
 from functools import lru_cache
 
@@ -54,15 +59,69 @@ def get_pairs(word):
     return pairs
 
 
+class BPECache(object):
+    def __init__(self, capacity=100000):
+        """
+        LRU cache from pretoken -> BPE'd string. Bounded so that long-running processes (like the server) don't keep
+        every pretoken they've ever seen around forever.
+        :param capacity: Max number of entries. None means unbounded.
+        """
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self._data.get(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if (self.capacity is not None) and (len(self._data) > self.capacity):
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+SPECIAL_TOKEN_TYPES = ['domain', 'date', 'authors', 'title', 'article', 'summary']
+
+
 class Encoder:
-    def __init__(self, encoder, bpe_merges, errors='replace'):
+    def __init__(self, encoder, bpe_merges, errors='replace', cache_size=100000):
         self.encoder = {k: v + 1 for k, v in encoder.items()}
         self.encoder['<|padding|>'] = 0
         self.padding = 0
 
         del self.encoder['<|endoftext|>']
 
-        for special_token_type in ['domain', 'date', 'authors', 'title', 'article', 'summary']:
+        for special_token_type in SPECIAL_TOKEN_TYPES:
             setattr(self, f'begin_{special_token_type}', len(self.encoder))
             self.encoder[f'<|begin{special_token_type}|>'] = len(self.encoder)
 
@@ -76,63 +135,153 @@ class Encoder:
         ################################## END OF SPECIAL TOKENS TO ADD
 
         self.decoder = {v: k for k, v in self.encoder.items()}
+        self._setup(bpe_merges, errors=errors, cache_size=cache_size)
+
+    @classmethod
+    def from_compiled(cls, tokens, bpe_merges, special_token_ids, errors='replace', cache_size=100000):
+        """
+        Builds the encoder from an already-processed vocab (see compile_encoder), skipping the special token setup.
+        :param tokens: list of all tokens, where tokens[i] has id i. Includes the special tokens.
+        :param bpe_merges: list of (first, second) merges in rank order
+        :param special_token_ids: dict of attribute name (like `begin_article') -> id
+        """
+        self = cls.__new__(cls)
+        self.encoder = dict(zip(tokens, range(len(tokens))))
+        for k, v in special_token_ids.items():
+            setattr(self, k, v)
+        self.decoder = dict(enumerate(tokens))
+        self._setup(bpe_merges, errors=errors, cache_size=cache_size)
+        return self
+
+    def _setup(self, bpe_merges, errors, cache_size):
         self.errors = errors  # how to handle errors in decoding
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        # Lets us map utf-8 bytes -> unicode with a single str.translate over the latin-1 view of the bytes
+        self.byte_translation = str.maketrans({chr(b): c for b, c in self.byte_encoder.items()})
         self.bpe_ranks = dict(zip(bpe_merges, range(len(bpe_merges))))
-        self.cache = {}
+        self.cache = BPECache(capacity=cache_size)
+        # Optional data.token_cache.TokenCache, for whole texts
+        self.token_cache = None
+        self._fingerprint = None
 
         # Should haved added re.IGNORECASE so BPE merges can happen for capitalized versions of contractions
         self.pat = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
 
-    def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token)
-        pairs = get_pairs(word)
+    @property
+    def special_token_ids(self):
+        """ Attribute name -> id for all of the special tokens"""
+        names = ['padding', 'reset_context'] + [f'{x}_{y}' for y in SPECIAL_TOKEN_TYPES for x in ('begin', 'end')]
+        return {k: getattr(self, k) for k in names}
 
-        if not pairs:
+    def bpe(self, token):
+        """
+        Merges the symbols in `token' according to bpe_ranks.
+
+        Rather than rescanning every pair each time we merge, we keep the symbols in a linked list and the candidate
+        merges in a heap keyed by (rank, position). All occurrences of the lowest-ranked pair get merged left to right
+        before any new pairs are considered, so this gives the same output as the usual quadratic loop.
+        :param token: pretoken, already mapped to unicode via byte_translation
+        :return: space separated BPE pieces
+        """
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
+
+        symbols = list(token)
+        if len(symbols) < 2:
             return token
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
-        self.cache[token] = word
+        bpe_ranks = self.bpe_ranks
+        # prev_ind[i] / next_ind[i] point to the neighbors of symbol i, -1 at the ends. Merged-away symbols become None
+        prev_ind = list(range(-1, len(symbols) - 1))
+        next_ind = list(range(1, len(symbols) + 1))
+        next_ind[-1] = -1
+
+        heap = []
+        for i in range(len(symbols) - 1):
+            rank = bpe_ranks.get((symbols[i], symbols[i + 1]), None)
+            if rank is not None:
+                heap.append((rank, i, symbols[i], symbols[i + 1]))
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            merged = []
+            while heap and heap[0][0] == rank:
+                _, i, first, second = heapq.heappop(heap)
+                j = next_ind[i]
+                # Skip stale entries, where one of the two symbols has been merged into something else already
+                if symbols[i] != first or j == -1 or symbols[j] != second:
+                    continue
+                symbols[i] = first + second
+                symbols[j] = None
+                k = next_ind[j]
+                next_ind[i] = k
+                if k != -1:
+                    prev_ind[k] = i
+                merged.append(i)
+
+            merged_set = set(merged)
+            for i in merged:
+                p = prev_ind[i]
+                if p != -1 and p not in merged_set:
+                    new_rank = bpe_ranks.get((symbols[p], symbols[i]), None)
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, p, symbols[p], symbols[i]))
+                k = next_ind[i]
+                if k != -1:
+                    new_rank = bpe_ranks.get((symbols[i], symbols[k]), None)
+                    if new_rank is not None:
+                        heapq.heappush(heap, (new_rank, i, symbols[i], symbols[k]))
+
+        word = ' '.join(x for x in symbols if x is not None)
+        self.cache.put(token, word)
         return word
 
+    @property
+    def fingerprint(self):
+        """ Hash of the vocab + merges, so the token cache can tell encoders apart"""
+        if self._fingerprint is None:
+            h = hashlib.sha1()
+            h.update('\n'.join(self.decoder[i] for i in range(len(self.decoder))).encode('utf-8'))
+            h.update('\n'.join(' '.join(x) for x in sorted(self.bpe_ranks, key=self.bpe_ranks.get)).encode('utf-8'))
+            self._fingerprint = 'gpt2-bpe-' + h.hexdigest()
+        return self._fingerprint
+
     def encode(self, text):
+        if self.token_cache is not None:
+            return self.token_cache.encode(text, self._encode, self.fingerprint)
+        return self._encode(text)
+
+    def _encode(self, text):
         bpe_tokens = []
         for token in re.findall(self.pat, text):
-            token = ''.join(self.byte_encoder[b] for b in token.encode('utf-8'))
+            token = token.encode('utf-8').decode('latin-1').translate(self.byte_translation)
             bpe_tokens.extend(self.encoder[bpe_token] for bpe_token in self.bpe(token).split(' '))
         return bpe_tokens
 
+    def encode_batch(self, texts, num_workers=None, chunksize=64):
+        """
+        Encodes a bunch of texts, possibly using a pool of worker processes.
+
+        Each worker gets its own copy of the vocab + merge ranks once (when the pool starts), rather than per text.
+        :param texts: list of strings
+        :param num_workers: How many processes to use. Defaults to the number of CPUs. If this is 1 (or there's not
+                            much to do) we'll just encode everything in this process.
+        :param chunksize: how many texts to send to a worker at a time
+        :return: list of token lists, in the same order as `texts'
+        """
+        texts = list(texts)
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        num_workers = min(num_workers, (len(texts) + chunksize - 1) // chunksize)
+        if num_workers <= 1:
+            return [self.encode(text) for text in texts]
+
+        with multiprocessing.Pool(num_workers, initializer=_init_encode_worker, initargs=(self,)) as pool:
+            return pool.map(_encode_in_worker, texts, chunksize=chunksize)
+
     def decode(self, tokens):
         text = ''.join([self.decoder[token] for token in tokens])
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors=self.errors)
@@ -147,19 +296,155 @@ class Encoder:
         return [(self.decoder[i].startswith('<|') and self.decoder[i].endswith('|>')) for i in range(len(self))]
 
 
-def get_encoder():
+# Set in each worker process by encode_batch
+_worker_encoder = None
+
+
+def _init_encode_worker(encoder):
+    global _worker_encoder
+    _worker_encoder = encoder
+
+
+def _encode_in_worker(text):
+    return _worker_encoder.encode(text)
+
+
+COMPILED_ENCODER_VERSION = 1
+# The compiled encoder goes here by default, so we never write into the source tree unless asked to
+CACHE_DIR = os.environ.get('TURINGADVICE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'turingadvice'))
+
+
+def _encoder_source_fns():
     directory_name = os.path.dirname(__file__)
-    with open(os.path.join(directory_name, 'encoder.json'), 'r') as f:
+    return [os.path.join(directory_name, 'encoder.json'), os.path.join(directory_name, 'vocab.bpe')]
+
+
+def _default_compiled_fn():
+    return os.path.join(CACHE_DIR, 'encoder.compiled')
+
+
+def _source_stats():
+    """ [size, mtime] of encoder.json + vocab.bpe. If these haven't changed, we don't need to hash them"""
+    return [[os.stat(fn).st_size, os.stat(fn).st_mtime_ns] for fn in _encoder_source_fns()]
+
+
+def _source_fingerprint():
+    """ Hash of encoder.json + vocab.bpe, so we can tell if a compiled encoder is stale"""
+    h = hashlib.sha1()
+    for fn in _encoder_source_fns():
+        with open(fn, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _get_encoder_from_sources(cache_size=100000):
+    encoder_fn, bpe_fn = _encoder_source_fns()
+    with open(encoder_fn, 'r') as f:
         encoder = json.load(f)
-    with open(os.path.join(directory_name, 'vocab.bpe'), 'r', encoding="utf-8") as f:
+    with open(bpe_fn, 'r', encoding="utf-8") as f:
         bpe_data = f.read()
     bpe_merges = [tuple(merge_str.split()) for merge_str in bpe_data.split('\n')[1:-1]]
     return Encoder(
         encoder=encoder,
         bpe_merges=bpe_merges,
+        cache_size=cache_size,
     )
 
 
+def compile_encoder(compiled_fn=None, encoder=None):
+    """
+    Writes out a compiled version of the vocab, which is way faster to load than encoder.json + vocab.bpe.
+
+    The format is a JSON header line, then one token per line (in id order), then one merge per line. Tokens are in the
+    byte-level alphabet so they never contain raw spaces or newlines.
+    :param compiled_fn: Where to save it. Defaults to encoder.compiled in CACHE_DIR
+    :param encoder: Optional, an encoder built from the sources
+    :return: the filename
+    """
+    if compiled_fn is None:
+        compiled_fn = _default_compiled_fn()
+    # Before reading the sources, so if they change while we're at it the stats won't match
+    source_stats = _source_stats()
+    if encoder is None:
+        encoder = _get_encoder_from_sources()
+
+    tokens = [encoder.decoder[i] for i in range(len(encoder))]
+    bpe_merges = sorted(encoder.bpe_ranks, key=lambda x: encoder.bpe_ranks[x])
+    header = {
+        'version': COMPILED_ENCODER_VERSION,
+        'source_fingerprint': _source_fingerprint(),
+        'source_stats': source_stats,
+        'num_tokens': len(tokens),
+        'num_merges': len(bpe_merges),
+        'special_token_ids': encoder.special_token_ids,
+    }
+    if os.path.dirname(compiled_fn):
+        os.makedirs(os.path.dirname(compiled_fn), exist_ok=True)
+    # Write to a temp file + rename so that concurrent readers never see a partial file
+    tmp_fn = '{}.{}.tmp'.format(compiled_fn, os.getpid())
+    with open(tmp_fn, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        f.write('\n'.join(tokens) + '\n')
+        f.write('\n'.join(' '.join(x) for x in bpe_merges) + '\n')
+    os.replace(tmp_fn, compiled_fn)
+    return compiled_fn
+
+
+def _load_compiled_encoder(compiled_fn, cache_size=100000):
+    """
+    :return: The encoder, or None if the compiled file is missing or out of date with the sources.
+    """
+    if not os.path.exists(compiled_fn):
+        return None
+    with open(compiled_fn, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != COMPILED_ENCODER_VERSION:
+            return None
+        # Only hash the sources if they look like they've changed
+        if (header.get('source_stats') != _source_stats()) and (
+                header.get('source_fingerprint') != _source_fingerprint()):
+            return None
+        lines = f.read().split('\n')
+
+    num_tokens = header['num_tokens']
+    tokens = lines[:num_tokens]
+    merge_pieces = iter(' '.join(lines[num_tokens:num_tokens + header['num_merges']]).split(' '))
+    bpe_merges = list(zip(merge_pieces, merge_pieces))
+    return Encoder.from_compiled(tokens=tokens, bpe_merges=bpe_merges,
+                                 special_token_ids=header['special_token_ids'], cache_size=cache_size)
+
+
+def get_encoder(cache_size=100000, compiled_fn=None, token_cache=None):
+    """
+    Loads the encoder from the compiled vocab if it's up to date, otherwise from encoder.json + vocab.bpe (in which
+    case we'll also try to compile it to compiled_fn for next time).
+    :param cache_size: Max number of pretokens to keep in the BPE cache (None for unbounded)
+    :param compiled_fn: Where the compiled vocab lives. Defaults to encoder.compiled in CACHE_DIR
+                        ($TURINGADVICE_CACHE_DIR, or ~/.cache/turingadvice)
+    :param token_cache: Optional data.token_cache.TokenCache to look up whole texts in before encoding them
+    :return: the Encoder
+    """
+    if compiled_fn is None:
+        compiled_fn = _default_compiled_fn()
+
+    # We're allocating ~200k small objects that will all stay alive, so there's no point in the GC scanning them
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        encoder = _load_compiled_encoder(compiled_fn, cache_size=cache_size)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    if encoder is None:
+        encoder = _get_encoder_from_sources(cache_size=cache_size)
+        try:
+            compile_encoder(compiled_fn, encoder=encoder)
+        except OSError as e:
+            print("Couldn't compile the encoder to {}: {}".format(compiled_fn, e), flush=True)
+    encoder.token_cache = token_cache
+    return encoder
+
+
 ##############################################################
 # NEWS TOKENIZING
 ##############################################################
@@ -339,18 +624,63 @@ def _is_control(char):
     return False
 
 
-all_chars = [chr(i) for i in range(sys.maxunicode)]
-CONTROL_CHARACTERS = ''.join(c for c in all_chars if _is_control(c))
-sub_dict = {k: None for k in CONTROL_CHARACTERS}
-sub_dict['\t'] = ' '
-CLEAN_TABLE = str.maketrans(sub_dict)
+@lru_cache()
+def get_control_characters():
+    """
+    All the control characters. This needs a scan over every unicode codepoint, so it's built on first use rather than
+    at import time.
+    """
+    return ''.join(chr(i) for i in range(sys.maxunicode) if _is_control(chr(i)))
+
+
+@lru_cache()
+def get_clean_table():
+    """ str.translate table that deletes control characters and turns tabs into spaces"""
+    sub_dict = {k: None for k in get_control_characters()}
+    sub_dict['\t'] = ' '
+    return str.maketrans(sub_dict)
+
+
+def __getattr__(name):
+    # CONTROL_CHARACTERS and CLEAN_TABLE used to be built at import time, keep them around as lazy attributes
+    if name == 'CONTROL_CHARACTERS':
+        return get_control_characters()
+    if name == 'CLEAN_TABLE':
+        return get_clean_table()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+class _PrintableFilter(dict):
+    """
+    str.translate table that drops non-printable characters (except newlines + tabs, and tabs become spaces). It's
+    filled in as we see new characters, so we don't need to scan all of unicode up front.
+    """
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        value = codepoint if (char.isprintable() or char == '\n') else None
+        self[codepoint] = value
+        return value
+
+
+_PRINTABLE_FILTER = _PrintableFilter({ord('\t'): ' '})
+
+_MAYBE_EDIT_PATTERN = re.compile(r'(edit|update)', flags=re.IGNORECASE)
+_EDIT_AT_END_PATTERN = re.compile(r'\n[\W ]*(edit|update).+$', flags=re.IGNORECASE)
+_EDIT_AT_START_PATTERN = re.compile(r'^[\W ]*(edit|update)[\W\d\n ]*.+\n\n', flags=re.IGNORECASE)
+_LEADING_JUNK_PATTERN = re.compile(r'^[\W\n ]*\n+')
+_EDIT_ANYWHERE_PATTERN = re.compile(r'\n[\W ]*(edit|update).*$', flags=re.IGNORECASE | re.DOTALL)
+_HTML_PATTERN = re.compile(r'\&[^\s]+;')
+_REPEATED_AMP_PATTERN = re.compile(r'amp;(amp;)+')
+_NEWLINES_PATTERN = re.compile(r'[\s\n]+\n', flags=re.MULTILINE)
+_PERIOD_SPACES_PATTERN = re.compile(r'\. +')
 
 
 def escape_html(match):
     """ Sometimes there's hidden HTML, we wanna get rid of that"""
     match_txt = match.group(0)
 
-    match_txt = re.sub(r'amp;(amp;)+', 'amp;', match_txt)
+    match_txt = _REPEATED_AMP_PATTERN.sub('amp;', match_txt)
 
     # Keep in the > < overrides.
     common_cases = {
@@ -377,42 +707,76 @@ def clean_reddit_text(text):
     """
     Remove weird HTML things
 
+    Each regex pass is skipped when a cheap check shows it can't match. In particular, all the edit/update patterns need
+    `edit' or `update' somewhere in the text, and we only ever trim from the start or end of the text, so if it isn't
+    there at the beginning it never will be.
+
     :param text: selftext OR comment body text from reddit
     :return:
     """
 
     # Remove these corner case chars
     # text = re.sub(r'[\u200b\ufeff]', '', text)
-    text = ''.join(c for c in text if c.isprintable() or c in '\n\t').replace('\t', ' ')
+    text = text.translate(_PRINTABLE_FILTER)
     # Maybe could have done:
-    # text = text.translate(CLEAN_TABLE)
+    # text = text.translate(get_clean_table())
+
+    has_edit = _MAYBE_EDIT_PATTERN.search(text) is not None
 
     # Remove 'EDIT' if it's at the end
     prev_len = len(text) + 1
     while len(text) < prev_len:
         prev_len = len(text)
-        text_strip = text.strip()
-        text = re.sub(r'\n[\W ]*(edit|update).+$', '', text_strip, flags=re.IGNORECASE)
+        text = text.strip()
+        if has_edit:
+            text = _EDIT_AT_END_PATTERN.sub('', text)
 
-        # If EDIT is at the beginning, trim that. Sometimes people add newlines immediately after. In that case
-        # trim the next line
-        text = re.sub(r'^[\W ]*(edit|update)[\W\d\n ]*.+\n\n', '', text, flags=re.IGNORECASE)
+            # If EDIT is at the beginning, trim that. Sometimes people add newlines immediately after. In that case
+            # trim the next line
+            text = _EDIT_AT_START_PATTERN.sub('', text)
 
         # Trim lines that only have special characters at the beginning
-        text = re.sub(r'^[\W\n ]*\n+', '', text)
+        text = _LEADING_JUNK_PATTERN.sub('', text)
 
     # If edits are still in there, trim everything thereafter
-    text = re.sub(r'\n[\W ]*(edit|update).*$', '', text, flags=re.IGNORECASE | re.DOTALL)
+    if has_edit:
+        text = _EDIT_ANYWHERE_PATTERN.sub('', text)
 
     # Remove weird HTML characters
-    text2 = re.sub(r'\&[^\s]+;', escape_html, text)
+    if '&' in text:
+        text = _HTML_PATTERN.sub(escape_html, text)
 
     # At most two \n's (also take out spaces before them)
-    text3 = re.sub(r'[\s\n]+\n', '\n\n', text2, flags=re.MULTILINE)
+    if '\n' in text:
+        text = _NEWLINES_PATTERN.sub('\n\n', text)
 
     # Take out period then two spaces
-    text3 = re.sub(r'\. +', '. ', text3)
-    return text3.strip()
+    if '. ' in text:
+        text = _PERIOD_SPACES_PATTERN.sub('. ', text)
+    return text.strip()
+
+
+# Markdown where rendering could drop a URL (unused link definitions / footnotes, and lists like `*1. ', which
+# mistune swallows), or could emit a literal <a> (fenced code info strings aren't escaped).
+_LINK_RENDER_FALLBACK_PATTERN = re.compile(r'\]:|[*+-]\d+\.[ \t]')
+
+
+def contains_links(text):
+    """
+    Whether markdown text has a link in it. Same answer as checking mistune.markdown(text) for `<a>', `http://' or
+    `https://', but we only actually render in the (rare) cases where the raw text could give a different answer.
+    :param text: selftext from reddit
+    :return: True if it has links
+    """
+    if '<a>' not in text:
+        if ('http://' not in text) and ('https://' not in text):
+            return False
+        if _LINK_RENDER_FALLBACK_PATTERN.search(text) is None:
+            return True
+
+    import mistune
+    html_format = mistune.markdown(text)
+    return '<a>' in html_format or 'http://' in html_format or 'https://' in html_format
 
 
 def _tokenize_reddit_post_pieces(encoder, subreddit=None, date=None, title=None, selftext=None, body=None,
@@ -460,18 +824,28 @@ def _tokenize_reddit_post_pieces(encoder, subreddit=None, date=None, title=None,
     return article_pieces
 
 
-def trim_paragraphs(selftext, num2del=1):
+def _paragraph_delete_scores(paragraphs, rng=random):
+    """
+    Random scores for which paragraphs to delete first (highest first). We prioritize deleting things without a `?'
+    or a tldr
+    """
+    return [rng.random() + (0 if ('?' in line) or ('tldr' in line.lower().replace(';', '')) else 1)
+            for line in paragraphs]
+
+
+def trim_paragraphs(selftext, num2del=1, rng=random):
     """
     Trims a long selftext.
     :param selftext: The self text
     :param num2del: How many paragraphs to delete.
+    :param rng: Where the randomness comes from (a random.Random, or the random module)
     :return:
     """
     # Otherwise trim from the context + return.
     selftext_split = selftext.split('\n\n')
 
     # Prioritize deleting things without ?
-    delete_score = [random.random() + (0 if ('?' in line) or ('tldr' in line.lower().replace(';','')) else 1) for line in selftext_split]
+    delete_score = _paragraph_delete_scores(selftext_split, rng=rng)
     delete_thresh = sorted(delete_score)[-num2del] * 0.99
 
     selftext = '\n\n'.join(
@@ -479,8 +853,51 @@ def trim_paragraphs(selftext, num2del=1):
     return selftext.strip()
 
 
+def trim_paragraphs_to_length(selftext, encode, max_len, rng=random):
+    """
+    Deletes paragraphs from a long selftext until it's at most max_len tokens. Same priorities as trim_paragraphs.
+
+    Rather than deleting a paragraph and re-encoding everything until it fits, we encode each paragraph once and use
+    those lengths to pick everything we need to delete in one go. Paragraph lengths don't add up exactly to the length
+    of the whole thing, so we still encode the result to check, deleting more if we were off (which is rare).
+
+    :param selftext: The self text
+    :param encode: function from a string to a list of token ids, like encoder.encode
+    :param max_len: Max number of tokens
+    :param rng: Where the randomness comes from (a random.Random, or the random module)
+    :return: the trimmed selftext, and its tokens
+    """
+    tokens = encode(selftext)
+    if len(tokens) <= max_len:
+        return selftext, tokens
+
+    paragraphs = selftext.split('\n\n')
+    lengths = [len(encode(x)) for x in paragraphs]
+    # Whatever the paragraphs don't account for (the separators, mostly) gets spread over the joins
+    join_len = (len(tokens) - sum(lengths)) / max(len(paragraphs) - 1, 1)
+
+    delete_score = _paragraph_delete_scores(paragraphs, rng=rng)
+    delete_order = sorted(range(len(paragraphs)), key=lambda i: -delete_score[i])
+    keep = [True for _ in paragraphs]
+
+    estimated_len = len(tokens)
+    num_deleted = 0
+    while (estimated_len > max_len) and (num_deleted < len(paragraphs)):
+        keep[delete_order[num_deleted]] = False
+        estimated_len -= lengths[delete_order[num_deleted]] + join_len
+        num_deleted += 1
+
+    while True:
+        selftext = '\n\n'.join([line for line, keep_line in zip(paragraphs, keep) if keep_line]).strip()
+        tokens = encode(selftext)
+        if (len(tokens) <= max_len) or (num_deleted == len(paragraphs)):
+            return selftext, tokens
+        keep[delete_order[num_deleted]] = False
+        num_deleted += 1
+
+
 def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, title=None,
-                                        selftext=None, body=None, desired_len=1536):
+                                        selftext=None, body=None, desired_len=1536, rng=random):
     """
     Tokenizes the post title / post selftext / comment body.
     If it's too long we'll cut some paragraphs at random from the selftext.
@@ -490,6 +907,7 @@ def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, titl
     :param title:
     :param selftext:
     :param body:
+    :param rng: Where the randomness (for trimming) comes from. Pass in a seeded random.Random for reproducibility.
     :return:
     """
     if len(selftext) < 64:
@@ -508,42 +926,18 @@ def tokenize_for_grover_advice_training(encoder, subreddit=None, date=None, titl
     if len(context) + len(target) < desired_len:
         return {'context': context, 'target': target}
 
-    # print("Title len {} selftext len {} body len {}. RECURSING".format(len(encoder.encode(title)),
-    #                                                                    len(encoder.encode(selftext)),
-    #                                                                    len(encoder.encode(body))), flush=True)
-
-    # Delete this many paragraphs.
-    # TODO: might need to rehandle the logic for super long bodys. Distribution is
-    # """
-    # ----------
-    # Key selftext
-    #   0.000%: 4.000
-    #   0.100%: 12.000
-    #   25.000%: 222.000
-    #   50.000%: 418.000
-    #   75.000%: 701.000
-    #   90.000%: 1079.000
-    #   95.000%: 1366.300
-    #   99.000%: 2187.000
-    #   99.900%: 3710.000
-    #   99.990%: 5747.000
-    # ----------
-    # Key body
-    #   0.000%: 5.000
-    #   0.100%: 9.000
-    #   25.000%: 41.000
-    #   50.000%: 78.000
-    #   75.000%: 144.000
-    #   90.000%: 242.000
-    #   95.000%: 330.000
-    #   99.000%: 596.000
-    #   99.900%: 1118.848
-    #   99.990%: 1828.224
-    #   """
-    num2del = int(max((len(context) - desired_len) / len(context) * len(selftext.split('\n\n')), 1))
-    selftext = trim_paragraphs(selftext, num2del=num2del)
-    return tokenize_for_grover_advice_training(encoder, subreddit=subreddit, date=date,
-                                               title=title, selftext=selftext, body=body, desired_len=1536)
+    # Too long, so we'll cut some paragraphs from the selftext. Everything else stays the same so we can just work
+    # out how many selftext tokens we can afford.
+    selftext_tokens = article_pieces['selftext'][1:-1]
+    selftext_budget = desired_len - 1 - (len(context) + len(target) - len(selftext_tokens))
+    selftext, selftext_tokens = trim_paragraphs_to_length(selftext, encoder.encode, max_len=selftext_budget, rng=rng)
+    if len(selftext) < 64:
+        return None
+
+    article_pieces['selftext'] = [encoder.begin_article] + selftext_tokens + [encoder.end_article]
+    context = [t for k in ['subreddit', 'date', 'title', 'selftext'] for t in article_pieces[k]]
+    context.append(encoder.begin_summary)
+    return {'context': context, 'target': target}
 
 
 #######################################
@@ -581,5 +975,6 @@ def extract_generated_target(output_tokens, encoder, target):
 
 
 if __name__ == '__main__':
-    encoder = get_encoder()
+    encoder = _get_encoder_from_sources()
+    print("Compiled the encoder to {}".format(compile_encoder(encoder=encoder)))
     print("VOCAB SIZE IS {}".format(len(encoder.encoder)))
@@ -0,0 +1,276 @@
+"""Tests for data.encoder."""
+
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+from absl.testing import absltest
+
+import data.encoder
+from data.encoder import get_encoder, get_pairs, compile_encoder, _get_encoder_from_sources, clean_reddit_text, \
+    trim_paragraphs_to_length, contains_links
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+
+
+def _reference_bpe(encoder, token):
+    """The original min()-over-all-pairs merge loop, which Encoder.bpe needs to match exactly."""
+    word = tuple(token)
+    if len(word) < 2:
+        return token
+    pairs = get_pairs(word)
+    while True:
+        bigram = min(pairs, key=lambda pair: encoder.bpe_ranks.get(pair, float('inf')))
+        if bigram not in encoder.bpe_ranks:
+            break
+        first, second = bigram
+        new_word = []
+        i = 0
+        while i < len(word):
+            try:
+                j = word.index(first, i)
+                new_word.extend(word[i:j])
+                i = j
+            except ValueError:
+                new_word.extend(word[i:])
+                break
+
+            if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
+                new_word.append(first + second)
+                i += 2
+            else:
+                new_word.append(word[i])
+                i += 1
+        word = tuple(new_word)
+        if len(word) == 1:
+            break
+        pairs = get_pairs(word)
+    return ' '.join(word)
+
+
+_worker_cache = None
+
+
+def _init_cache_worker(token_cache):
+    global _worker_cache
+    _worker_cache = token_cache
+
+
+def _put_tokens(i):
+    _worker_cache.put('text number {}'.format(i), 'test', list(range(i % 7 + 1)))
+
+
+class EncoderTest(absltest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.encoder = get_encoder()
+
+    def _pretokens(self, text):
+        return [t.encode('utf-8').decode('latin-1').translate(self.encoder.byte_translation)
+                for t in self.encoder.pat.findall(text)]
+
+    def test_bpe_matches_reference(self):
+        rng = random.Random(1234)
+        alphabet = 'aaabbeeeelnst!?.  \U0001F600é\n'
+        texts = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 200))) for _ in range(500)]
+        texts += [
+            'https://www.example.com/' + 'a' * 300,
+            '!' * 500,
+            '\U0001F600' * 100,
+            "My (27F) boyfriend's mom keeps texting me at 3am?!?! What do I do... TL;DR: help",
+        ]
+        for text in texts:
+            for pretoken in self._pretokens(text):
+                self.encoder.cache.clear()
+                self.assertEqual(self.encoder.bpe(pretoken), _reference_bpe(self.encoder, pretoken))
+
+    def test_encode_batch_preserves_order(self):
+        texts = ['Hello there number {}\n\nhow are you?'.format(i) * (i % 7 + 1) for i in range(200)]
+        expected = [self.encoder.encode(t) for t in texts]
+        self.assertEqual(self.encoder.encode_batch(texts, num_workers=2, chunksize=16), expected)
+
+    def test_decode_roundtrip(self):
+        text = "Café \U0001F600 isn't   spaced\n\nweird\ttabs"
+        self.assertEqual(self.encoder.decode(self.encoder.encode(text)), text)
+
+    def test_cache_is_bounded(self):
+        encoder = get_encoder(cache_size=4)
+        encoder.encode('one two three four five six seven one')
+        self.assertEqual(len(encoder.cache), 4)
+        self.assertEqual(encoder.cache.stats['evictions'], 4)
+
+    def test_compiled_encoder_matches_sources(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compiled_fn = os.path.join(tmp_dir, 'encoder.compiled')
+            from_sources = _get_encoder_from_sources()
+            compile_encoder(compiled_fn, encoder=from_sources)
+            compiled = get_encoder(compiled_fn=compiled_fn)
+            self.assertEqual(compiled.encoder, from_sources.encoder)
+            self.assertEqual(compiled.decoder, from_sources.decoder)
+            self.assertEqual(compiled.bpe_ranks, from_sources.bpe_ranks)
+            self.assertEqual(compiled.special_token_ids, from_sources.special_token_ids)
+
+    def test_stale_compiled_encoder_is_rebuilt(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compiled_fn = os.path.join(tmp_dir, 'encoder.compiled')
+            with open(compiled_fn, 'w') as f:
+                f.write(json.dumps({'version': 1, 'source_fingerprint': 'stale'}) + '\n')
+            encoder = get_encoder(compiled_fn=compiled_fn)
+            self.assertEqual(encoder.encode('Hello world'), self.encoder.encode('Hello world'))
+            with open(compiled_fn, 'r') as f:
+                self.assertNotEqual(json.loads(f.readline())['source_fingerprint'], 'stale')
+
+    def test_compiled_encoder_only_hashes_changed_sources(self):
+        fingerprint = data.encoder._source_fingerprint
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            compiled_fn = compile_encoder(os.path.join(tmp_dir, 'encoder.compiled'),
+                                          encoder=_get_encoder_from_sources())
+
+            def _fail():
+                raise AssertionError("hashed the sources")
+
+            data.encoder._source_fingerprint = _fail
+            try:
+                self.assertIsNotNone(data.encoder._load_compiled_encoder(compiled_fn))
+            finally:
+                data.encoder._source_fingerprint = fingerprint
+
+            # As if the sources were touched (checked out again, say) but are the same
+            with open(compiled_fn, 'r', encoding='utf-8') as f:
+                header, rest = f.readline(), f.read()
+            header = dict(json.loads(header), source_stats=[[0, 0], [0, 0]])
+            with open(compiled_fn, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(header) + '\n' + rest)
+            self.assertIsNotNone(data.encoder._load_compiled_encoder(compiled_fn))
+
+    def test_compiled_encoder_goes_in_cache_dir(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, TURINGADVICE_CACHE_DIR=os.path.join(tmp_dir, 'cache'))
+            repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            subprocess.run([sys.executable, '-c', 'from data.encoder import get_encoder; get_encoder()'],
+                           cwd=repo_root, env=env, check=True)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'cache', 'encoder.compiled')))
+            self.assertFalse(os.path.exists(os.path.join(os.path.dirname(__file__), 'encoder.compiled')))
+
+    def test_import_skips_unicode_scans(self):
+        code = ('import data.encoder as e; '
+                'print(e.get_control_characters.cache_info().currsize, e.get_clean_table.cache_info().currsize)')
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], cwd=repo_root, check=True, stdout=subprocess.PIPE)
+        self.assertEqual(out.stdout.decode('utf-8').split(), ['0', '0'])
+
+    def test_trim_paragraphs_to_length(self):
+        random.seed(1234)
+        paragraphs = ['This is filler paragraph number {}. '.format(i) * 10 for i in range(20)]
+        paragraphs[3] = 'What should I do about my landlord?'
+        selftext = '\n\n'.join(paragraphs)
+
+        calls = []
+
+        def _encode(text):
+            calls.append(text)
+            return self.encoder.encode(text)
+
+        trimmed, tokens = trim_paragraphs_to_length(selftext, _encode, max_len=300)
+        self.assertLessEqual(len(tokens), 300)
+        self.assertEqual(tokens, self.encoder.encode(trimmed))
+        self.assertIn(paragraphs[3], trimmed)
+        # Whole thing once, each paragraph once, then (usually) a single check of the result
+        self.assertLessEqual(len(calls), len(paragraphs) + 3)
+
+    def test_token_cache(self):
+        from data.token_cache import TokenCache
+        texts = ['Paragraph {} of a long post about my landlord and the security deposit.'.format(i) for i in range(50)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            encoder = get_encoder(token_cache=TokenCache(os.path.join(tmp_dir, 'tokens.sqlite')))
+            first = [encoder.encode(t) for t in texts]
+            encoder.token_cache.flush()
+            self.assertEqual(encoder.token_cache.stats['misses'], 50)
+
+            # A new process (or rerun) should get everything from the cache
+            encoder = get_encoder(token_cache=TokenCache(os.path.join(tmp_dir, 'tokens.sqlite')))
+            self.assertEqual([encoder.encode(t) for t in texts], first)
+            self.assertEqual(encoder.token_cache.stats['hit_rate'], 1.0)
+            self.assertEqual(first, [self.encoder.encode(t) for t in texts])
+
+    def test_token_cache_is_bounded(self):
+        from data.token_cache import TokenCache
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            token_cache = TokenCache(os.path.join(tmp_dir, 'tokens.sqlite'), max_bytes=4000, flush_every=10)
+            for i in range(100):
+                token_cache.put('text number {}'.format(i), 'test', list(range(20)))
+            token_cache.flush()
+            self.assertLessEqual(token_cache.size_bytes(), 4000)
+            self.assertGreater(token_cache.stats['evictions'], 0)
+            self.assertIsNotNone(token_cache.get('text number 99', 'test'))
+
+    def test_token_cache_size_and_pool_workers(self):
+        from data.token_cache import TokenCache
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            token_cache = TokenCache(os.path.join(tmp_dir, 'tokens.sqlite'), flush_every=1000)
+            # Fewer than flush_every each, so these only get written when the workers exit
+            with multiprocessing.get_context('fork').Pool(2, initializer=_init_cache_worker,
+                                                          initargs=(token_cache,)) as pool:
+                pool.map(_put_tokens, range(40), chunksize=5)
+                pool.close()
+                pool.join()
+            self.assertLen(token_cache, 40)
+
+            # Replacing entries keeps the running size right
+            token_cache.put('text number 0', 'test', list(range(5)))
+            token_cache.flush()
+            conn = token_cache._connect()
+            self.assertEqual(token_cache.size_bytes(),
+                             conn.execute('SELECT SUM(LENGTH(tokens)) FROM tokens').fetchone()[0])
+
+    def test_token_cache_is_off_by_default(self):
+        env = {k: v for k, v in os.environ.items() if k != 'TURINGADVICE_TOKEN_CACHE'}
+        out = subprocess.run([sys.executable, '-c', 'from data.token_cache import get_token_cache; '
+                                                    'print(get_token_cache())'],
+                             env=env, stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        self.assertEqual(out.strip(), 'None')
+
+    def test_trim_paragraphs_to_length_noop(self):
+        self.assertEqual(trim_paragraphs_to_length('short\n\ntext', self.encoder.encode, max_len=100),
+                         ('short\n\ntext', self.encoder.encode('short\n\ntext')))
+
+
+class CleanRedditTextTest(absltest.TestCase):
+
+    def test_matches_golden_outputs(self):
+        with open(os.path.join(TEST_DATA_DIR, 'clean_reddit_text_golden.jsonl'), 'r') as f:
+            for l in f:
+                item = json.loads(l)
+                self.assertEqual(clean_reddit_text(item['text']), item['cleaned'], msg=repr(item['text']))
+
+    def test_trims_edits(self):
+        text = "My boyfriend forgot our anniversary. What should I do?\n\nEDIT: thanks everyone!"
+        self.assertEqual(clean_reddit_text(text), "My boyfriend forgot our anniversary. What should I do?")
+
+    def test_removes_control_characters(self):
+        self.assertEqual(clean_reddit_text('a\x00b\tc\u200bd'), 'ab cd')
+
+
+class ContainsLinksTest(absltest.TestCase):
+
+    def test_matches_rendering(self):
+        import mistune
+        cases = [
+            'no links here', 'see https://example.com', 'http://example.com', '[text](http://x.com)',
+            '<http://x.com>', '`http://x.com`', '    http://x.com', 'HTTP://X.COM', 'www.example.com',
+            '[a]: http://x.com', '[a]: http://x.com\n\n[a]', '[^1]: http://x.com', 'x[^1]\n\n[^1]: http://x.com',
+            '*1. http://x.com', '* 1. http://x.com', '<a>hi</a>', '~~~<a>\ncode\n~~~', '<!-- http://x.com -->',
+        ]
+        for text in cases:
+            html_format = mistune.markdown(text)
+            expected = '<a>' in html_format or 'http://' in html_format or 'https://' in html_format
+            self.assertEqual(contains_links(text), expected, msg=repr(text))
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,426 @@
+"""
+Runs the data prep scripts as a build graph, so rerunning only redoes what changed.
+
+Each stage is a command with declared inputs and outputs. After a stage succeeds we write a stamp with the command,
+its params and the content hash of every input (scripts included, along with every module in the repo that they
+import). Next time, a stage whose stamp still matches
+and whose outputs all exist is skipped. Since inputs are hashed by content, a stage that gets rerun but writes the
+same bytes as before doesn't trigger anything downstream.
+
+The default graph is
+
+ clean_posts.{dump} / clean_comments.{dump}   one per dump file, see create_redditadvice_2019.py -clean_only
+ join                                         -> redditadvice2019.jsonl
+ store                                        -> redditadvice2019.store (data/advice_store.py)
+ grover                                       -> tfrecords (to_tfrecord_grover.py)
+ t5                                           -> tsvs (to_tfrecord_t5.py)
+ reward_tsvs, reward_tfrecords.{split}        only with -reward_dataset_id (reward/comparative/data)
+
+so adding a month of reddit data means cleaning just that month's dumps. Everything from join onwards still
+depends on all the data: the splits, shuffles and folds are global, so one new post moves things around everywhere.
+
+python data/pipeline.py -posts 'dumps/posts-*.jsonl' -comments 'dumps/comments-*.jsonl' -work_dir work -dry_run
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+sys.path.append('../')
+from data.create_redditadvice_2019 import expand_fns
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _is_remote(fn):
+    return '://' in fn
+
+
+class Stage(object):
+    def __init__(self, name, cmd, inputs=(), outputs=(), params=None, untracked_flags=('-num_workers',)):
+        """
+        :param name: unique name, like clean_posts.posts-2019-01
+        :param cmd: list of arguments to run, from the repo root
+        :param inputs: files or directories the stage reads, including the scripts it runs
+        :param outputs: files or directories the stage writes. Local ones get deleted before it runs
+        :param params: anything else that changes the outputs, if it's not already in cmd
+        :param untracked_flags: flags in cmd (and their values) that don't change the outputs, so changing them
+                                doesn't mean a rebuild
+        """
+        self.name = name
+        self.cmd = [str(x) for x in cmd]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.untracked_flags = set(untracked_flags)
+
+    @property
+    def tracked_cmd(self):
+        """ The part of cmd that goes in the stamp"""
+        cmd = []
+        skip = False
+        for x in self.cmd:
+            if x in self.untracked_flags:
+                skip = True
+            elif skip:
+                skip = False
+            else:
+                cmd.append(x)
+        # Running it with a different python is fine
+        if cmd and cmd[0] == sys.executable:
+            cmd[0] = 'python'
+        return cmd
+
+
+class ContentHasher(object):
+    """ sha1s of files, remembered by (path, size, mtime) so that unchanged files aren't read again"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.hashes = {}
+        if os.path.exists(fn):
+            with open(fn, 'r') as f:
+                self.hashes = json.load(f)
+
+    def _hash_file(self, fn):
+        st = os.stat(fn)
+        key = '{}:{}:{}'.format(os.path.abspath(fn), st.st_size, st.st_mtime_ns)
+        if key not in self.hashes:
+            h = hashlib.sha1()
+            with open(fn, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    h.update(block)
+            self.hashes[key] = h.hexdigest()
+        return self.hashes[key]
+
+    def hash(self, fn):
+        """ :return: hash of the file, or of every file in the directory. None if it doesn't exist"""
+        if _is_remote(fn):
+            raise ValueError("Can't hash {}, inputs need to be local".format(fn))
+        if os.path.isfile(fn):
+            return self._hash_file(fn)
+        if not os.path.isdir(fn):
+            return None
+        h = hashlib.sha1()
+        for dirpath, dirnames, filenames in os.walk(fn):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                h.update('{}\0{}\0'.format(os.path.relpath(path, fn), self._hash_file(path)).encode('utf-8'))
+        return h.hexdigest()
+
+    def save(self):
+        # Only keep entries for files that are still there
+        live = {}
+        for key, value in self.hashes.items():
+            fn, size, mtime = key.rsplit(':', 2)
+            if os.path.isfile(fn):
+                st = os.stat(fn)
+                if (str(st.st_size), str(st.st_mtime_ns)) == (size, mtime):
+                    live[key] = value
+        _write_json_atomic(self.fn, live)
+
+
+def _resolve_module(name, search_dirs):
+    """ :return: the files that importing module name runs (its packages' __init__.py too), if it's in search_dirs"""
+    parts = name.split('.')
+    for d in search_dirs:
+        candidates = [os.path.join(d, *parts) + '.py', os.path.join(d, *parts, '__init__.py')]
+        for fn in candidates:
+            if os.path.isfile(fn):
+                packages = [os.path.join(d, *parts[:i], '__init__.py') for i in range(1, len(parts))]
+                return [x for x in packages if os.path.isfile(x)] + [fn]
+    return []
+
+
+def local_imports(fn, search_dirs):
+    """
+    :param fn: a python file
+    :param search_dirs: where to look for modules, besides fn's own directory. Anything that isn't in one of these
+                        (the standard library, installed packages) gets left out
+    :return: sorted absolute paths of every python file in search_dirs that fn imports, directly or not. Imports
+             inside functions count too
+    """
+    seen = set()
+    todo = [os.path.abspath(fn)]
+    while todo:
+        fn = todo.pop()
+        if fn in seen:
+            continue
+        seen.add(fn)
+        with open(fn, 'rb') as f:
+            try:
+                tree = ast.parse(f.read(), filename=fn)
+            except SyntaxError:
+                continue
+        dirs = [os.path.dirname(fn)] + [os.path.abspath(d) for d in search_dirs]
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [(alias.name, dirs) for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                if node.level > 0:
+                    base = os.path.dirname(fn)
+                    for _ in range(node.level - 1):
+                        base = os.path.dirname(base)
+                    module_dirs = [base]
+                    module = node.module or ''
+                else:
+                    module_dirs = dirs
+                    module = node.module
+                # "from a import b" might mean the module a.b
+                names = [(module, module_dirs)] if module else []
+                names += [('.'.join(x for x in [module, alias.name] if x), module_dirs) for alias in node.names]
+            else:
+                continue
+            for name, module_dirs in names:
+                todo.extend(x for x in _resolve_module(name, module_dirs) if x not in seen)
+    return sorted(seen)
+
+
+def _write_json_atomic(fn, data):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
+class Pipeline(object):
+    def __init__(self, stages, state_dir, cwd=ROOT):
+        """
+        :param stages: list of Stage, in an order where each stage comes after the ones making its inputs
+        :param state_dir: where the stamps + hash cache go
+        :param cwd: where to run the commands (and what relative paths are relative to)
+        """
+        self.stages = stages
+        self.state_dir = state_dir
+        self.cwd = cwd
+        self.hasher = ContentHasher(os.path.join(state_dir, 'hashes.json'))
+        self._imports = {}
+
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError("Stage names need to be unique")
+        # Which stages make the inputs of each one. Reading a file in an output directory counts too
+        self.upstream = {}
+        for i, stage in enumerate(stages):
+            self.upstream[stage.name] = set()
+            for j, other in enumerate(stages):
+                if any(fn == out_fn or fn.startswith(out_fn.rstrip('/') + '/')
+                       for fn in stage.inputs for out_fn in other.outputs):
+                    if j >= i:
+                        raise ValueError("{} reads what {} writes, so it has to come after it".format(
+                            stage.name, other.name))
+                    self.upstream[stage.name].add(other.name)
+
+    def _path(self, fn):
+        return fn if _is_remote(fn) or os.path.isabs(fn) else os.path.join(self.cwd, fn)
+
+    def _stamp_fn(self, stage):
+        return os.path.join(self.state_dir, 'stamps', stage.name.replace('/', '_') + '.json')
+
+    def _inputs(self, stage):
+        """ stage.inputs, plus what the python ones import from the repo"""
+        inputs = list(stage.inputs)
+        for fn in stage.inputs:
+            if not fn.endswith('.py') or not os.path.isfile(self._path(fn)):
+                continue
+            if fn not in self._imports:
+                self._imports[fn] = []
+                for path in local_imports(self._path(fn), [self.cwd, ROOT]):
+                    rel = os.path.relpath(path, self.cwd)
+                    self._imports[fn].append(path if rel.startswith('..') else rel)
+            inputs += [x for x in self._imports[fn] if x not in inputs]
+        return inputs
+
+    def signature(self, stage):
+        """ What the stamp has to match for us to skip the stage"""
+        return {
+            'cmd': stage.tracked_cmd,
+            'params': stage.params,
+            'inputs': {fn: self.hasher.hash(self._path(fn)) for fn in self._inputs(stage)},
+        }
+
+    def why_stale(self, stage):
+        """ :return: None if the stage is up to date, otherwise the reason it needs to run"""
+        missing_inputs = [fn for fn in stage.inputs if not os.path.exists(self._path(fn))]
+        if missing_inputs:
+            return 'missing input {}'.format(missing_inputs[0])
+        stamp_fn = self._stamp_fn(stage)
+        if not os.path.exists(stamp_fn):
+            return 'never built'
+        with open(stamp_fn, 'r') as f:
+            stamp = json.load(f)
+        signature = self.signature(stage)
+        if stamp['cmd'] != signature['cmd']:
+            return 'command changed'
+        if stamp['params'] != signature['params']:
+            return 'params changed'
+        changed = sorted(fn for fn in set(stamp['inputs']) | set(signature['inputs'])
+                         if stamp['inputs'].get(fn) != signature['inputs'].get(fn))
+        if changed:
+            return 'input changed: {}'.format(', '.join(changed))
+        for fn in stage.outputs:
+            if not _is_remote(fn) and not os.path.exists(self._path(fn)):
+                return 'missing output {}'.format(fn)
+        return None
+
+    def _clear_outputs(self, stage):
+        for fn in stage.outputs:
+            path = self._path(fn)
+            if _is_remote(fn):
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            elif os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def run_stage(self, stage):
+        stamp_fn = self._stamp_fn(stage)
+        if os.path.exists(stamp_fn):
+            # So a failed run doesn't leave a stamp that matches
+            os.remove(stamp_fn)
+        self._clear_outputs(stage)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + [x for x in [env.get('PYTHONPATH')] if x])
+        subprocess.run(stage.cmd, cwd=self.cwd, env=env, check=True)
+        for fn in stage.outputs:
+            if not _is_remote(fn) and not os.path.exists(self._path(fn)):
+                raise ValueError("{} finished but didn't write {}".format(stage.name, fn))
+        _write_json_atomic(stamp_fn, self.signature(stage))
+
+    def run(self, only=None, force=False, dry_run=False, log=print):
+        """
+        :param only: if given, just run these stages (and not their upstream ones)
+        :param force: run stages even if they're up to date
+        :param dry_run: just say what would run
+        :return: names of the stages that ran (or would have)
+        """
+        ran = set()
+        try:
+            for stage in self.stages:
+                if only is not None and stage.name not in only:
+                    continue
+                if force:
+                    reason = 'forced'
+                elif dry_run and self.upstream[stage.name] & ran:
+                    # We don't know yet if its inputs will change, assume they will
+                    reason = 'after {}'.format(', '.join(sorted(self.upstream[stage.name] & ran)))
+                else:
+                    reason = self.why_stale(stage)
+                if reason is None:
+                    log('{}: up to date'.format(stage.name))
+                    continue
+                log('{}: running ({})'.format(stage.name, reason))
+                if not dry_run:
+                    self.run_stage(stage)
+                ran.add(stage.name)
+        finally:
+            self.hasher.save()
+        return [stage.name for stage in self.stages if stage.name in ran]
+
+
+def _dump_name(fn):
+    return os.path.splitext(os.path.basename(fn))[0]
+
+
+def default_stages(args):
+    """ The data path from the reddit dumps to every training format, see the top of the file"""
+    py = sys.executable
+    work = args.work_dir.rstrip('/')
+    create_script = 'data/create_redditadvice_2019.py'
+    # The python modules each script imports get added automatically (see Pipeline._inputs), so these are the
+    # scripts themselves and the data files they read
+    encoder_files = ['data/encoder.py', 'data/encoder.json', 'data/vocab.bpe']
+    stages = []
+
+    cleaned = {'posts': [], 'comments': []}
+    for kind in ('posts', 'comments'):
+        dumps = expand_fns(getattr(args, kind))
+        if len(set(map(_dump_name, dumps))) != len(dumps):
+            raise ValueError("Dump files need unique names, got {}".format(dumps))
+        for dump in dumps:
+            out_fn = '{}/cleaned/{}/{}.jsonl'.format(work, kind, _dump_name(dump))
+            cleaned[kind].append(out_fn)
+            stages.append(Stage('clean_{}.{}'.format(kind, _dump_name(dump)),
+                                [py, create_script, '-{}'.format(kind), os.path.abspath(dump), '-clean_only', kind,
+                                 '-out', out_fn, '-num_workers', args.num_workers],
+                                inputs=[dump, create_script] + encoder_files, outputs=[out_fn]))
+
+    jsonl_fn = '{}/redditadvice2019.jsonl'.format(work)
+    join_cmd = [py, create_script, '-posts', ','.join(cleaned['posts']), '-comments', ','.join(cleaned['comments']),
+                '-cleaned', '-out', jsonl_fn, '-seed', args.seed, '-num_workers', args.num_workers]
+    if args.streaming:
+        join_cmd += ['-streaming', '-tmp_dir', '{}/tmp'.format(work)]
+    stages.append(Stage('join', join_cmd, inputs=cleaned['posts'] + cleaned['comments'] + [create_script] +
+                                                encoder_files, outputs=[jsonl_fn]))
+
+    store_dir = '{}/redditadvice2019.store'.format(work)
+    stages.append(Stage('store', [py, '-m', 'data.advice_store', '-in', jsonl_fn, '-out', store_dir],
+                        inputs=[jsonl_fn, 'data/advice_store.py'], outputs=[store_dir]))
+
+    grover_prefix = args.grover_out_prefix or '{}/grover/'.format(work)
+    # Same names as to_tfrecord_grover.fold_file_names, which we can't import without tensorflow
+    num_folds = {'train': args.num_train_folds, 'val': 1, 'test': 1}
+    grover_outputs = ['{}{}{:02d}of{}.tfrecord'.format(grover_prefix, split, fold, n)
+                      for split, n in num_folds.items() for fold in range(n)]
+    stages.append(Stage('grover', [py, 'data/to_tfrecord_grover.py', '-fn', store_dir, '-out_prefix', grover_prefix,
+                                   '-num_train_folds', args.num_train_folds],
+                        inputs=[store_dir, 'data/to_tfrecord_grover.py', 'data/tfrecord_utils.py',
+                                'data/advice_store.py'] + encoder_files, outputs=grover_outputs))
+
+    t5_pattern = '{}/t5/{{split}}.tsv'.format(work)
+    stages.append(Stage('t5', [py, 'data/to_tfrecord_t5.py', store_dir, t5_pattern],
+                        inputs=[store_dir, 'data/to_tfrecord_t5.py', 'data/advice_store.py', 'data/encoder.py',
+                                'data/assertions.py'],
+                        outputs=[t5_pattern.format(split=split) for split in ['train', 'val', 'test']]))
+
+    if args.reward_dataset_id:
+        reward_dir = 'reward/comparative/data/{}'.format(args.reward_dataset_id)
+        cmd = [py, 'reward/comparative/data/jsonl_to_tsvs.py', '--dataset_id={}'.format(args.reward_dataset_id),
+               '--jsonl_path={}'.format(store_dir)]
+        for flag in ('max_time_diff', 'max_len_ratio', 'min_score_ratio'):
+            if getattr(args, flag) is not None:
+                cmd.append('--{}={}'.format(flag, getattr(args, flag)))
+        # jsonl_to_tsvs wants to make the directory itself, so the whole thing is its output
+        tsvs = ['{}/{}_str.tsv'.format(reward_dir, split) for split in ['train', 'val', 'test']]
+        stages.append(Stage('reward_tsvs', cmd, inputs=[store_dir, 'reward/comparative/data/jsonl_to_tsvs.py',
+                                                        'data/assertions.py', 'data/to_tfrecord_t5.py'],
+                            outputs=[reward_dir]))
+        for split, tsv in zip(['train', 'val', 'test'], tsvs):
+            stages.append(Stage('reward_tfrecords.{}'.format(split),
+                                [py, 'reward/comparative/data/tsvs_to_tfrecords.py',
+                                 '--dataset_id={}'.format(args.reward_dataset_id), '--splits={}'.format(split)],
+                                inputs=[tsv, 'reward/comparative/data/tsvs_to_tfrecords.py',
+                                        'reward/comparative/data/ops.py'],
+                                outputs=['{}/{}.tfrecords'.format(reward_dir, split)]))
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build (or update) all the datasets, skipping what is up to date')
+    parser.add_argument('-posts', type=str, required=True, help='Post dumps: a glob or comma separated list')
+    parser.add_argument('-comments', type=str, required=True, help='Comment dumps: a glob or comma separated list')
+    parser.add_argument('-work_dir', type=str, default='pipeline_out', help='Where everything goes (relative to the repo root)')
+    parser.add_argument('-seed', type=int, default=123456)
+    parser.add_argument('-streaming', action='store_true', help='Use create_redditadvice_2019.py -streaming')
+    parser.add_argument('-num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('-num_train_folds', type=int, default=32)
+    parser.add_argument('-grover_out_prefix', type=str, default=None, help='e.g. gs://mybucket/turingadvice/')
+    parser.add_argument('-reward_dataset_id', type=str, default=None, help='Also build this reward model dataset')
+    parser.add_argument('-max_time_diff', type=int, default=None)
+    parser.add_argument('-max_len_ratio', type=float, default=None)
+    parser.add_argument('-min_score_ratio', type=float, default=None)
+    parser.add_argument('-only', type=str, default=None, help='Comma separated stages to run, nothing else')
+    parser.add_argument('-force', action='store_true', help='Rerun stages even if they are up to date')
+    parser.add_argument('-dry_run', action='store_true', help='Just print what would run')
+    args = parser.parse_args()
+
+    pipeline = Pipeline(default_stages(args), state_dir=os.path.join(ROOT, args.work_dir, '.pipeline'))
+    pipeline.run(only=None if args.only is None else set(args.only.split(',')), force=args.force,
+                 dry_run=args.dry_run)
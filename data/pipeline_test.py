@@ -0,0 +1,100 @@
+"""Tests for data.pipeline."""
+
+import os
+import sys
+import tempfile
+
+from absl.testing import absltest
+
+from data.pipeline import Stage, Pipeline
+
+# Copies its inputs into the output, and counts how many times it ran
+_CAT = ("import sys; out, fns = sys.argv[1], [x for x in sys.argv[2:] if '.' in x]; "
+        "open(out, 'w').write(''.join(open(fn).read() for fn in fns)); "
+        "open(out + '.runs', 'a').write('x')")
+
+
+class PipelineTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.tmp_dir.name
+        for name in ['a', 'b']:
+            self._write('{}.dump'.format(name), name * 3)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _write(self, fn, text):
+        with open(os.path.join(self.dir, fn), 'w') as f:
+            f.write(text)
+
+    def _read(self, fn):
+        with open(os.path.join(self.dir, fn), 'r') as f:
+            return f.read()
+
+    def _pipeline(self, dumps=('a', 'b'), seed=1, num_workers=4):
+        stages = [Stage('clean.{}'.format(name), [sys.executable, '-c', _CAT, '{}.clean'.format(name),
+                                                  '{}.dump'.format(name), '-num_workers', num_workers],
+                        inputs=['{}.dump'.format(name)], outputs=['{}.clean'.format(name)]) for name in dumps]
+        stages.append(Stage('join', [sys.executable, '-c', _CAT, 'joined'] + ['{}.clean'.format(x) for x in dumps],
+                            inputs=['{}.clean'.format(x) for x in dumps], outputs=['joined'],
+                            params={'seed': seed}))
+        return Pipeline(stages, state_dir=os.path.join(self.dir, '.pipeline'), cwd=self.dir)
+
+    def _run(self, pipeline, **kwargs):
+        return pipeline.run(log=lambda x: None, **kwargs)
+
+    def test_only_reruns_what_changed(self):
+        self.assertEqual(self._run(self._pipeline()), ['clean.a', 'clean.b', 'join'])
+        self.assertEqual(self._read('joined'), 'aaabbb')
+        self.assertEqual(self._run(self._pipeline(num_workers=8)), [])
+
+        self._write('b.dump', 'BBB')
+        self.assertEqual(self._run(self._pipeline(), dry_run=True), ['clean.b', 'join'])
+        self.assertEqual(self._run(self._pipeline()), ['clean.b', 'join'])
+        self.assertEqual(self._read('joined'), 'aaaBBB')
+        self.assertEqual(self._read('a.clean.runs'), 'x')
+
+        # A new dump just means cleaning that one
+        self._write('c.dump', 'ccc')
+        self.assertEqual(self._run(self._pipeline(dumps=('a', 'b', 'c'))), ['clean.c', 'join'])
+        self.assertEqual(self._read('joined'), 'aaaBBBccc')
+
+    def test_params_and_outputs(self):
+        self._run(self._pipeline())
+        self.assertEqual(self._run(self._pipeline(seed=2)), ['join'])
+        os.remove(os.path.join(self.dir, 'a.clean'))
+        self.assertEqual(self._run(self._pipeline(seed=2)), ['clean.a'])
+        # clean.a wrote the same thing as before, so join is still up to date
+        self.assertEqual(self._read('joined.runs'), 'xx')
+        self.assertEqual(self._run(self._pipeline(seed=2), force=True, only={'join'}), ['join'])
+
+    def test_imported_modules(self):
+        os.mkdir(os.path.join(self.dir, 'pkg'))
+        self._write('pkg/__init__.py', '')
+        self._write('pkg/helper.py', 'from . import other\nimport json\n')
+        self._write('pkg/other.py', 'X = 1\n')
+        self._write('script.py', 'import sys\ndef main():\n    from pkg.helper import other\n' +
+                    'open(sys.argv[1], "w").write("done")\n')
+
+        def pipeline():
+            stage = Stage('script', [sys.executable, 'script.py', 'out'], inputs=['script.py'], outputs=['out'])
+            return Pipeline([stage], state_dir=os.path.join(self.dir, '.pipeline'), cwd=self.dir)
+
+        self.assertEqual(self._run(pipeline()), ['script'])
+        self.assertEqual(self._run(pipeline()), [])
+        # Only imported two levels down, and from inside a function
+        self._write('pkg/other.py', 'X = 2\n')
+        self.assertEqual(self._run(pipeline()), ['script'])
+        self.assertEqual(self._run(pipeline()), [])
+
+    def test_order(self):
+        stages = [Stage('join', ['true'], inputs=['a.clean'], outputs=['joined']),
+                  Stage('clean.a', ['true'], inputs=['a.dump'], outputs=['a.clean'])]
+        with self.assertRaises(ValueError):
+            Pipeline(stages, state_dir=os.path.join(self.dir, '.pipeline'), cwd=self.dir)
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -7,7 +7,7 @@ sys.path.append('../')
 # Enable all logging
 import logging
 import argparse
-from data.encoder import clean_reddit_text
+from data.encoder import clean_reddit_text, contains_links
 import praw
 from praw.models import MoreComments
 from praw.models.reddit import submission, comment
@@ -16,7 +16,6 @@ from collections import OrderedDict
 from datetime import datetime
 import pytz
 import re
-import mistune
 from spacy.tokens import Token
 from tqdm import tqdm
 import random
@@ -78,10 +77,7 @@ def _contains_links(post):
     :param post:
     :return:
     """
-    html_format = mistune.markdown(post)
-    if '<a>' in html_format or 'http://' in html_format or 'https://' in html_format:
-        return True
-    return False
+    return contains_links(post)
 
 
 def _contains_bad_words(spacy_tokens: List[Token],
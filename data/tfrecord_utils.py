@@ -2,12 +2,18 @@
 Go from video files to tfrecord files!
 """
 
+import array
 import collections
+import hashlib
+import json
 import os
+import shutil
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 
 import h5py
+import numpy as np
 import tensorflow as tf
 from google.cloud import storage
 
@@ -30,43 +36,318 @@ def _resolve_maybe_gcloud_fn(gclient, fn, tmp_storage_location):
     return tmp_storage_location
 
 
+class GCSObjectStore(object):
+    """
+    The bits of a gcloud bucket that the streaming writers need.
+    """
+
+    def __init__(self, bucket_name, gclient=None):
+        self.gclient = storage.Client() if gclient is None else gclient
+        self.bucket = self.gclient.get_bucket(bucket_name)
+
+    def upload_file(self, local_fn, name):
+        self.bucket.blob(name).upload_from_filename(local_fn)
+
+    def upload_bytes(self, data, name):
+        self.bucket.blob(name).upload_from_string(data)
+
+    def download_bytes(self, name):
+        """ Returns None if it doesn't exist"""
+        blob = self.bucket.get_blob(name)
+        return None if blob is None else blob.download_as_string()
+
+    def compose(self, names, dest):
+        self.bucket.blob(dest).compose([self.bucket.blob(name) for name in names])
+
+    def delete(self, name):
+        self.bucket.delete_blob(name)
+
+
+class LocalObjectStore(object):
+    """
+    Stand-in for GCSObjectStore that keeps objects as files under root, for testing
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def upload_file(self, local_fn, name):
+        path = self._path(name)
+        shutil.copyfile(local_fn, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def upload_bytes(self, data, name):
+        path = self._path(name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def download_bytes(self, name):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def compose(self, names, dest):
+        if len(names) > MAX_COMPOSE_COMPONENTS:
+            raise ValueError("Can only compose {} objects at once".format(MAX_COMPOSE_COMPONENTS))
+        path = self._path(dest)
+        with open(path + '.tmp', 'wb') as f_out:
+            for name in names:
+                with open(os.path.join(self.root, name), 'rb') as f_in:
+                    shutil.copyfileobj(f_in, f_out)
+        os.replace(path + '.tmp', path)
+
+    def delete(self, name):
+        os.remove(os.path.join(self.root, name))
+
+
+# GCS won't compose more than this many objects in one call
+MAX_COMPOSE_COMPONENTS = 32
+
+
+def compose_parts(store, part_names, dest):
+    """
+    Composes the parts into dest (in order), via intermediate objects if there are more than
+    MAX_COMPOSE_COMPONENTS. Deletes the intermediates afterwards, but not the parts.
+    """
+    to_delete = []
+    level = 0
+    while len(part_names) > MAX_COMPOSE_COMPONENTS:
+        merged = []
+        for i, (start, end) in enumerate(batch_index_iterator(len(part_names), MAX_COMPOSE_COMPONENTS,
+                                                              skip_end=False)):
+            name = '{}.compose/{:02d}-{:05d}'.format(dest, level, i)
+            store.compose(part_names[start:end], name)
+            merged.append(name)
+        to_delete.extend(merged)
+        part_names = merged
+        level += 1
+    store.compose(part_names, dest)
+    for name in to_delete:
+        store.delete(name)
+
+
+class _ChunkedUpload(object):
+    """
+    Uploads numbered parts of an object in the background, and keeps a manifest of the finished parts in the
+    store, next to the parts. If we crash, the next upload of the same object can skip the parts that are in
+    the manifest.
+    """
+
+    def __init__(self, store, name, chunk_size, num_workers=2):
+        self.store = store
+        self.name = name
+        self.chunk_size = chunk_size
+        self.manifest_name = '{}.parts/manifest.json'.format(name)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.max_pending = 2 * num_workers
+        self.pending = collections.deque()
+        self.parts = []
+
+        manifest = self.store.download_bytes(self.manifest_name)
+        manifest = json.loads(manifest.decode('utf-8')) if manifest is not None else None
+        if manifest is not None and manifest['chunk_size'] == chunk_size:
+            self.resumable_parts = manifest['parts']
+        else:
+            self.resumable_parts = []
+
+    def part_name(self, i):
+        return '{}.parts/{:05d}'.format(self.name, i)
+
+    def _write_manifest(self):
+        manifest = {'chunk_size': self.chunk_size, 'parts': self.parts}
+        self.store.upload_bytes(json.dumps(manifest).encode('utf-8'), self.manifest_name)
+
+    def _finish_done(self, wait=False):
+        """ Add finished uploads to the manifest, in order. If wait, block until there's room for more"""
+        updated = False
+        while self.pending and (self.pending[0][0].done() or (wait and len(self.pending) >= self.max_pending)):
+            future, part = self.pending.popleft()
+            future.result()
+            self.parts.append(part)
+            updated = True
+        if updated:
+            self._write_manifest()
+
+    def try_skip(self, part):
+        """
+        If an interrupted upload already got this part up, with the same contents, add it to the manifest and
+        return True. Otherwise we'll need to upload it (and everything after it)
+        """
+        i = len(self.parts) + len(self.pending)
+        if i < len(self.resumable_parts) and all(self.resumable_parts[i].get(k) == v for k, v in part.items()):
+            self.parts.append(self.resumable_parts[i])
+            return True
+        if self.resumable_parts:
+            # Forget about the rest of the old parts, since we'll be overwriting them
+            self.resumable_parts = []
+            self._write_manifest()
+        return False
+
+    def submit(self, local_fn, part):
+        """
+        Uploads local_fn as the next part, in the background. Deletes local_fn when done.
+        :param part: dict with info on the part, that goes in the manifest.
+        """
+        part = dict(part, name=self.part_name(len(self.parts) + len(self.pending)))
+
+        def _upload():
+            self.store.upload_file(local_fn, part['name'])
+            os.remove(local_fn)
+
+        self.pending.append((self.executor.submit(_upload), part))
+        self._finish_done(wait=True)
+
+    def abort(self):
+        """
+        Stops without making the final object. Parts that made it stay up, with the manifest, so a rerun can skip
+        them
+        """
+        for future, _ in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        while self.pending and self.pending[0][0].done() and not self.pending[0][0].cancelled() and \
+                self.pending[0][0].exception() is None:
+            self.parts.append(self.pending.popleft()[1])
+        self.pending.clear()
+        self._write_manifest()
+
+    def finish(self):
+        """ Waits for all parts, then composes them into the final object"""
+        self.executor.shutdown(wait=True)
+        self._finish_done()
+        part_names = [part['name'] for part in self.parts]
+        if part_names:
+            compose_parts(self.store, part_names, self.name)
+        else:
+            self.store.upload_bytes(b'', self.name)
+        # Manifest first, so a crash here can't leave it pointing at deleted parts
+        self.store.delete(self.manifest_name)
+        for name in part_names:
+            self.store.delete(name)
+
+
+def upload_file_in_parts(store, local_fn, name, chunk_size=64 * 1024 * 1024, num_workers=4):
+    """
+    Uploads a local file to the store in chunks, in parallel. If an earlier upload of the same object got
+    interrupted, the chunks that already made it (with the same size + md5) are skipped.
+    """
+    upload = _ChunkedUpload(store, name, chunk_size, num_workers=num_workers)
+    with open(local_fn, 'rb') as f, tempfile.TemporaryDirectory() as tmp_dir:
+        for i, data in enumerate(iter(lambda: f.read(chunk_size), b'')):
+            part = {'num_bytes': len(data), 'md5': hashlib.md5(data).hexdigest()}
+            if upload.try_skip(part):
+                continue
+            part_fn = os.path.join(tmp_dir, '{:05d}'.format(i))
+            with open(part_fn, 'wb') as f_part:
+                f_part.write(data)
+            upload.submit(part_fn, part)
+        upload.finish()
+
+
+def _get_object_store(fn, store=None):
+    """
+    :param fn: gs://bucket/file_name or, if a store is given, anything
+    :return: (store, name in the store), or (None, None) for a local file
+    """
+    if fn.startswith('gs://'):
+        bucket_name, file_name = fn.split('gs://', 1)[1].split('/', 1)
+        return (GCSObjectStore(bucket_name) if store is None else store), file_name
+    if store is not None:
+        return store, fn
+    return None, None
+
+
 class S3TFRecordWriter(object):
-    def __init__(self, fn):
+    def __init__(self, fn, streaming=False, chunk_size=64 * 1024 * 1024, num_upload_workers=2, store=None):
         """
         Upload to gcloud
         :param fn:
-        :param buffer_size: Trying to space out idential things here by shuffling a buffer
-
-        p(first lasts until the end,N) = (1-pflush) ^ (N/(p*buffer_size))
-        each flush event removes buffer_size*p
-        If the buffer size is big enough then we have good randomness I think
+        :param streaming: If true, we'll upload chunks of about chunk_size bytes in the background as we go, then
+                          compose them into fn at the end. Rerunning with the same records will skip the chunks
+                          that got uploaded before a crash.
+        :param chunk_size: Roughly how many bytes per chunk, if streaming
+        :param num_upload_workers: How many chunks to upload at once, if streaming
+        :param store: Where to upload to, defaults to GCSObjectStore. Pass in a LocalObjectStore for testing.
         """
         self.fn = fn
-        if fn.startswith('gs://'):
-            self.gclient = storage.Client()
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.store, self.file_name = _get_object_store(fn, store)
+        self.upload = None
+
+        if self.store is None:
+            self.storage_dir = None
+            self.writer = tf.io.TFRecordWriter(fn)
+        elif streaming:
+            self.storage_dir = TemporaryDirectory()
+            self.upload = _ChunkedUpload(self.store, self.file_name, chunk_size, num_workers=num_upload_workers)
+            self._start_chunk()
+        else:
             self.storage_dir = TemporaryDirectory()
             self.writer = tf.io.TFRecordWriter(os.path.join(self.storage_dir.name, 'temp.tfrecord'))
-            self.bucket_name, self.file_name = self.fn.split('gs://', 1)[1].split('/', 1)
 
+    def _start_chunk(self):
+        self.chunk_fn = os.path.join(self.storage_dir.name, 'chunk{:05d}.tfrecord'.format(
+            len(self.upload.parts) + len(self.upload.pending)))
+        self.writer = tf.io.TFRecordWriter(self.chunk_fn)
+        self.chunk_info = {'num_records': 0, 'num_bytes': 0}
+        self.chunk_md5 = hashlib.md5()
+
+    def _finish_chunk(self):
+        self.writer.close()
+        part = dict(self.chunk_info, md5=self.chunk_md5.hexdigest())
+        if self.upload.try_skip(part):
+            os.remove(self.chunk_fn)
         else:
-            self.gclient = None
-            self.bucket_name = None
-            self.file_name = None
-            self.storage_dir = None
-            self.writer = tf.io.TFRecordWriter(fn)
+            self.upload.submit(self.chunk_fn, part)
 
     def write(self, x):
         self.writer.write(x)
+        if self.upload is not None:
+            # Each record has a 16 byte header + footer
+            self.chunk_info['num_records'] += 1
+            self.chunk_info['num_bytes'] += len(x) + 16
+            self.chunk_md5.update(x)
+            if self.chunk_info['num_bytes'] >= self.chunk_size:
+                self._finish_chunk()
+                self._start_chunk()
 
     def close(self):
+        if self.upload is not None:
+            print("FINISHING UPLOAD", flush=True)
+            if self.chunk_info['num_records'] > 0:
+                self._finish_chunk()
+            else:
+                self.writer.close()
+            # TFRecord files can just be concatenated
+            self.upload.finish()
+            self.storage_dir.cleanup()
+            return
+
         self.writer.close()
 
-        if self.gclient is not None:
+        if self.store is not None:
             print("UPLOADING!!!!!", flush=True)
-            bucket = self.gclient.get_bucket(self.bucket_name)
-            blob = bucket.blob(self.file_name)
-            blob.upload_from_filename(os.path.join(self.storage_dir.name, 'temp.tfrecord'))
+            self.store.upload_file(os.path.join(self.storage_dir.name, 'temp.tfrecord'), self.file_name)
+            self.storage_dir.cleanup()
+
+    def abort(self):
+        """ Like close, but after something went wrong: nothing gets uploaded, and a local file gets deleted"""
+        self.writer.close()
+        if self.upload is not None:
+            self.upload.abort()
+        if self.storage_dir is not None:
             self.storage_dir.cleanup()
+        elif os.path.exists(self.fn):
+            os.remove(self.fn)
 
     def __enter__(self):
         # Called when entering "with" context.
@@ -133,19 +414,71 @@ def batch_index_iterator(len_l, batch_size, skip_end=True):
         yield (b_start, min(b_start + batch_size, len_l))
 
 
+def token_budget_batches(lengths, max_tokens, max_rows=None):
+    """
+    Groups items of similar lengths into batches, longest first, so that each batch padded to its longest item
+    fits in max_tokens. Short items end up in big batches and long ones in small batches.
+
+    :param lengths: the length of each item
+    :param max_tokens: max (# rows * longest length) per batch. Items longer than this get a batch to themselves.
+    :param max_rows: optional cap on the # of rows per batch
+    :return: A generator that returns lists of indices into lengths
+    """
+    batch = []
+    batch_len = 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        # Sorted longest first, so the first item in the batch sets the padded length
+        if batch and ((len(batch) + 1) * batch_len > max_tokens or (max_rows is not None and len(batch) >= max_rows)):
+            yield batch
+            batch = []
+        if not batch:
+            batch_len = lengths[i]
+        batch.append(i)
+    if batch:
+        yield batch
+
+
+def padding_stats(lengths, batches):
+    """
+    How much of the compute on these batches goes to real tokens rather than padding
+    :param lengths: the length of each item
+    :param batches: lists of indices into lengths, like from token_budget_batches
+    :return: dict with num_batches, real_tokens, padded_tokens (including the real ones), and efficiency
+    """
+    real_tokens = 0
+    padded_tokens = 0
+    for batch in batches:
+        real_tokens += sum(lengths[i] for i in batch)
+        padded_tokens += len(batch) * max(lengths[i] for i in batch)
+    return {
+        'num_batches': len(batches),
+        'real_tokens': real_tokens,
+        'padded_tokens': padded_tokens,
+        'efficiency': real_tokens / padded_tokens if padded_tokens else 1.0,
+    }
+
+
 class GCSH5Writer(object):
-    def __init__(self, fn):
+    def __init__(self, fn, streaming=False, chunk_size=64 * 1024 * 1024, num_upload_workers=4, store=None):
+        """
+        :param fn:
+        :param streaming: h5 files get written all over the place, so we can't upload them before they're done.
+                          Instead, if this is true, we'll upload them in parallel chunks at the end, so that an
+                          interrupted upload can pick up where it left off.
+        :param chunk_size: How many bytes per chunk, if streaming
+        :param num_upload_workers: How many chunks to upload at once, if streaming
+        :param store: Where to upload to, defaults to GCSObjectStore. Pass in a LocalObjectStore for testing.
+        """
         self.fn = fn
-        if fn.startswith('gs://'):
-            self.gclient = storage.Client()
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.num_upload_workers = num_upload_workers
+        self.store, self.file_name = _get_object_store(fn, store)
+        if self.store is not None:
             self.storage_dir = tempfile.TemporaryDirectory()
             self.writer = h5py.File(os.path.join(self.storage_dir.name, 'temp.h5'), 'w')
-            self.bucket_name, self.file_name = self.fn.split('gs://', 1)[1].split('/', 1)
 
         else:
-            self.gclient = None
-            self.bucket_name = None
-            self.file_name = None
             self.storage_dir = None
             assert not os.path.exists(self.fn)
             self.writer = h5py.File(self.fn)
@@ -156,10 +489,13 @@ class GCSH5Writer(object):
     def close(self):
         self.writer.close()
 
-        if self.gclient is not None:
-            bucket = self.gclient.get_bucket(self.bucket_name)
-            blob = bucket.blob(self.file_name)
-            blob.upload_from_filename(os.path.join(self.storage_dir.name, 'temp.h5'))
+        if self.store is not None:
+            local_fn = os.path.join(self.storage_dir.name, 'temp.h5')
+            if self.streaming:
+                upload_file_in_parts(self.store, local_fn, self.file_name, chunk_size=self.chunk_size,
+                                     num_workers=self.num_upload_workers)
+            else:
+                self.store.upload_file(local_fn, self.file_name)
             self.storage_dir.cleanup()
 
     def __enter__(self):
@@ -171,3 +507,145 @@ class GCSH5Writer(object):
         # Upload shit
         print("CALLING CLOSE")
         self.close()
+
+
+################################################################################################
+# Flat token store: all the tokens in one array + an index, so we can memmap them instead of
+# parsing tf.train.Examples.
+#
+# {prefix}.json         header with the dtype and sizes
+# {prefix}.tokens.bin   every example's context then target, back to back
+# {prefix}.index.bin    int64 [num_examples, 3] of (start, context end / target start, end)
+###############################################################################################
+
+FLAT_TOKEN_STORE_VERSION = 1
+
+
+def _flat_token_store_fns(prefix):
+    return {'header': prefix + '.json', 'tokens': prefix + '.tokens.bin', 'index': prefix + '.index.bin'}
+
+
+class FlatTokenWriter(object):
+    def __init__(self, prefix, dtype='uint16', store=None):
+        """
+        Writes seq2seq examples to a flat token store. Uploads it at the end if prefix is on gcloud.
+        :param prefix: where to save it, like train00of32
+        :param dtype: uint16 is fine for both the Grover and T5 vocabs, otherwise use int32
+        :param store: Where to upload to, defaults to GCSObjectStore. Pass in a LocalObjectStore for testing.
+        """
+        self.prefix = prefix
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype('uint16'), np.dtype('int32')):
+            raise ValueError("dtype must be uint16 or int32, not {}".format(dtype))
+        self.max_token = np.iinfo(self.dtype).max
+
+        self.store, self.file_name = _get_object_store(prefix, store)
+        if self.store is not None:
+            self.storage_dir = TemporaryDirectory()
+            local_prefix = os.path.join(self.storage_dir.name, 'temp')
+        else:
+            self.storage_dir = None
+            local_prefix = prefix
+        self.local_fns = _flat_token_store_fns(local_prefix)
+        self.tokens_file = open(self.local_fns['tokens'], 'wb')
+        # (start, mid, end) for each example, flattened
+        self.index = array.array('q')
+        self.num_tokens = 0
+
+    def write(self, context, target):
+        """
+        :param context: list of token ids
+        :param target: list of token ids
+        """
+        tokens = np.asarray(list(context) + list(target), dtype=np.int64)
+        if tokens.size and (tokens.min() < 0 or tokens.max() > self.max_token):
+            raise ValueError("Token ids must be in [0, {}] to use {}".format(self.max_token, self.dtype))
+        self.tokens_file.write(tokens.astype(self.dtype).tobytes())
+        start = self.num_tokens
+        self.num_tokens += tokens.size
+        self.index.extend((start, start + len(context), self.num_tokens))
+
+    def close(self):
+        self.tokens_file.close()
+        np.frombuffer(self.index, dtype=np.int64).tofile(self.local_fns['index'])
+        with open(self.local_fns['header'], 'w') as f:
+            json.dump({'version': FLAT_TOKEN_STORE_VERSION, 'dtype': self.dtype.name,
+                       'num_examples': len(self.index) // 3, 'num_tokens': self.num_tokens}, f)
+
+        if self.store is not None:
+            for k, fn in _flat_token_store_fns(self.file_name).items():
+                self.store.upload_file(self.local_fns[k], fn)
+            self.storage_dir.cleanup()
+
+    def abort(self):
+        """ Like close, but after something went wrong: nothing gets uploaded, and local files get deleted"""
+        self.tokens_file.close()
+        if self.storage_dir is not None:
+            self.storage_dir.cleanup()
+            return
+        for fn in self.local_fns.values():
+            if os.path.exists(fn):
+                os.remove(fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class FlatTokenReader(object):
+    def __init__(self, prefix, _arrays=None, _range=None):
+        """
+        Memory maps a flat token store, so opening it is free and examples are read lazily. Indexing gives
+        numpy views into the token array, without copying.
+        :param prefix: the same prefix passed to FlatTokenWriter (local only)
+        """
+        self.prefix = prefix
+        if _arrays is None:
+            fns = _flat_token_store_fns(prefix)
+            with open(fns['header'], 'r') as f:
+                header = json.load(f)
+            if header['version'] != FLAT_TOKEN_STORE_VERSION:
+                raise ValueError("{} is version {}, expected {}".format(
+                    fns['header'], header['version'], FLAT_TOKEN_STORE_VERSION))
+            # np.memmap won't map empty files
+            if header['num_tokens'] > 0:
+                tokens = np.memmap(fns['tokens'], dtype=header['dtype'], mode='r', shape=(header['num_tokens'],))
+            else:
+                tokens = np.zeros(0, dtype=header['dtype'])
+            if header['num_examples'] > 0:
+                index = np.memmap(fns['index'], dtype=np.int64, mode='r', shape=(header['num_examples'], 3))
+            else:
+                index = np.zeros((0, 3), dtype=np.int64)
+            _arrays = (tokens, index)
+        self.tokens, index = _arrays
+        self.index = index if _range is None else index[_range[0]:_range[1]]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, i):
+        """
+        :return: dict with context and target, as views into the memmapped tokens
+        """
+        start, mid, end = self.index[i]
+        return {'context': self.tokens[start:mid], 'target': self.tokens[mid:end]}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        """ Total (context + target) length of each example, without touching the tokens"""
+        return self.index[:, 2] - self.index[:, 0]
+
+    def shard(self, shard_id, num_shards):
+        """
+        A reader over a contiguous 1/num_shards of the examples, sharing the same memmaps.
+        """
+        if not 0 <= shard_id < num_shards:
+            raise ValueError("shard_id must be in [0, {})".format(num_shards))
+        start = len(self) * shard_id // num_shards
+        end = len(self) * (shard_id + 1) // num_shards
+        return FlatTokenReader(self.prefix, _arrays=(self.tokens, self.index), _range=(start, end))
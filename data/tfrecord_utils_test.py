@@ -0,0 +1,127 @@
+"""Tests for data.tfrecord_utils."""
+
+import os
+import tempfile
+
+import tensorflow as tf
+from absl.testing import absltest
+
+from data.tfrecord_utils import LocalObjectStore, S3TFRecordWriter, upload_file_in_parts, token_budget_batches, \
+    padding_stats, FlatTokenWriter, FlatTokenReader
+
+
+class StreamingUploadTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.store = LocalObjectStore(os.path.join(self.tmp_dir.name, 'bucket'))
+        self.records = [('record {}'.format(i) * (i % 13 + 1)).encode('utf-8') for i in range(2000)]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _read_records(self, name):
+        fn = os.path.join(self.store.root, name)
+        # Works in graph mode too (TF 1.15), unlike iterating over a TFRecordDataset
+        return list(tf.compat.v1.io.tf_record_iterator(fn))
+
+    def test_streaming_tfrecord(self):
+        # Small chunks, so we need more than one round of composes
+        with S3TFRecordWriter('gs://bucket/train.tfrecord', streaming=True, chunk_size=4096,
+                              store=self.store) as writer:
+            for x in self.records:
+                writer.write(x)
+        self.assertEqual(self._read_records('train.tfrecord'), self.records)
+        self.assertIsNone(self.store.download_bytes('train.tfrecord.parts/manifest.json'))
+
+    def test_streaming_tfrecord_resumes(self):
+        writer = S3TFRecordWriter('gs://bucket/train.tfrecord', streaming=True, chunk_size=4096, store=self.store)
+        for x in self.records[:1000]:
+            writer.write(x)
+        # Crash, after the uploads in flight finish
+        writer.upload.executor.shutdown(wait=True)
+        writer.upload._finish_done()
+        num_uploaded = len(writer.upload.parts)
+        self.assertGreater(num_uploaded, 0)
+
+        writer = S3TFRecordWriter('gs://bucket/train.tfrecord', streaming=True, chunk_size=4096, store=self.store)
+        self.assertLen(writer.upload.resumable_parts, num_uploaded)
+        for x in self.records:
+            writer.write(x)
+        writer.close()
+        self.assertEqual(self._read_records('train.tfrecord'), self.records)
+
+    def test_abort_uploads_nothing(self):
+        writer = S3TFRecordWriter('gs://bucket/train.tfrecord', streaming=True, chunk_size=4096, store=self.store)
+        for x in self.records[:1000]:
+            writer.write(x)
+        writer.abort()
+        self.assertIsNone(self.store.download_bytes('train.tfrecord'))
+        # What did get uploaded can still be reused
+        with S3TFRecordWriter('gs://bucket/train.tfrecord', streaming=True, chunk_size=4096,
+                              store=self.store) as writer:
+            self.assertNotEmpty(writer.upload.resumable_parts)
+            for x in self.records:
+                writer.write(x)
+        self.assertEqual(self._read_records('train.tfrecord'), self.records)
+
+        writer = FlatTokenWriter('gs://bucket/train00of01', store=self.store)
+        writer.write([1, 2], [3])
+        writer.abort()
+        self.assertIsNone(self.store.download_bytes('train00of01.json'))
+        self.assertIsNone(self.store.download_bytes('train00of01.tokens.bin'))
+
+    def test_upload_file_in_parts(self):
+        local_fn = os.path.join(self.tmp_dir.name, 'temp.h5')
+        with open(local_fn, 'wb') as f:
+            f.write(os.urandom(100000))
+        upload_file_in_parts(self.store, local_fn, 'features.h5', chunk_size=1000)
+        with open(local_fn, 'rb') as f:
+            self.assertEqual(self.store.download_bytes('features.h5'), f.read())
+
+
+class TokenBudgetBatchesTest(absltest.TestCase):
+
+    def test_batches_fit_budget(self):
+        lengths = [(i * 37) % 1280 + 1 for i in range(500)]
+        batches = list(token_budget_batches(lengths, max_tokens=8192, max_rows=32))
+        self.assertCountEqual([i for batch in batches for i in batch], range(500))
+        for batch in batches:
+            self.assertLessEqual(len(batch), 32)
+            self.assertLessEqual(len(batch) * max(lengths[i] for i in batch), 8192)
+        # Short things go in bigger batches
+        self.assertGreater(len(batches[-2]), len(batches[0]))
+        self.assertGreater(padding_stats(lengths, batches)['efficiency'], 0.9)
+
+    def test_long_items_get_their_own_batch(self):
+        self.assertEqual(list(token_budget_batches([10, 5000, 20], max_tokens=1000)), [[1], [2, 0]])
+
+
+class FlatTokenStoreTest(absltest.TestCase):
+
+    def test_roundtrip_and_shard(self):
+        examples = [(list(range(i, i + i % 7)), [50000 + i % 200] * (i % 5 + 1)) for i in range(300)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prefix = os.path.join(tmp_dir, 'train00of01')
+            with FlatTokenWriter(prefix) as writer:
+                for context, target in examples:
+                    writer.write(context, target)
+
+            reader = FlatTokenReader(prefix)
+            self.assertLen(reader, len(examples))
+            self.assertEqual(reader[123]['context'].tolist(), examples[123][0])
+            self.assertEqual(reader[123]['target'].tolist(), examples[123][1])
+            self.assertEqual(reader.lengths().tolist(), [len(c) + len(t) for c, t in examples])
+
+            shards = [reader.shard(i, 4) for i in range(4)]
+            self.assertEqual([x['target'].tolist() for shard in shards for x in shard], [t for _, t in examples])
+
+    def test_rejects_big_token_ids(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            writer = FlatTokenWriter(os.path.join(tmp_dir, 'x'))
+            with self.assertRaises(ValueError):
+                writer.write([70000], [1])
+
+
+if __name__ == '__main__':
+    absltest.main()
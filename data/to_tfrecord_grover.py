@@ -1,47 +1,167 @@
 """
+Turns advice.jsonl (from create_redditadvice_2019.py) into tfrecords for Grover.
+
+We only read the file once: first we get the offset and sort key of each post, then we seek to the posts in
+shuffled order and send each inference to the right fold. All the folds are written at once, then uploaded
+in parallel.
 """
 
+import argparse
 import json
+import os
 import sys
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from tqdm import tqdm
 
 sys.path.append('../')
-from data.encoder import get_encoder, clean_reddit_text, tokenize_for_grover_advice_training
-from data.tfrecord_utils import S3TFRecordWriter, int64_list_feature
-import mistune
-from datetime import datetime
+from data.tfrecord_utils import S3TFRecordWriter, FlatTokenWriter, int64_list_feature
+from data.advice_store import AdviceStore
 import random
 import tensorflow as tf
 
-encoder = get_encoder()
-random.seed(123456)
-advice = []
-with open('advice.jsonl', 'r') as f:
-    for l in tqdm(f):
-        item = json.loads(l)
-        advice.append(item)
-training_examples_sorted = sorted(advice,
-                                  key=lambda x: ({'test': 0, 'val': 1, 'train': 2}[x['split']], -x['created_utc']))
-
-random.shuffle(training_examples_sorted)
-
-for split in ['train', 'val', 'test']:
-    inferences_this_split = [y for x in training_examples_sorted if x['split'] == split for y in x['tokens']]
-
-    num_folds = 32 if split == 'train' else 1
-
-    print("{} inferences for {}".format(len(inferences_this_split), split))
-    for fold in range(num_folds):
-
-        # Change this file if you want to save somewhere else
-        file_name = '{}{:02d}of{}.tfrecord'.format(split, fold, num_folds)
-        with S3TFRecordWriter(file_name) as writer:
-            for i, item in enumerate(tqdm(inferences_this_split)):
-                if i % num_folds == fold:
-                    features = OrderedDict()
-                    features['context'] = int64_list_feature(item['context'])
-                    features['target'] = int64_list_feature(item['target'])
-                    ex = tf.train.Example(features=tf.train.Features(feature=features))
-                    writer.write(ex.SerializeToString())
+SPLIT_ORDER = {'test': 0, 'val': 1, 'train': 2}
+
+parser = argparse.ArgumentParser(description='Convert advice.jsonl to tfrecords')
+parser.add_argument(
+    '-fn',
+    dest='fn',
+    default='advice.jsonl',
+    type=str,
+    help='Jsonl made by create_redditadvice_2019.py, or a store made from it with data/advice_store.py',
+)
+parser.add_argument(
+    '-out_prefix',
+    dest='out_prefix',
+    default='',
+    type=str,
+    help='Where to save the tfrecords, e.g. gs://mybucket/turingadvice/',
+)
+parser.add_argument(
+    '-num_train_folds',
+    dest='num_train_folds',
+    default=32,
+    type=int,
+    help='How many files to split the training set into',
+)
+parser.add_argument(
+    '-format',
+    dest='format',
+    default='tfrecord',
+    choices=['tfrecord', 'flat'],
+    help='tfrecord for training, or flat for a memmappable token store (see FlatTokenReader)',
+)
+parser.add_argument(
+    '-num_upload_workers',
+    dest='num_upload_workers',
+    default=8,
+    type=int,
+    help='How many files to finish / upload at once',
+)
+
+
+def index_posts(fn):
+    """
+    :param fn: advice.jsonl, or a store
+    :return: A list of (sort key, split, offset) for each post, in file order. We don't keep the posts around.
+             For a store, the offset is the row.
+    """
+    if os.path.isdir(fn):
+        store = AdviceStore(fn)
+        splits = store.column('split')
+        created_utc = store.column('created_utc')
+        return [((SPLIT_ORDER[splits[i]], -int(created_utc[i])), splits[i], i) for i in range(len(store))]
+
+    index = []
+    with open(fn, 'rb') as f:
+        offset = f.tell()
+        for l in tqdm(iter(f.readline, b'')):
+            item = json.loads(l)
+            index.append(((SPLIT_ORDER[item['split']], -item['created_utc']), item['split'], offset))
+            offset = f.tell()
+    return index
+
+
+def iter_inferences_shuffled(fn, index):
+    """
+    Yields (split, inference) in the same order as sorting + shuffling all the posts in memory would.
+    random.shuffle's permutation only depends on the length, so shuffling the index instead of the posts is fine.
+
+    :param fn: advice.jsonl, or a store
+    :param index: from index_posts
+    """
+    index = [(split, offset) for _, split, offset in sorted(index, key=lambda x: x[0])]
+    random.shuffle(index)
+    if os.path.isdir(fn):
+        store = AdviceStore(fn)
+        for split, row in index:
+            for inference in store.get(row, fields=['tokens'])['tokens']:
+                yield split, inference
+        return
+
+    with open(fn, 'rb') as f:
+        for split, offset in index:
+            f.seek(offset)
+            for inference in json.loads(f.readline())['tokens']:
+                yield split, inference
+
+
+def fold_file_names(out_prefix, num_train_folds=32, ext='.tfrecord'):
+    """
+    :return: {split: [file name for each fold]}
+    """
+    num_folds = {'train': num_train_folds, 'val': 1, 'test': 1}
+    return {split: ['{}{}{:02d}of{}{}'.format(out_prefix, split, fold, n, ext) for fold in range(n)]
+            for split, n in num_folds.items()}
+
+
+def write_folds(inferences, file_names, num_upload_workers=8, flat=False):
+    """
+    Fans out the inferences to every fold at once. The i-th inference of a split goes to fold i % num_folds.
+
+    :param inferences: iterable of (split, inference)
+    :param file_names: {split: [file name for each fold]}
+    :param num_upload_workers: how many writers to close (and upload) at once
+    :param flat: write FlatTokenWriter stores instead of tfrecords
+    :return: {split: number of inferences}
+    """
+    writer_cls = FlatTokenWriter if flat else S3TFRecordWriter
+    writers = {split: [writer_cls(fn) for fn in fns] for split, fns in file_names.items()}
+    counts = {split: 0 for split in writers}
+    try:
+        for split, item in tqdm(inferences):
+            writer = writers[split][counts[split] % len(writers[split])]
+            if flat:
+                writer.write(item['context'], item['target'])
+            else:
+                features = OrderedDict()
+                features['context'] = int64_list_feature(item['context'])
+                features['target'] = int64_list_feature(item['target'])
+                ex = tf.train.Example(features=tf.train.Features(feature=features))
+                writer.write(ex.SerializeToString())
+            counts[split] += 1
+    except BaseException:
+        # Don't upload truncated folds. The original error is the one that matters, so errors here get dropped
+        for w in [w for ws in writers.values() for w in ws]:
+            try:
+                w.abort()
+            except Exception:
+                pass
+        raise
+    with ThreadPoolExecutor(max_workers=num_upload_workers) as executor:
+        # list() so that any upload errors get raised here
+        list(executor.map(lambda w: w.close(), [w for ws in writers.values() for w in ws]))
+    return counts
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    random.seed(123456)
+
+    counts = write_folds(iter_inferences_shuffled(args.fn, index_posts(args.fn)),
+                         fold_file_names(args.out_prefix, num_train_folds=args.num_train_folds,
+                                         ext='.tfrecord' if args.format == 'tfrecord' else ''),
+                         num_upload_workers=args.num_upload_workers, flat=args.format == 'flat')
+    for split in ['train', 'val', 'test']:
+        print("{} inferences for {}".format(counts[split], split))
@@ -9,11 +9,15 @@ import sys
 sys.path.append('../')
 import random
 from datetime import datetime
-from data.encoder import trim_paragraphs
-from t5.data.sentencepiece_vocabulary import SentencePieceVocabulary
+from functools import lru_cache
+from data.encoder import trim_paragraphs_to_length, CACHE_DIR
 from data.assertions import question_is_valid, answer_is_valid
+from data.advice_store import iter_advice
+from data.token_cache import get_token_cache
 import sys
-from unidecode import unidecode
+import hashlib
+import os
+import pickle
 
 import regex as re
 from tqdm import tqdm
@@ -24,9 +28,11 @@ import warnings
 
 random.seed(123456)
 
-# Make sure unidecode doesn't touch whatever is in the sentencepiece model
-encoder = SentencePieceVocabulary(sentencepiece_model_file='gs://t5-data/vocabs/cc_all.32000/sentencepiece.model')
-valid_symbols = sorted(set(''.join(encoder.decode([x]) for x in range(encoder.vocab_size))))
+# Set T5_SENTENCEPIECE_MODEL to a local copy of the vocab to work offline.
+SENTENCEPIECE_MODEL_FILE = os.environ.get('T5_SENTENCEPIECE_MODEL',
+                                          'gs://t5-data/vocabs/cc_all.32000/sentencepiece.model')
+# The unidecode table takes minutes to build, so we cache it in CACHE_DIR (the same place as the compiled BPE vocab)
+UNIDECODE_TABLE_VERSION = 1
 
 emoji_pattern = re.compile("["
                            u"\U0001F600-\U0001F64F"  # emoticons
@@ -36,33 +42,161 @@ emoji_pattern = re.compile("["
                            u"\U00002702-\U000027B0"
                            u"\U000024C2-\U0001F251"
                            "]+", flags=re.UNICODE)
-with warnings.catch_warnings():
-    old2new_unidecode = {}
-    for i in range(sys.maxunicode):
-        val_i = chr(i)
-        if val_i in valid_symbols:
-            continue
+
+
+@lru_cache()
+def get_encoder():
+    """ Loads the sentencepiece vocab the first time it's needed"""
+    from t5.data.sentencepiece_vocabulary import SentencePieceVocabulary
+    return SentencePieceVocabulary(sentencepiece_model_file=SENTENCEPIECE_MODEL_FILE)
+
+
+class _LazyEncoder(object):
+    """
+    Stands in for the SentencePieceVocabulary, so importing this module doesn't load it. encode() goes through the
+    token cache (see data/token_cache.py) if there is one.
+    """
+
+    def encode(self, s):
+        token_cache = get_token_cache()
+        if token_cache is None:
+            return get_encoder().encode(s)
+        return token_cache.encode(s, get_encoder().encode, 'sentencepiece-' + _vocab_fingerprint())
+
+    def __getattr__(self, name):
+        return getattr(get_encoder(), name)
+
+
+encoder = _LazyEncoder()
+
+
+def _unidecode_version():
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        from pkg_resources import get_distribution
+        return get_distribution('Unidecode').version
+    return version('Unidecode')
+
+
+def _gcs_object_version(fn):
+    """ :return: the generation + etag of a gs:// object, which change whenever it gets overwritten"""
+    from google.auth.exceptions import DefaultCredentialsError
+    from google.cloud import storage
+    bucket_name, name = fn.split('gs://', 1)[1].split('/', 1)
+    try:
+        gclient = storage.Client()
+    except DefaultCredentialsError:
+        # The T5 vocabs are public
+        gclient = storage.Client.create_anonymous_client()
+    blob = gclient.bucket(bucket_name).get_blob(name)
+    if blob is None:
+        raise ValueError("{} doesnt exist".format(fn))
+    return '{}-{}'.format(blob.generation, blob.etag)
+
+
+@lru_cache()
+def _vocab_fingerprint():
+    """
+    Identifies the sentencepiece vocab. For local vocab files we key on the contents; remote ones (like the default
+    gs:// one) are keyed on the path and the object's generation, so we don't need to download anything.
+    """
+    key = hashlib.sha1(SENTENCEPIECE_MODEL_FILE.encode('utf-8'))
+    if SENTENCEPIECE_MODEL_FILE.startswith('gs://'):
         try:
-            unidecode_vali = unidecode(val_i)
-        except Warning as e:
-            # Surrogate character will be ignored?
-            continue
-        if unidecode_vali == val_i:
-            continue
-        if unidecode_vali == '[?]':
-            old2new_unidecode[val_i] = ''
-            continue
-        if emoji_pattern.match(val_i) is not None:
-            old2new_unidecode[val_i] = ''
-            continue
-        old2new_unidecode[val_i] = unidecode_vali
-old2new_unidecode['\t'] = ' '
-FAST_UNIDECODE = str.maketrans(old2new_unidecode)
+            key.update(_gcs_object_version(SENTENCEPIECE_MODEL_FILE).encode('utf-8'))
+        except Exception as e:
+            # Probably offline, in which case we can only use what's cached anyway
+            print("Couldn't look up {}, going by its path: {}".format(SENTENCEPIECE_MODEL_FILE, e), flush=True)
+    elif os.path.exists(SENTENCEPIECE_MODEL_FILE):
+        with open(SENTENCEPIECE_MODEL_FILE, 'rb') as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def _unidecode_cache_fn():
+    """
+    Where the unidecode table for this vocab + unidecode version lives.
+    """
+    key = hashlib.sha1()
+    key.update('{}|{}|{}'.format(UNIDECODE_TABLE_VERSION, _unidecode_version(), _vocab_fingerprint()).encode('utf-8'))
+    return os.path.join(CACHE_DIR, 'unidecode-{}.pkl'.format(key.hexdigest()))
+
+
+def _build_unidecode_table(valid_symbols):
+    """ Maps every character that's not in the vocab to whatever unidecode turns it into"""
+    from unidecode import unidecode
+
+    valid_symbols = set(valid_symbols)
+    with warnings.catch_warnings():
+        old2new_unidecode = {}
+        for i in range(sys.maxunicode):
+            val_i = chr(i)
+            if val_i in valid_symbols:
+                continue
+            try:
+                unidecode_vali = unidecode(val_i)
+            except Warning as e:
+                # Surrogate character will be ignored?
+                continue
+            if unidecode_vali == val_i:
+                continue
+            if unidecode_vali == '[?]':
+                old2new_unidecode[val_i] = ''
+                continue
+            if emoji_pattern.match(val_i) is not None:
+                old2new_unidecode[val_i] = ''
+                continue
+            old2new_unidecode[val_i] = unidecode_vali
+    old2new_unidecode['\t'] = ' '
+    return str.maketrans(old2new_unidecode)
+
+
+@lru_cache()
+def _get_unidecode_tables():
+    """
+    :return: (the str.translate table, sorted list of symbols in the vocab). Loaded from CACHE_DIR if possible.
+    """
+    cache_fn = _unidecode_cache_fn()
+    if os.path.exists(cache_fn):
+        with open(cache_fn, 'rb') as f:
+            return pickle.load(f)
+
+    # Make sure unidecode doesn't touch whatever is in the sentencepiece model
+    vocab = get_encoder()
+    valid_symbols = sorted(set(''.join(vocab.decode([x]) for x in range(vocab.vocab_size))))
+    tables = (_build_unidecode_table(valid_symbols), valid_symbols)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_fn = '{}.{}.tmp'.format(cache_fn, os.getpid())
+        with open(tmp_fn, 'wb') as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_fn, cache_fn)
+    except OSError as e:
+        print("Couldn't cache the unidecode table to {}: {}".format(cache_fn, e), flush=True)
+    return tables
+
+
+def get_fast_unidecode():
+    return _get_unidecode_tables()[0]
+
+
+def get_valid_symbols():
+    return _get_unidecode_tables()[1]
+
+
+def __getattr__(name):
+    # These used to get built at import time
+    if name == 'FAST_UNIDECODE':
+        return get_fast_unidecode()
+    if name == 'valid_symbols':
+        return get_valid_symbols()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def _fix_reddit_text(x):
     """TSV writer will complain if I can't do newlines. note that this will return an UNK"""
-    x1 = x.translate(FAST_UNIDECODE)
+    x1 = x.translate(get_fast_unidecode())
     x3 = re.sub(r'[\s\n]*\n\n[\s\n]*', ' » ', x1, flags=re.MULTILINE)  # Double newline
     x4 = re.sub(r'[\s\n]*\n[\s\n]*', ' ', x3, flags=re.MULTILINE)  # Single newline
     x4 = re.sub(r'\s+', ' ', x4)
@@ -71,11 +205,8 @@ def _fix_reddit_text(x):
 
 def _trim_to_desired_length(encoder, text, desired_len=512):
     """ Trims a piece to the desired length, for sometimes long article pieces"""
-    doc_len = len(encoder.encode(text))
-    if doc_len <= desired_len:
-        return text
-    text = trim_paragraphs(selftext=text, num2del=1)
-    return _trim_to_desired_length(encoder, text, desired_len=desired_len)
+    text, _ = trim_paragraphs_to_length(text, encoder.encode, max_len=desired_len)
+    return text
 
 
 def tokenize_for_t5_advice_training(encoder, subreddit=None, date=None, title=None,
@@ -139,32 +270,33 @@ if __name__ == '__main__':
     Parameters
     ----------
     static_dataset_path : str
-        Dataset generated by create_redditadvice_2019.py
+        Dataset generated by create_redditadvice_2019.py, or a store made from it with data/advice_store.py
+    output_tsv_path : str, optional
+        Where to write each split, with {split} in it. Defaults to ./data/{split}.tsv
     """
     TRAIN_ANSS_PER_Q = 10
     TOTAL_TEST_ANSS = 8192
     TOTAL_VAL_ANSS = 8192
-    OUTPUT_TSV_PATH = "./data/{split}.tsv"
+    OUTPUT_TSV_PATH = sys.argv[2] if len(sys.argv) > 2 else "./data/{split}.tsv"
     static_dataset_path = sys.argv[1]
     # Which answers to use per question? Build anss_in_dataset
     valid_anss_per_question = []
-    with open(static_dataset_path, "r") as static_dataset:
-        print("Sorting questions by date")
-        for line in tqdm(static_dataset):
-            question = json.loads(line)
-            if question_is_valid(question):
-                continue
-            else:
-                valid_ans_ids = [
-                    ans["id"] for ans in question["good_comments"]
-                    if answer_is_valid(ans)
-                ]
-                valid_anss_per_question.append({
-                    "q_id": question["id"],
-                    "created_utc": question["created_utc"],
-                    "split": question["split"],
-                    "valid_ans_ids": valid_ans_ids
-                })
+    print("Sorting questions by date")
+    for question in tqdm(iter_advice(static_dataset_path, fields=['id', 'created_utc', 'split', 'selftext',
+                                                                  'good_comments'], comment_fields=['id', 'body'])):
+        if question_is_valid(question):
+            continue
+        else:
+            valid_ans_ids = [
+                ans["id"] for ans in question["good_comments"]
+                if answer_is_valid(ans)
+            ]
+            valid_anss_per_question.append({
+                "q_id": question["id"],
+                "created_utc": question["created_utc"],
+                "split": question["split"],
+                "valid_ans_ids": valid_ans_ids
+            })
     valid_anss_per_question = sorted(
         valid_anss_per_question, key=lambda x: x["created_utc"], reverse=True
     )
@@ -184,8 +316,7 @@ if __name__ == '__main__':
                 len(valid_anss["valid_ans_ids"])
             )
     # Tokenize answers and write split dataset
-    with open(static_dataset_path, "r") as static_dataset, \
-        open(OUTPUT_TSV_PATH.format(split="train"), "w") as train_tsv,\
+    with open(OUTPUT_TSV_PATH.format(split="train"), "w") as train_tsv,\
         open(OUTPUT_TSV_PATH.format(split="val"), "w") as val_tsv,\
         open(OUTPUT_TSV_PATH.format(split="test"), "w") as test_tsv:
         split_to_file = {
@@ -194,8 +325,9 @@ if __name__ == '__main__':
             "test": test_tsv
         }
         print("Writing file for each split")
-        for line in tqdm(static_dataset):
-            question = json.loads(line)
+        for question in tqdm(iter_advice(static_dataset_path,
+                                         fields=['subreddit', 'created_utc', 'title', 'selftext', 'split',
+                                                 'good_comments'], comment_fields=['id', 'body'])):
             for answer in question["good_comments"]:
                 if answer["id"] in anss_in_dataset:
                     write_answer(
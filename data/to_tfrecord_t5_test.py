@@ -0,0 +1,80 @@
+"""Tests for data.to_tfrecord_t5."""
+
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+from absl.testing import absltest
+
+import data.to_tfrecord_t5 as to_tfrecord_t5
+
+
+class UnidecodeCacheTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.vocab_fn = os.path.join(self.tmp_dir.name, 'sentencepiece.model')
+        with open(self.vocab_fn, 'wb') as f:
+            f.write(b'vocab v1')
+        self.old = {name: getattr(to_tfrecord_t5, name) for name in
+                    ['SENTENCEPIECE_MODEL_FILE', 'CACHE_DIR', '_unidecode_version', '_gcs_object_version']}
+        to_tfrecord_t5.SENTENCEPIECE_MODEL_FILE = self.vocab_fn
+        to_tfrecord_t5.CACHE_DIR = self.tmp_dir.name
+        to_tfrecord_t5._unidecode_version = lambda: '1.0'
+        to_tfrecord_t5._vocab_fingerprint.cache_clear()
+
+    def tearDown(self):
+        for name, value in self.old.items():
+            setattr(to_tfrecord_t5, name, value)
+        to_tfrecord_t5._vocab_fingerprint.cache_clear()
+        self.tmp_dir.cleanup()
+
+    def _cache_fn(self):
+        to_tfrecord_t5._vocab_fingerprint.cache_clear()
+        return to_tfrecord_t5._unidecode_cache_fn()
+
+    def test_import_is_lazy(self):
+        code = ('import data.to_tfrecord_t5 as t; '
+                'print(t.get_encoder.cache_info().currsize, t._get_unidecode_tables.cache_info().currsize)')
+        repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        out = subprocess.run([sys.executable, '-c', code], cwd=repo_root, check=True, stdout=subprocess.PIPE)
+        self.assertEqual(out.stdout.decode('utf-8').split(), ['0', '0'])
+
+    def test_cache_key(self):
+        cache_fn = self._cache_fn()
+        self.assertEqual(os.path.dirname(cache_fn), self.tmp_dir.name)
+        self.assertEqual(self._cache_fn(), cache_fn)
+
+        with open(self.vocab_fn, 'wb') as f:
+            f.write(b'vocab v2')
+        new_vocab_fn = self._cache_fn()
+        self.assertNotEqual(new_vocab_fn, cache_fn)
+
+        to_tfrecord_t5._unidecode_version = lambda: '1.1'
+        self.assertNotIn(self._cache_fn(), [cache_fn, new_vocab_fn])
+
+    def test_cache_key_gcs(self):
+        to_tfrecord_t5.SENTENCEPIECE_MODEL_FILE = 'gs://bucket/sentencepiece.model'
+        to_tfrecord_t5._gcs_object_version = lambda fn: '1-etag1'
+        cache_fn = self._cache_fn()
+        self.assertEqual(self._cache_fn(), cache_fn)
+        # Overwritten in place
+        to_tfrecord_t5._gcs_object_version = lambda fn: '2-etag2'
+        self.assertNotEqual(self._cache_fn(), cache_fn)
+
+    def test_cached_table(self):
+        tables = ({ord('\t'): ' '}, ['a', 'b'])
+        to_tfrecord_t5._get_unidecode_tables.cache_clear()
+        try:
+            with open(self._cache_fn(), 'wb') as f:
+                pickle.dump(tables, f)
+            # Doesn't need the vocab, or to build anything
+            self.assertEqual(to_tfrecord_t5._get_unidecode_tables(), tables)
+        finally:
+            to_tfrecord_t5._get_unidecode_tables.cache_clear()
+
+
+if __name__ == '__main__':
+    absltest.main()
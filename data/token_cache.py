@@ -0,0 +1,193 @@
+"""
+On-disk cache of tokenized text, shared by all the data prep scripts (and processes).
+
+Entries are keyed by a hash of the tokenizer's identity + the text, so the BPE encoder and the T5 sentencepiece
+vocab can share one file, and editing the vocab just means we stop hitting the old entries (they'll get evicted
+eventually). It's a sqlite database in WAL mode, so any number of processes can read while one writes.
+
+It's off unless you ask for it, like TURINGADVICE_TOKEN_CACHE=~/.cache/turingadvice/tokens.sqlite
+"""
+import array
+import hashlib
+import multiprocessing.util
+import os
+import sqlite3
+import time
+
+
+class TokenCache(object):
+    def __init__(self, fn, max_bytes=4 * 1024 ** 3, min_chars=64, flush_every=256):
+        """
+        :param fn: where the sqlite database lives
+        :param max_bytes: Once the cached tokens take up more than this, we evict the least recently used ones
+        :param min_chars: Don't bother caching texts shorter than this, it's faster to just tokenize them
+        :param flush_every: write out new entries once we have this many. Until then they're kept in memory, so
+                            we only hold the write lock briefly
+        """
+        self.fn = fn
+        self.max_bytes = max_bytes
+        self.min_chars = min_chars
+        self.flush_every = flush_every
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'hit_rate': 0.0}
+        self._conn = None
+        self._pid = None
+        self._pending = {}
+        self._touched = []
+        self._size_estimate = 0
+
+    def __getstate__(self):
+        # Connections can't be pickled (or shared between processes), each process opens its own
+        state = dict(self.__dict__)
+        state.update({'_conn': None, '_pid': None, '_pending': {}, '_touched': [], '_size_estimate': 0})
+        return state
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            dirname = os.path.dirname(self.fn)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._conn = sqlite3.connect(self.fn, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                               '(key BLOB PRIMARY KEY, tokens BLOB, last_used REAL) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tokens_last_used ON tokens (last_used)')
+            self._create_size_table()
+            self._conn.commit()
+            # Runs at exit in multiprocessing workers too, unlike atexit (they leave with os._exit)
+            multiprocessing.util.Finalize(None, self.close, exitpriority=10)
+            self._pid = os.getpid()
+            self._pending = {}
+            self._touched = []
+            self._size_estimate = self.size_bytes()
+        return self._conn
+
+    def _create_size_table(self):
+        """ Keeps a running total of the bytes of tokens, so size_bytes doesn't need to scan the whole table"""
+        # So the REPLACE in INSERT OR REPLACE counts as a delete
+        self._conn.execute('PRAGMA recursive_triggers=ON')
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'size'").fetchone() is not None:
+            return
+        self._conn.execute('BEGIN IMMEDIATE')
+        # Someone else might have made it while we waited for the lock
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'size'").fetchone() is None:
+            self._conn.execute('CREATE TABLE size (bytes INTEGER)')
+            self._conn.execute('INSERT INTO size SELECT COALESCE(SUM(LENGTH(tokens)), 0) FROM tokens')
+            self._conn.execute('CREATE TRIGGER size_insert AFTER INSERT ON tokens '
+                               'BEGIN UPDATE size SET bytes = bytes + LENGTH(new.tokens); END')
+            self._conn.execute('CREATE TRIGGER size_delete AFTER DELETE ON tokens '
+                               'BEGIN UPDATE size SET bytes = bytes - LENGTH(old.tokens); END')
+            self._conn.execute('CREATE TRIGGER size_update AFTER UPDATE OF tokens ON tokens '
+                               'BEGIN UPDATE size SET bytes = bytes + LENGTH(new.tokens) - LENGTH(old.tokens); END')
+        self._conn.commit()
+
+    @staticmethod
+    def _key(text, tokenizer_id):
+        return hashlib.sha1('{}\0{}'.format(tokenizer_id, text).encode('utf-8', errors='surrogatepass')).digest()
+
+    def _update_hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        self.stats['hit_rate'] = self.stats['hits'] / total if total else 0.0
+
+    def get(self, text, tokenizer_id):
+        """ :return: the cached tokens, or None"""
+        key = self._key(text, tokenizer_id)
+        if key in self._pending:
+            row = (self._pending[key],)
+        else:
+            row = self._connect().execute('SELECT tokens FROM tokens WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            self._update_hit_rate()
+            return None
+        self.stats['hits'] += 1
+        self._update_hit_rate()
+        # Batch up the LRU bookkeeping, rather than writing on every read
+        self._touched.append(key)
+        if len(self._touched) >= self.flush_every:
+            self.flush()
+        return array.array('i', row[0]).tolist()
+
+    def put(self, text, tokenizer_id, tokens):
+        self._connect()
+        data = array.array('i', tokens).tobytes()
+        self._pending[self._key(text, tokenizer_id)] = data
+        self._size_estimate += len(data)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def encode(self, text, encode_fn, tokenizer_id):
+        """
+        Looks up text in the cache, tokenizing it with encode_fn (and caching that) if it's not there.
+        :param tokenizer_id: Identifies whatever encode_fn is, like a hash of the vocab
+        """
+        if len(text) < self.min_chars:
+            return encode_fn(text)
+        tokens = self.get(text, tokenizer_id)
+        if tokens is None:
+            tokens = encode_fn(text)
+            self.put(text, tokenizer_id, tokens)
+        return tokens
+
+    def flush(self):
+        """ Writes new entries + last-used times, then evicts things if we're over max_bytes"""
+        if self._conn is None or self._pid != os.getpid():
+            return
+        now = time.time()
+        with self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                                   [(k, v, now) for k, v in self._pending.items()])
+            self._conn.executemany('UPDATE tokens SET last_used = ? WHERE key = ?', [(now, k) for k in self._touched])
+        self._pending = {}
+        self._touched = []
+
+        # Other processes might have added things too, so check for real before evicting
+        if self._size_estimate > self.max_bytes:
+            self._size_estimate = self.size_bytes()
+            if self._size_estimate > self.max_bytes:
+                self._evict(int(self.max_bytes * 0.9))
+
+    def size_bytes(self):
+        """ How many bytes of tokens are in the database (not counting what we haven't flushed)"""
+        return self._connect().execute('SELECT bytes FROM size').fetchone()[0]
+
+    def _evict(self, target_bytes):
+        """ Drops the least recently used entries until the tokens fit in target_bytes"""
+        conn = self._connect()
+        to_free = self.size_bytes() - target_bytes
+        keys = []
+        for key, size in conn.execute('SELECT key, LENGTH(tokens) FROM tokens ORDER BY last_used'):
+            if to_free <= 0:
+                break
+            keys.append((key,))
+            to_free -= size
+        conn.executemany('DELETE FROM tokens WHERE key = ?', keys)
+        conn.commit()
+        self.stats['evictions'] += len(keys)
+        self._size_estimate = self.size_bytes()
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self.flush()
+            self._conn.close()
+        self._conn = None
+
+
+_TOKEN_CACHES = {}
+
+
+def get_token_cache():
+    """
+    :return: The shared TokenCache at $TURINGADVICE_TOKEN_CACHE, or None if that isn't set.
+             $TURINGADVICE_TOKEN_CACHE_MB caps the size (default 4096).
+    """
+    fn = os.path.expanduser(os.environ.get('TURINGADVICE_TOKEN_CACHE', ''))
+    if not fn:
+        return None
+    if fn not in _TOKEN_CACHES:
+        max_mb = int(os.environ.get('TURINGADVICE_TOKEN_CACHE_MB', 4096))
+        _TOKEN_CACHES[fn] = TokenCache(fn, max_bytes=max_mb * 1024 ** 2)
+    return _TOKEN_CACHES[fn]
@@ -470,7 +470,9 @@ class GroverModel(object):
         else:
             batch_size_, num_layers_, two_, num_heads_, self.cache_length, features_ = get_shape_list(
                 cache, expected_rank=6)
-            assert batch_size_ == self.batch_size
+            if isinstance(batch_size_, int) and isinstance(self.batch_size, int):
+                # Can't check this if the batch size is only known at runtime
+                assert batch_size_ == self.batch_size
             assert num_layers_ == config.num_hidden_layers
             assert two_ == 2
             assert num_heads_ == config.num_attention_heads
@@ -817,12 +819,14 @@ def sample_seq2seq(news_config: GroverConfig, initial_context, eos_token, ignore
 
     :param news_config: Configuration used to construct the model
     :param initial_context: [batch_size, seq_length] that we'll start generating with.
-                            Invalid entries are padded.
+                            Invalid entries are padded. The batch size can be None.
     :param eos_token: Stop generating if you see this (tf scalar)
     :param ignore_ids: NEVER GENERATE THESE [vocab_size]
     :return:
     """
     batch_size, ctxb_end = get_shape_list(initial_context, expected_rank=2)
+    # None if the batch size is only known at runtime, for the while loop shapes
+    static_batch_size = initial_context.shape.as_list()[0]
     # This just says 'ignore the pad character'
     if ignore_ids is None:
         ignore_ids = tf.constant([x == 0 for x in range(news_config.vocab_size)], dtype=tf.bool)
@@ -892,12 +896,12 @@ def sample_seq2seq(news_config: GroverConfig, initial_context, eos_token, ignore
         tokens, cache, probs = tf.while_loop(
             cond=cond, body=body, maximum_iterations=max_len - get_shape_list(ctx)[1],
             loop_vars=[ctx, cache, probs],
-            shape_invariants=[tf.TensorShape([batch_size, None]),
+            shape_invariants=[tf.TensorShape([static_batch_size, None]),
                               tf.TensorShape(
-                                  [batch_size, news_config.num_hidden_layers, 2,
+                                  [static_batch_size, news_config.num_hidden_layers, 2,
                                    news_config.num_attention_heads,
                                    None, news_config.hidden_size // news_config.num_attention_heads]),
-                              tf.TensorShape([batch_size, None]),
+                              tf.TensorShape([static_batch_size, None]),
                               ],
             back_prop=False,
         )
@@ -8,7 +8,10 @@ parser = argparse.ArgumentParser()
 parser.add_argument('-gpu', type=int, default=0)
 parser.add_argument('-size', type=str, default="mega")
 parser.add_argument('-tag', type=str, default="")
-parser.add_argument('-batch_size', type=int, default=1)
+parser.add_argument('-batch_size', type=int, default=1, help='Max # of rows per batch')
+parser.add_argument('-max_batch_tokens', type=int, default=None,
+                    help='Max # of context tokens per batch, including padding. Defaults to batch_size * 1280')
+parser.add_argument('-bpe_cache_size', type=int, default=100000, help='Max # of pretokens kept in the BPE cache')
 
 args = parser.parse_args()
 GPUID = args.gpu
@@ -24,14 +27,14 @@ import sys
 
 sys.path.append('../../')
 from grover.lm.modeling import GroverConfig, sample_seq2seq
-from data.encoder import get_encoder, extract_generated_target, _tokenize_reddit_post_pieces, trim_paragraphs
-from data.tfrecord_utils import batch_index_iterator
+from data.encoder import get_encoder, extract_generated_target, _tokenize_reddit_post_pieces, \
+    trim_paragraphs_to_length
+from data.tfrecord_utils import token_budget_batches, padding_stats
 import logging
 from datetime import datetime
 import click
 from gevent.pywsgi import WSGIServer
 import numpy as np
-import pandas as pd
 
 app = flask.Flask(__name__, template_folder='.')
 CORS(app, resources={r'/api/*': {'origins': '*'}})
@@ -39,9 +42,10 @@ CORS(app, resources={r'/api/*': {'origins': '*'}})
 logger = logging.getLogger(__name__)
 
 # SETUP
-encoder = get_encoder()
+encoder = get_encoder(cache_size=args.bpe_cache_size)
 news_config = GroverConfig.from_json_file(f'../lm/configs/{SIZE}.json')
 batch_size = args.batch_size
+max_batch_tokens = args.max_batch_tokens if args.max_batch_tokens is not None else batch_size * 1280
 top_p = 0.94
 
 def _prepare_instance(instance, date, target='advice'):
@@ -60,10 +64,13 @@ def _prepare_instance(instance, date, target='advice'):
                                           selftext=instance['selftext'] if target in ('selftext', 'advice') else '',
                                           max_date_length=5, max_subreddit_length=5, max_title_length=80,
                                           max_selftext_length=6000)
-    # If too long, keep trimming the selftext
-    while sum([len(x) for x in pieces]) > 1280:
-        instance['selftext'] = trim_paragraphs(instance['selftext'], num2del=1)
-        pieces['selftext'] = [encoder.begin_article] + encoder.encode(instance['selftext']) + [encoder.end_article]
+    # If too long, trim the selftext to whatever budget is left over
+    total_len = sum([len(x) for x in pieces.values()])
+    if total_len > 1280:
+        selftext_budget = 1280 - (total_len - len(pieces['selftext']) + 2)
+        instance['selftext'], selftext_tokens = trim_paragraphs_to_length(instance['selftext'], encoder.encode,
+                                                                          max_len=selftext_budget)
+        pieces['selftext'] = [encoder.begin_article] + selftext_tokens + [encoder.end_article]
 
     # OK NOW FORMAT CONTEXT
     instance['advice'] = ''
@@ -112,7 +119,8 @@ def _prepare_instance(instance, date, target='advice'):
 
 
 with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph()) as sess:
-    initial_context = tf.placeholder(tf.int32, [batch_size, None])
+    # The number of rows changes from batch to batch, see token_budget_batches
+    initial_context = tf.placeholder(tf.int32, [None, None])
     eos_token = tf.placeholder(tf.int32, [])
     ignore_ids = tf.placeholder(tf.bool, [news_config.vocab_size])
 
@@ -132,6 +140,12 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
         return flask.render_template('index.html', model_details="The model used is Grover {} with a max sequence length of 1536 tokens. It was trained on 600k reddit Q+A's for 20 epochs. The perplexity is {:.3f} on the val set.".format(args.size, {'mega': 12.56, 'large': 14.733, 'base': 17.565}[args.size]))
 
 
+    @app.route('/api/cache_stats', methods=['GET'])
+    def api_cache_stats():
+        """Hit / miss / eviction counts for the BPE cache, useful for sizing -bpe_cache_size."""
+        return flask.jsonify(encoder.cache.stats), 200
+
+
     @app.route('/api/ask', methods=['POST'])
     def api_ask():
         """Serve a prediction for a single instance."""
@@ -153,7 +167,7 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
         ignore_ids_np = np.array(encoder.special_tokens_onehot)
         ignore_ids_np[eos_token_val] = 0
 
-        out = sess.run(tokens, feed_dict={initial_context: np.stack([context_formatted]*batch_size),
+        out = sess.run(tokens, feed_dict={initial_context: np.array([context_formatted], dtype=np.int32),
                                           eos_token: eos_token_val,
                                           ignore_ids: ignore_ids_np})
 
@@ -198,35 +212,28 @@ with tf.Session(config=tf.ConfigProto(allow_soft_placement=True), graph=tf.Graph
         ignore_ids_np = np.array(encoder.special_tokens_onehot)
         ignore_ids_np[eos_token_val] = 0
 
-        things_to_process = pd.DataFrame(instances)
-        things_to_process['ind'] = np.arange(len(instances))
-        things_to_process['len'] = things_to_process['context_formatted'].apply(lambda x: len(x))
-        things_to_process['out'] = ''
-        things_to_process.sort_values(by='len', ascending=False, inplace=True)
-
-        for b_start, b_end in batch_index_iterator(things_to_process.shape[0], batch_size=args.batch_size,
-                                                   skip_end=False):
-            these_ctx = things_to_process['context_formatted'].iloc[b_start:b_end].tolist()
+        contexts = [x.pop('context_formatted') for x in instances]
+        lengths = [len(x) for x in contexts]
+        outs = [''] * len(instances)
 
-            ctx_array = np.zeros((args.batch_size, max([len(x) for x in these_ctx])), dtype=np.int32) + encoder.padding
-            for i, ctx_i in enumerate(these_ctx):
-                ctx_array[i, :len(ctx_i)] = ctx_i
+        batches = list(token_budget_batches(lengths, max_tokens=max_batch_tokens, max_rows=batch_size))
+        print("Batching {} instances: {}".format(len(instances), padding_stats(lengths, batches)), flush=True)
+        for batch in batches:
+            ctx_array = np.zeros((len(batch), max([lengths[i] for i in batch])), dtype=np.int32) + encoder.padding
+            for row, i in enumerate(batch):
+                ctx_array[row, :lengths[i]] = contexts[i]
 
             out = sess.run(tokens, feed_dict={initial_context: ctx_array,
                                               eos_token: eos_token_val,
                                               ignore_ids: ignore_ids_np})
-            for i, out_i in enumerate(out[:(b_end-b_start)]):
-                # item = things_to_process.iloc[b_start + i]
-                out_decoded = extract_generated_target(
+            for i, out_i in zip(batch, out):
+                outs[i] = extract_generated_target(
                     output_tokens=out_i, encoder=encoder,
                     target={'subreddit': 'domain', 'date': 'date',
                             'title': 'title', 'selftext': 'article', 'advice': 'summary'}[target])['extraction'].strip()
-                things_to_process.at[things_to_process.iloc[b_start + i].name, 'out'] = out_decoded
 
-        # Sort back
-        things_to_process.sort_values(by='ind', ascending=True, inplace=True)
         return flask.jsonify({
-            'gens': things_to_process['out'].tolist(),
+            'gens': outs,
         }), 200
 
 
@@ -9,6 +9,7 @@ from datetime import datetime
 from contextlib import ExitStack
 
 from data.assertions import question_is_valid, answer_is_valid, answer_pair_is_valid
+from data.advice_store import iter_advice
 from data.to_tfrecord_t5 import encoder, _trim_to_desired_length, _fix_reddit_text
 from reward.comparative.data import SELFTEXT_DESIRED_LEN, LOCAL_TSV_PATH, SPLITS
 
@@ -23,7 +24,7 @@ def _define_flags():
     flags.DEFINE_string(
         name="jsonl_path",
         default="data/redditadvice2019.jsonl",
-        help="Dataset generated by create_redditadvice_2019.py"
+        help="Dataset generated by create_redditadvice_2019.py, or a store made from it with data/advice_store.py"
     )
     flags.DEFINE_integer(
         name="max_time_diff",
@@ -107,7 +108,7 @@ if __name__ == "__main__":
         os.makedirs(out_dir, exist_ok=False)
     n_questions = {dataset_id: 0 for dataset_id in dataset_ids}
     n_ans_pairs = {dataset_id: 0 for dataset_id in dataset_ids}
-    with open(FLAGS.jsonl_path, "r") as jsonl_file, ExitStack() as stack:
+    with ExitStack() as stack:
         # Open all dataset files at the same time
         dataset_files = {
             dataset_id: {
@@ -120,8 +121,12 @@ if __name__ == "__main__":
             for dataset_id in dataset_ids
         } # dataset_files["id"]["train"] := train split file of dataset "id"
         # Randomly place the questions into the n datasets
-        for line in tqdm(jsonl_file):
-            question = json.loads(line)
+        questions = iter_advice(
+            FLAGS.jsonl_path,
+            fields=["subreddit", "created_utc", "title", "selftext", "split", "good_comments"],
+            comment_fields=["body", "score", "created_utc"]
+        )
+        for question in tqdm(questions):
             question_counted = False
             if question_is_valid(question):
                 # Which dataset will we store this question in?
@@ -13,6 +13,11 @@ def _define_flags():
         default=None,
         help="Id of the dataset generated by jsonl_to_tsvs.py"
     )
+    flags.DEFINE_list(
+        name="splits",
+        default=SPLITS,
+        help="Which splits to convert"
+    )
     return flags.FLAGS
 
 def _serialize_tokens(*values, colnames):
@@ -42,8 +47,9 @@ if __name__ == "__main__":
     assert (not DATASET_IS_PACKED), "Packed dataset not supported"
     FLAGS = _define_flags()
     FLAGS(sys.argv)
-    for split in SPLITS:
+    for split in FLAGS.splits:
         shuffled_dataset = get_dataset(
+            bucket_name=None,
             dataset_id=FLAGS.dataset_id,
             split=split,
             from_local=True,
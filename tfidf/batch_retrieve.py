@@ -0,0 +1,48 @@
+"""
+Runs the TF-IDF retriever over a jsonl file of questions, without the server. Each line needs title and selftext,
+and gets written back out with a 'retrieved' field: the k best matches, best first (see describe_match).
+
+python batch_retrieve.py -in questions.jsonl -out retrieved.jsonl -k 10
+"""
+import argparse
+import json
+import sys
+
+from tqdm import tqdm
+
+sys.path.append('../')
+from tfidf.retrieval import load_or_build_index, tokenize, question_text, describe_match
+
+parser = argparse.ArgumentParser(description='Retrieve advice for a jsonl file of questions')
+parser.add_argument('-in', dest='in_fn', type=str, required=True, help='Questions, with title + selftext fields')
+parser.add_argument('-out', dest='out_fn', type=str, required=True)
+parser.add_argument('-advice', type=str, default='../data/redditadvice2019.jsonl',
+                    help='redditadvice2019.jsonl, or a store made from it with data/advice_store.py')
+parser.add_argument('-cache_dir', type=str, default='.', help='Where the index is cached (same as run_server.py)')
+parser.add_argument('-k', type=int, default=10, help='How many matches to return for each question')
+parser.add_argument('-batch_size', type=int, default=256, help='Questions to tokenize + score at once')
+
+
+def _batches(f, batch_size):
+    batch = []
+    for l in f:
+        batch.append(json.loads(l))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    from allennlp.common.util import get_spacy_model
+    spacy_model = get_spacy_model('en_core_web_sm', pos_tags=False, parse=False, ner=False)
+    index, responses = load_or_build_index(args.advice, spacy_model, cache_dir=args.cache_dir)
+
+    with open(args.in_fn, 'r') as f_in, open(args.out_fn, 'w') as f_out:
+        for batch in tqdm(_batches(f_in, args.batch_size)):
+            results = index.top_k_batch(tokenize(spacy_model, [question_text(x) for x in batch]), k=args.k)
+            for item, top in zip(batch, results):
+                item['retrieved'] = [describe_match(responses[row], score) for row, score in top]
+                f_out.write(json.dumps(item) + '\n')
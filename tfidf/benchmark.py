@@ -0,0 +1,196 @@
+"""
+Latency benchmarks for the TF-IDF retriever. This times the search, not spaCy. Run from the repo root like
+
+python -m tfidf.benchmark latency
+python -m tfidf.benchmark latency -cache_dir tfidf/   # on the real index (tfidf/tfidf_index)
+python -m tfidf.benchmark startup
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy.sparse
+
+sys.path.append('../')
+from tfidf.retrieval import build_vocab, tfidf_matrix, TfidfIndex, load_or_build_index
+
+
+def _percentiles(fn, queries):
+    """ :return: median and p99 latency in ms"""
+    times = []
+    for q in queries:
+        start = time.perf_counter()
+        fn(q)
+        times.append(1000 * (time.perf_counter() - start))
+    return np.percentile(times, 50), np.percentile(times, 99)
+
+
+def synthetic_corpus(num_docs, vocab_size, num_topics=500, seed=123456):
+    """
+    Roughly the shape of reddit posts: each document is half common (Zipfian) words and half words from its topic,
+    which has its own Zipfian distribution over a shuffled vocab
+    """
+    rng = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(vocab_size)]
+    cum_weights = np.cumsum([1.0 / (i + 1) for i in range(vocab_size)]).tolist()
+    topics = [rng.sample(words, len(words)) for _ in range(num_topics)]
+    docs = []
+    for _ in range(num_docs):
+        length = rng.randint(20, 400)
+        doc = rng.choices(words, cum_weights=cum_weights, k=length // 2)
+        doc += rng.choices(rng.choice(topics), cum_weights=cum_weights, k=length - length // 2)
+        rng.shuffle(doc)
+        docs.append(doc)
+    return docs
+
+
+def load_index(args):
+    """ :return: (unnormalized TF-IDF matrix, word_to_idx, idf, queries)"""
+    rng = random.Random(args.seed)
+    if args.cache_dir is None:
+        docs = synthetic_corpus(args.num_docs + args.num_queries, args.vocab_size, seed=args.seed)
+        docs, queries = docs[:args.num_docs], docs[args.num_docs:]
+        idx_to_word, word_to_idx, idf = build_vocab(docs)
+        return tfidf_matrix(docs, word_to_idx, idf), word_to_idx, idf, queries
+
+    index, _ = load_or_build_index(None, None, cache_dir=args.cache_dir)
+    matrix = scipy.sparse.vstack([segment.index.matrix for segment in index.segments], format='csr')
+    word_to_idx, idf = index.word_to_idx, index.idf
+    # Queries are the words of random posts
+    idx_to_word = [w for w, i in sorted(word_to_idx.items(), key=lambda x: x[1])]
+    queries = []
+    for row in rng.sample(range(matrix.shape[0]), args.num_queries):
+        cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+        queries.append([idx_to_word[i] for i in cols])
+    return matrix, word_to_idx, idf, queries
+
+
+def bench_latency(args):
+    """ The old float16 COO + dense query + random noise path vs TfidfIndex, brute force and pruned"""
+    matrix, word_to_idx, idf, queries = load_index(args)
+    print("{} docs, vocab {}, {} nonzeros, {} queries".format(matrix.shape[0], matrix.shape[1], matrix.nnz,
+                                                              len(queries)), flush=True)
+    try:
+        old_dtype = np.float16
+        old_matrix = scipy.sparse.coo_matrix(matrix, dtype=old_dtype)
+    except ValueError:
+        # Newer scipy won't do float16 at all
+        old_dtype = np.float32
+        old_matrix = scipy.sparse.coo_matrix(matrix, dtype=old_dtype)
+    old_denom = np.sqrt(old_matrix.power(2).dot(np.ones(old_matrix.shape[1], dtype=old_dtype)))
+
+    def _old(tokens):
+        item_vec = np.zeros(len(word_to_idx), dtype=old_dtype)
+        for tok in tokens:
+            item_vec[word_to_idx.get(tok, 0)] += idf[word_to_idx.get(tok, 0)] / len(tokens)
+        sim = old_matrix.dot(item_vec) + (1e-5) * np.random.rand(old_matrix.shape[0])
+        sim /= old_denom
+        return int(np.argmax(sim))
+
+    start = time.perf_counter()
+    index = TfidfIndex(matrix, word_to_idx, idf)
+    print("Built the index in {:.1f}s".format(time.perf_counter() - start), flush=True)
+    if args.query_len is not None:
+        queries = [q[:args.query_len] for q in queries]
+    results = {'old ({})'.format(np.dtype(old_dtype).name): _percentiles(_old, queries),
+               'brute force': _percentiles(lambda q: int(np.argmax(index.scores(q))), queries),
+               'pruned': _percentiles(index.best_match, queries)}
+    for name, (p50, p99) in results.items():
+        print("{:>20s}: {:8.2f}ms median, {:8.2f}ms p99".format(name, p50, p99), flush=True)
+    agree = np.mean([_old(q) == index.best_match(q)[0] for q in queries[:50]])
+    print("Same best match as the old path for {:.0%} of queries".format(agree), flush=True)
+    exact = np.mean([int(np.argmax(index.scores(q))) == index.best_match(q)[0] for q in queries])
+    print("Same best match as brute force for {:.0%} of queries".format(exact), flush=True)
+
+
+def _rss_mb():
+    with open('/proc/self/status', 'r') as f:
+        for l in f:
+            if l.startswith('VmRSS:'):
+                return int(l.split()[1]) / 1024
+
+
+def _startup_child(args):
+    """ Runs in a fresh process, so the memory numbers don't include anything else"""
+    start_rss = _rss_mb()
+    start = time.perf_counter()
+    if args.child == 'npz':
+        # What run_server.py used to do: load the matrix + vocab, then normalize and build the postings
+        matrix = scipy.sparse.load_npz(os.path.join(args.cache_dir, 'counts.npz'))
+        idf = np.load(os.path.join(args.cache_dir, 'idf.npy'))
+        with open(os.path.join(args.cache_dir, 'word_to_idx.json'), 'r') as f:
+            word_to_idx = json.load(f)
+        index = TfidfIndex(matrix, word_to_idx, idf)
+    else:
+        index, responses = load_or_build_index(None, None, cache_dir=args.cache_dir)
+    elapsed = time.perf_counter() - start
+    query = list(index.word_to_idx)[1:50]
+    index.best_match(query)
+    print(json.dumps({'seconds': elapsed, 'rss_mb': _rss_mb() - start_rss}), flush=True)
+
+
+def bench_startup(args):
+    """ How long it takes to load the index, and how much memory it takes, memmapped or not"""
+    tmp_dir = None
+    if args.cache_dir is None:
+        matrix, word_to_idx, idf, _ = load_index(args)
+        tmp_dir = tempfile.TemporaryDirectory()
+        args.cache_dir = tmp_dir.name
+        scipy.sparse.save_npz(os.path.join(args.cache_dir, 'counts.npz'), matrix)
+        np.save(os.path.join(args.cache_dir, 'idf.npy'), idf)
+        with open(os.path.join(args.cache_dir, 'word_to_idx.json'), 'w') as f:
+            json.dump(word_to_idx, f)
+        # The responses, normally from redditadvice2019.jsonl
+        advice_fn = os.path.join(args.cache_dir, 'advice.jsonl')
+        with open(advice_fn, 'w') as f:
+            for i in range(matrix.shape[0]):
+                f.write(json.dumps({'subreddit': 'Advice', 'id': 'p{}'.format(i), 'split': 'train',
+                                    'good_comments': [{'id': 'c{}'.format(i), 'body': 'Advice! ' * 100}]}) + '\n')
+        load_or_build_index(advice_fn, None, cache_dir=args.cache_dir)
+
+    for child in ['npz', 'memmap']:
+        out = subprocess.run([sys.executable, '-m', 'tfidf.benchmark', 'startup', '-cache_dir', args.cache_dir,
+                              '-child', child], stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+        result = json.loads(out.strip().splitlines()[-1])
+        print("{:>10s}: {:6.2f}s to load, {:8.1f}MB resident".format(child, result['seconds'], result['rss_mb']),
+              flush=True)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TF-IDF retrieval benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    latency_parser = subparsers.add_parser('latency', help='Per-query search latency')
+    latency_parser.add_argument('-cache_dir', type=str, default=None,
+                                help='Directory with counts.npz etc from run_server.py. Otherwise synthetic data')
+    latency_parser.add_argument('-num_docs', type=int, default=50000)
+    latency_parser.add_argument('-vocab_size', type=int, default=30000)
+    latency_parser.add_argument('-num_queries', type=int, default=200)
+    latency_parser.add_argument('-query_len', type=int, default=None, help='Cut the queries to this many words')
+    latency_parser.add_argument('-seed', type=int, default=123456)
+    latency_parser.set_defaults(fn=bench_latency)
+
+    startup_parser = subparsers.add_parser('startup', help='Index load time + memory')
+    startup_parser.add_argument('-cache_dir', type=str, default=None,
+                                help='Directory with tfidf_index/ and counts.npz etc. Otherwise synthetic data')
+    startup_parser.add_argument('-num_docs', type=int, default=50000)
+    startup_parser.add_argument('-vocab_size', type=int, default=30000)
+    startup_parser.add_argument('-num_queries', type=int, default=0)
+    startup_parser.add_argument('-seed', type=int, default=123456)
+    startup_parser.add_argument('-child', type=str, default=None, choices=['npz', 'memmap'], help=argparse.SUPPRESS)
+    startup_parser.set_defaults(fn=bench_startup)
+
+    args = parser.parse_args()
+    if getattr(args, 'child', None) is not None:
+        _startup_child(args)
+    else:
+        args.fn(args)
@@ -0,0 +1,95 @@
+"""
+Pre-fork serving: bind the socket and load everything once, then fork worker processes that all accept on it.
+
+The index and responses are memmapped (see retrieval.py), so the workers share the same pages of the page cache
+instead of each holding a copy. Everything else loaded before the fork (the vocab dict, spaCy) is shared
+copy-on-write.
+"""
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+_STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+
+def bind_listener(address, backlog=128):
+    """ :return: a listening socket on (host, port), for the workers to accept on"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(backlog)
+    return listener
+
+
+class PreforkServer(object):
+    def __init__(self, worker_fn, num_workers, min_restart_interval=1.0):
+        """
+        :param worker_fn: runs in each worker, and should serve requests forever. Open anything that can't be
+                          shared between processes (gevent's hub, DB connections...) in here, not before.
+        :param num_workers: how many worker processes to keep running
+        :param min_restart_interval: If a worker dies, wait at least this long (seconds) before replacing it, so a
+                                     worker that crashes on startup doesn't turn into a fork bomb
+        """
+        self.worker_fn = worker_fn
+        self.num_workers = num_workers
+        self.min_restart_interval = min_restart_interval
+        self.workers = {}
+        self._stopping = False
+
+    def _spawn(self, worker_id):
+        # Hold off SIGTERM until we've written down the pid, otherwise _stop() could miss this worker
+        signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            for signum in _STOP_SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+            exit_code = 0
+            try:
+                self.worker_fn()
+            except BaseException as e:
+                print("Worker {} died: {}".format(worker_id, repr(e)), file=sys.stderr, flush=True)
+                exit_code = 1
+            finally:
+                # Skip the parent's atexit handlers etc
+                os._exit(exit_code)
+        self.workers[pid] = (worker_id, time.time())
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        """ Starts the workers, replaces them if they die, and stops them all on SIGTERM / SIGINT"""
+        # Anything that's already loaded won't get garbage collected, so the GC doesn't need to touch (and copy) it
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+        for signum in _STOP_SIGNALS:
+            signal.signal(signum, self._stop)
+        for worker_id in range(self.num_workers):
+            self._spawn(worker_id)
+        print("Started {} workers: {}".format(self.num_workers, sorted(self.workers)), flush=True)
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.workers:
+                continue
+            worker_id, started = self.workers.pop(pid)
+            if self._stopping:
+                continue
+            print("Worker {} (pid {}) exited with status {}, restarting".format(worker_id, pid, status), flush=True)
+            time.sleep(max(0.0, self.min_restart_interval - (time.time() - started)))
+            if not self._stopping:
+                self._spawn(worker_id)
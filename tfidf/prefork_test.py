@@ -0,0 +1,73 @@
+"""Tests for tfidf.prefork."""
+
+import multiprocessing
+import os
+import signal
+import socket
+
+from absl.testing import absltest
+
+from tfidf.prefork import bind_listener, PreforkServer
+
+
+def _serve_pids(listener):
+    """ Replies to each connection with our pid, and doesn't take another one until the client hangs up"""
+    while True:
+        conn, _ = listener.accept()
+        conn.sendall('{}\n'.format(os.getpid()).encode('utf-8'))
+        conn.recv(1)
+        conn.close()
+
+
+class PreforkServerTest(absltest.TestCase):
+
+    def setUp(self):
+        self.listener = bind_listener(('127.0.0.1', 0))
+        self.address = self.listener.getsockname()
+        server = PreforkServer(lambda: _serve_pids(self.listener), num_workers=3, min_restart_interval=0.0)
+        self.supervisor = multiprocessing.get_context('fork').Process(target=server.run)
+        self.supervisor.start()
+
+    def tearDown(self):
+        self.supervisor.terminate()
+        self.supervisor.join(10)
+        self.listener.close()
+
+    def _connect(self, num_clients):
+        """ :return: num_clients open connections, and the pids of the workers that accepted them"""
+        conns = [socket.create_connection(self.address, timeout=10) for _ in range(num_clients)]
+        return conns, [int(conn.makefile('r').readline()) for conn in conns]
+
+    def _pids(self, num_clients):
+        conns, pids = self._connect(num_clients)
+        for conn in conns:
+            conn.close()
+        return pids
+
+    def test_concurrent(self):
+        pids = self._pids(3)
+        self.assertLen(set(pids), 3)
+        self.assertNotIn(self.supervisor.pid, pids)
+
+    def test_restart_and_stop(self):
+        conns, pids = self._connect(3)
+        # Kill it while it's busy, and wait for it to hang up, so it's gone before we connect again
+        os.kill(pids[0], signal.SIGKILL)
+        self.assertEqual(conns[0].recv(1), b'')
+        for conn in conns:
+            conn.close()
+        # The last connection waits for the replacement
+        new_pids = set(self._pids(3))
+        self.assertLen(new_pids, 3)
+        self.assertNotIn(pids[0], new_pids)
+
+        self.supervisor.terminate()
+        self.supervisor.join(10)
+        self.assertEqual(self.supervisor.exitcode, 0)
+        for pid in new_pids:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(pid, 0)
+
+
+if __name__ == '__main__':
+    absltest.main()
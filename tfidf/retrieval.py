@@ -0,0 +1,878 @@
+"""
+The TF-IDF retrieval baseline: building the index, and searching it (see run_server.py and batch_retrieve.py).
+
+A document's weight for word w is count(w) * idf[w] / len(document), and idf[w] = log(num docs / (1 + doc freq)).
+Words that show up fewer than 10 times overall are UNK (index 0).
+
+The index on disk is split into segments (see SegmentedIndex), so new posts can be added without rebuilding it.
+"""
+import array
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+import numpy as np
+import scipy.sparse
+from tqdm import tqdm
+
+sys.path.append('../')
+from data.advice_store import iter_advice, StringColumn
+
+INDEX_VERSION = 2
+
+
+def tokenize(spacy_model, texts, batch_size=256):
+    """ Lemmatized, lowercased tokens for each text. spaCy gets the texts in batches, with spacy_model.pipe"""
+    return [[x.lemma_.lower() for x in doc] for doc in spacy_model.pipe(texts, batch_size=batch_size)]
+
+
+def question_text(item):
+    """ What we search with, for a post or a question to the API"""
+    return '{} {}'.format(item['title'], item['selftext'])
+
+
+def build_vocab(docs_tokenized, min_count=10):
+    """
+    :param docs_tokenized: list of token lists, for every post (not just the ones we can retrieve)
+    :param min_count: words seen fewer times than this are UNK
+    :return: idx_to_word, word_to_idx, idf
+    """
+    word2count = Counter()
+    word2count_doc = Counter()
+    for toks in docs_tokenized:
+        word2count.update(toks)
+        word2count_doc.update(set(toks))
+
+    # Most common first. Ties stay in the order we first saw them
+    idx_to_word = ['UNK'] + [w for w, count in sorted(word2count.items(), key=lambda x: -x[1]) if count >= min_count]
+    word_to_idx = {w: i for i, w in enumerate(idx_to_word)}
+    doc_freq = np.array([0] + [word2count_doc[w] for w in idx_to_word[1:]], dtype=np.int64)
+    return idx_to_word, word_to_idx, idf_from_doc_freq(doc_freq, len(docs_tokenized))
+
+
+def idf_from_doc_freq(doc_freq, num_docs):
+    """
+    :param doc_freq: [vocab size] how many posts each word is in
+    :param num_docs: how many posts there are in total
+    :return: [vocab size] float32 IDF weights. UNK's is always log(1.01)
+    """
+    idf = np.zeros(len(doc_freq), dtype=np.float32)
+    idf[0] = np.log(1.01)
+    idf[1:] = np.log(num_docs / (1.0 + np.asarray(doc_freq[1:], dtype=np.float64)))
+    return idf
+
+
+def count_matrix(docs_tokenized, word_to_idx):
+    """
+    :return: CSR matrix of word counts, [num docs, vocab size], with sorted indices
+    """
+    lengths = np.fromiter((len(toks) for toks in docs_tokenized), dtype=np.int64, count=len(docs_tokenized))
+    indptr = np.zeros(len(docs_tokenized) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.fromiter((word_to_idx.get(tok, 0) for toks in docs_tokenized for tok in toks), dtype=np.int32,
+                          count=int(indptr[-1]))
+    counts = scipy.sparse.csr_matrix((np.ones(indices.shape[0], dtype=np.float32), indices, indptr),
+                                     shape=(len(docs_tokenized), len(word_to_idx)))
+    # Adds up repeated words, and sorts the indices
+    counts.sum_duplicates()
+    return counts
+
+
+def doc_lengths(docs_tokenized):
+    """ :return: [num docs] how many tokens each one has (at least 1, since we divide by it)"""
+    return np.fromiter((max(len(toks), 1) for toks in docs_tokenized), dtype=np.float64, count=len(docs_tokenized))
+
+
+def weight_counts(counts, lengths, idf, dtype=np.float32):
+    """
+    :param counts: CSR matrix from count_matrix
+    :param lengths: from doc_lengths
+    :return: CSR matrix of TF-IDF weights, with the same sparsity structure as counts. The weights get computed in
+             float64 and then cast to dtype
+    """
+    data = counts.data * idf[counts.indices].astype(np.float64) / np.repeat(lengths, np.diff(counts.indptr))
+    return scipy.sparse.csr_matrix((data.astype(dtype), counts.indices, counts.indptr), shape=counts.shape)
+
+
+def tfidf_matrix(docs_tokenized, word_to_idx, idf, dtype=np.float32):
+    """
+    :return: CSR matrix of TF-IDF weights, [num docs, vocab size]
+    """
+    return weight_counts(count_matrix(docs_tokenized, word_to_idx), doc_lengths(docs_tokenized), idf, dtype=dtype)
+
+
+def normalize_rows(matrix):
+    """
+    :return: float32 CSR copy of matrix, with each row scaled to unit L2 norm (empty rows stay empty)
+    """
+    matrix = scipy.sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    matrix.sum_duplicates()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    # Rows that are already normalized (like when we load a saved index) stay exactly the same
+    norms[(norms == 0) | (np.abs(norms - 1.0) < 1e-6)] = 1.0
+    matrix.data /= np.repeat(norms, np.diff(matrix.indptr))
+    return matrix.astype(np.float32)
+
+
+def _top_k_rows(scores, k, rows=None):
+    """
+    :param scores: float array
+    :param rows: the row each score is for, defaults to its position. Ties go to the lowest row
+    :return: positions in scores of the k best, best first. Uses a partial selection rather than sorting everything
+    """
+    if rows is None:
+        rows = np.arange(len(scores))
+    if k < len(scores):
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        # Everything tied with the k-th best, so that ties still go to the lowest row
+        keep = np.flatnonzero(scores >= kth)
+    else:
+        keep = np.arange(len(scores))
+    return keep[np.lexsort((rows[keep], -scores[keep]))[:k]]
+
+
+def _pad_with_zeros(top, k, num_rows):
+    """ If there are fewer than k posts with a positive score, the rest all score 0, and go in row order"""
+    if len(top) < k:
+        have = set(row for row, _ in top)
+        for row in range(num_rows):
+            if len(top) == k:
+                break
+            if row not in have:
+                top.append((row, 0.0))
+    return top
+
+
+class ImpactPostings(object):
+    def __init__(self, rows, weights, offsets):
+        """
+        Inverted index over a TF-IDF matrix: for each word, the posts that have it, highest weight first. The first
+        posting of each word is the most that word can add to any post's score. Use from_matrix to make one.
+        :param rows: [num postings] post of each posting
+        :param weights: [num postings] its weight
+        :param offsets: [vocab size + 1] where each word's postings start
+        """
+        self.rows = rows
+        self.weights = weights
+        self.offsets = offsets
+        self.lengths = np.diff(self.offsets)
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """ :param matrix: [num posts, vocab size] sparse matrix"""
+        matrix = scipy.sparse.csc_matrix(matrix, copy=True)
+        matrix.eliminate_zeros()
+        words = np.repeat(np.arange(matrix.shape[1]), np.diff(matrix.indptr))
+        order = np.lexsort((matrix.indices, -matrix.data, words))
+        return cls(matrix.indices[order].astype(np.int32), matrix.data[order], matrix.indptr.astype(np.int64))
+
+
+class TfidfIndex(object):
+    def __init__(self, matrix, word_to_idx, idf, postings=None):
+        """
+        Cosine similarity search over the retrievable posts.
+        :param matrix: [num posts, vocab size] TF-IDF weights from tfidf_matrix (or a saved copy of self.matrix)
+        :param word_to_idx: vocab
+        :param idf: [vocab size] IDF weights
+        :param postings: only when loading a saved index (see load), then matrix is used as is
+        """
+        if postings is None:
+            matrix = normalize_rows(matrix)
+            postings = ImpactPostings.from_matrix(matrix)
+        self.matrix = matrix
+        self.word_to_idx = word_to_idx
+        self.idf = np.asarray(idf, dtype=np.float32)
+        self.postings = postings
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def query_vector(self, tokens):
+        """
+        :return: the query's TF-IDF weights as a unit-norm sparse vector: sorted word indices, float32 weights
+        """
+        return _query_vector(tokens, self.word_to_idx, self.idf)
+
+    def query_matrix(self, queries_tokenized):
+        """ :return: [num queries, vocab size] CSR matrix, each row is a query_vector"""
+        return _query_matrix(queries_tokenized, self.word_to_idx, self.idf)
+
+    def _dense_query(self, ids, weights):
+        query = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        query[ids] = weights
+        return query
+
+    def scores(self, tokens):
+        """ :return: [num posts] cosine similarity of each post with the query, by brute force"""
+        return self.scores_vector(*self.query_vector(tokens))
+
+    def scores_vector(self, ids, weights):
+        """ scores, for a query that's already a query_vector"""
+        return self.matrix.dot(self._dense_query(ids, weights))
+
+    def top_k(self, tokens, k=1, initial_postings=64, max_seen_fraction=0.25):
+        """
+        The k most similar posts, without scoring all of them. Ties go to the lowest row, so it's exactly the same
+        as sorting self.scores(tokens).
+        :return: list of (row, score), best first
+        """
+        return self.top_k_vector(*self.query_vector(tokens), k=k, initial_postings=initial_postings,
+                                 max_seen_fraction=max_seen_fraction)
+
+    def top_k_vector(self, ids, weights, k=1, initial_postings=64, max_seen_fraction=0.25):
+        """
+        top_k, for a query that's already a query_vector.
+
+        We read each query word's postings from the top (highest weight first), adding up what we've read of each
+        post's score. A post we haven't come across yet can score at most the sum over query words of
+        (query weight * weight of the next unread posting), and one we have can score at most what we've read plus
+        that. Once that bound is below the k-th best score read so far, only the posts that could still make it need
+        to be scored exactly. Each round, we read more of the words that contribute the most to the bound, so we
+        hardly read the (long, low weight) postings of common words at all.
+
+        :param initial_postings: how many postings to read for each word to begin with
+        :param max_seen_fraction: if we come across more than this fraction of the posts, just score all of them
+        :return: list of (row, score), best first
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        query = self._dense_query(ids, weights)
+        keep = (weights > 0) & (self.postings.lengths[ids] > 0)
+        ids, weights = ids[keep], weights[keep].astype(np.float64)
+        starts = self.postings.offsets[ids]
+        lengths = self.postings.lengths[ids]
+        num_read = np.zeros(len(ids), dtype=np.int64)
+        to_read = np.minimum(lengths, initial_postings)
+
+        # np.zeros / np.empty don't touch the memory until we do, so these are cheap even for a big index
+        partial = np.zeros(len(self))
+        slot = np.empty(len(self), dtype=np.int64)
+        seen = np.zeros(0, dtype=np.int64)
+        # Leave some room for float32 rounding in the exact scores
+        slack = 1 - 1e-3
+        while True:
+            counts = to_read - num_read
+            num_new = int(counts.sum())
+            if len(seen) + num_new > max_seen_fraction * len(self):
+                # The query isn't selective enough for this to be worth it
+                scores = self.matrix.dot(query)
+                return [(int(row), float(scores[row])) for row in _top_k_rows(scores, k)]
+
+            # Read postings num_read:to_read of every word at once
+            if num_new > 0:
+                word = np.repeat(np.arange(len(ids)), counts)
+                pos = np.arange(num_new) + np.repeat(starts + num_read - np.cumsum(counts) + counts, counts)
+                new_rows = self.postings.rows[pos]
+                # Every posting adds something, so partial is 0 for posts we haven't seen. Then drop duplicates
+                # by keeping the last place each row shows up
+                new_rows = new_rows[partial[new_rows] == 0]
+                slot[new_rows] = np.arange(len(new_rows))
+                seen = np.concatenate([seen, new_rows[slot[new_rows] == np.arange(len(new_rows))]])
+                np.add.at(partial, self.postings.rows[pos], weights[word] * self.postings.weights[pos])
+            num_read = to_read
+
+            unread = num_read < lengths
+            frontier = np.zeros(len(ids))
+            frontier[unread] = weights[unread] * self.postings.weights[starts[unread] + num_read[unread]]
+            bound = frontier.sum()
+            kth = -np.partition(-partial[seen], k - 1)[k - 1] if len(seen) >= k else 0.0
+            if bound == 0 or bound < kth * slack:
+                break
+            gap = bound - kth * slack
+            expand = unread & (frontier >= gap / len(ids))
+            to_read = np.where(expand, np.minimum(lengths, np.maximum(2 * num_read, initial_postings)), num_read)
+
+        # Same kernel as scores(), so we get the same float32 values
+        candidates = seen[partial[seen] + bound >= kth * slack]
+        scores = self.matrix[candidates].dot(query)
+        top = [(int(candidates[i]), float(scores[i])) for i in _top_k_rows(scores, k, rows=candidates)]
+        return _pad_with_zeros(top, k, len(self))
+
+    def top_k_batch(self, queries_tokenized, k=1):
+        """
+        top_k for a bunch of queries at once, by scoring them all in one sparse-sparse product. That sums up each
+        score in the same order as scores() does, so the results are exactly the same as calling top_k on each.
+        :return: list of results from top_k
+        """
+        if len(queries_tokenized) == 0:
+            return []
+        return self.top_k_matrix(self.query_matrix(queries_tokenized), k=k)
+
+    def top_k_matrix(self, queries, k=1):
+        """ top_k_batch, for queries that are already a query_matrix"""
+        k = min(k, len(self))
+        if queries.shape[0] == 0 or k <= 0:
+            return [[] for _ in range(queries.shape[0])]
+        # [num posts, num queries], the products that are 0 get left out
+        scores = self.matrix.dot(queries.T.tocsr()).T.tocsr()
+        results = []
+        for i in range(queries.shape[0]):
+            rows = scores.indices[scores.indptr[i]:scores.indptr[i + 1]]
+            row_scores = scores.data[scores.indptr[i]:scores.indptr[i + 1]]
+            top = [(int(rows[j]), float(row_scores[j])) for j in _top_k_rows(row_scores, k, rows=rows)]
+            results.append(_pad_with_zeros(top, k, len(self)))
+        return results
+
+    def best_match(self, tokens):
+        """
+        :return: (row, score) of the most similar post. Ties go to the lowest row, so the answer is deterministic
+        """
+        return self.top_k(tokens, k=1)[0]
+
+    def save(self, path, with_vocab=True):
+        """
+        Writes the index to a directory as plain arrays, so load can memmap them
+        :param with_vocab: False leaves out the vocab, if it's kept somewhere else (like for a SegmentedIndex)
+        """
+        os.makedirs(path, exist_ok=True)
+        arrays = {
+            'matrix.data': self.matrix.data.astype(np.float32),
+            'matrix.indices': self.matrix.indices.astype(np.int32),
+            'matrix.indptr': self.matrix.indptr.astype(np.int64),
+            'postings.rows': self.postings.rows.astype(np.int32),
+            'postings.weights': self.postings.weights.astype(np.float32),
+            'postings.offsets': self.postings.offsets.astype(np.int64),
+            'idf': self.idf,
+        }
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        if with_vocab:
+            _write_strings(os.path.join(path, 'vocab'), _idx_to_word(self.word_to_idx))
+
+    @classmethod
+    def load(cls, path, shape, word_to_idx=None):
+        """
+        Opens an index written by save. The arrays are memmapped read-only, so processes that load the same index
+        share one copy of it (the OS page cache).
+        :param shape: (num posts, vocab size)
+        :param word_to_idx: the vocab, if it wasn't saved with the index
+        """
+        def _load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        matrix = scipy.sparse.csr_matrix((_load('matrix.data'), _load('matrix.indices'), _load('matrix.indptr')),
+                                         shape=shape, copy=False)
+        if word_to_idx is None:
+            word_to_idx = _read_vocab(path, shape[1])
+        postings = ImpactPostings(_load('postings.rows'), _load('postings.weights'), _load('postings.offsets'))
+        return cls(matrix, word_to_idx, _load('idf'), postings=postings)
+
+
+def _query_vector(tokens, word_to_idx, idf):
+    ids, counts = np.unique(np.fromiter((word_to_idx.get(tok, 0) for tok in tokens), dtype=np.int64,
+                                        count=len(tokens)), return_counts=True)
+    weights = counts * idf[ids].astype(np.float64)
+    norm = np.sqrt(np.square(weights).sum())
+    if norm > 0:
+        weights /= norm
+    return ids.astype(np.int32), weights.astype(np.float32)
+
+
+def _query_matrix(queries_tokenized, word_to_idx, idf):
+    ids, weights = zip(*[_query_vector(tokens, word_to_idx, idf) for tokens in queries_tokenized])
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in ids], out=indptr[1:])
+    return scipy.sparse.csr_matrix((np.concatenate(weights), np.concatenate(ids), indptr),
+                                   shape=(len(ids), len(idf)))
+
+
+def _idx_to_word(word_to_idx):
+    return [w for w, i in sorted(word_to_idx.items(), key=lambda x: x[1])]
+
+
+def _read_vocab(path, vocab_size):
+    words = StringColumn(os.path.join(path, 'vocab'), vocab_size)
+    return {words[i]: i for i in range(vocab_size)}
+
+
+def _write_strings(prefix, strings):
+    """ Same layout as str columns in data/advice_store.py, read them with StringColumn"""
+    offsets = array.array('q', [0])
+    with open(prefix + '.heap', 'wb') as f:
+        for x in strings:
+            data = x.encode('utf-8')
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    np.frombuffer(offsets, dtype=np.int64).tofile(prefix + '.offsets')
+
+
+class ResponseStore(object):
+    """ The bits of each retrievable post that we return: its first good comment, and where to find it"""
+    FIELDS = ('subreddit', 'post_id', 'comment_id', 'body')
+
+    def __init__(self, path, num_rows):
+        self.columns = {k: StringColumn(os.path.join(path, 'responses.{}'.format(k)), num_rows) for k in self.FIELDS}
+        self.num_rows = num_rows
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, row):
+        return {k: column[row] for k, column in self.columns.items()}
+
+    @classmethod
+    def write(cls, path, advice):
+        """ :param advice: posts with subreddit / id / good_comments"""
+        responses = [{'subreddit': item['subreddit'], 'post_id': item['id'],
+                      'comment_id': item['good_comments'][0]['id'], 'body': item['good_comments'][0]['body']}
+                     for item in advice]
+        for k in cls.FIELDS:
+            _write_strings(os.path.join(path, 'responses.{}'.format(k)), [x[k] for x in responses])
+
+    @classmethod
+    def concat(cls, path, stores):
+        """ Writes the rows of all of stores, one after the other, without decoding them"""
+        for k in cls.FIELDS:
+            columns = [store.columns[k] for store in stores]
+            prefix = os.path.join(path, 'responses.{}'.format(k))
+            with open(prefix + '.heap', 'wb') as f:
+                for column in columns:
+                    f.write(column.heap[:int(column.offsets[-1])].tobytes())
+            starts = np.cumsum([0] + [int(column.offsets[-1]) for column in columns])
+            offsets = [np.zeros(1, dtype=np.int64)] + [start + column.offsets[1:]
+                                                        for start, column in zip(starts, columns)]
+            np.concatenate(offsets).astype(np.int64).tofile(prefix + '.offsets')
+
+
+class Segment(object):
+    def __init__(self, path, num_rows, word_to_idx):
+        """
+        Part of a SegmentedIndex: a TfidfIndex over some of the posts, the responses for its rows, and the word
+        counts it was made from, so that it can be weighted again when the IDF changes. Use write to make one.
+        :param path: the segment's directory
+        """
+        self.path = path
+        self.name = os.path.basename(path)
+        self.index = TfidfIndex.load(path, (num_rows, len(word_to_idx)), word_to_idx=word_to_idx)
+        self.responses = ResponseStore(path, num_rows)
+        self.lengths = np.load(os.path.join(path, 'lengths.npy'), mmap_mode='r')
+        self._counts = np.load(os.path.join(path, 'counts.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def counts(self):
+        """ [num posts, vocab size] CSR matrix of word counts (see count_matrix)"""
+        matrix = self.index.matrix
+        return scipy.sparse.csr_matrix((self._counts, matrix.indices, matrix.indptr), shape=matrix.shape, copy=False)
+
+    @staticmethod
+    def write(path, counts, lengths, idf, word_to_idx):
+        """
+        Writes everything but the responses (see ResponseStore)
+        :param counts: [num posts, vocab size] from count_matrix
+        :param lengths: [num posts] from doc_lengths
+        :param idf: what to weight the counts with
+        """
+        index = TfidfIndex(weight_counts(counts, lengths, idf), word_to_idx, idf)
+        index.save(path, with_vocab=False)
+        # Normalizing doesn't change the sparsity structure, so the counts line up with index.matrix
+        np.save(os.path.join(path, 'counts.npy'), counts.data.astype(np.float32))
+        np.save(os.path.join(path, 'lengths.npy'), np.asarray(lengths, dtype=np.float64))
+
+
+class _SegmentedResponses(object):
+    """ The ResponseStore for all the rows of a SegmentedIndex, as of its last refresh"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, row):
+        i = int(np.searchsorted(self.index.offsets, row, side='right')) - 1
+        return self.index.segments[i].responses[row - int(self.index.offsets[i])]
+
+
+class SegmentedIndex(object):
+    def __init__(self, path):
+        """
+        Searches all the segments of an index directory as one index. Rows are numbered through the segments in
+        order.
+
+        New posts get added to the directory as segments of their own (see append_to_index), and the document
+        frequencies + IDF get updated for them. Queries always get weighted with the current IDF, so they score the
+        same in every segment. A segment's posts stay weighted with the IDF from when it was written until it gets
+        merged (see merge_segments), which weights them with the current one. Any of that can happen while we're
+        serving: refresh picks up the changes.
+
+        :param path: the index directory, from create_index
+        """
+        self.path = path
+        self.generation = None
+        self.segments = []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.responses = _SegmentedResponses(self)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Picks up segments that were added or merged since we last looked. Cheap if nothing changed.
+        :return: whether anything did
+        """
+        for attempt in range(3):
+            meta = _read_meta(self.path)
+            if meta['generation'] == self.generation:
+                return False
+            try:
+                self._open(meta)
+                return True
+            except FileNotFoundError:
+                # A merge cleaned up a segment from the meta.json we read, so there's a newer one by now
+                if attempt == 2:
+                    raise
+
+    def _open(self, meta):
+        if self.generation is None:
+            self.word_to_idx = _read_vocab(self.path, meta['vocab_size'])
+        old_segments = {segment.name: segment for segment in self.segments}
+        segments = []
+        for x in meta['segments']:
+            segment = old_segments.get(x['name'])
+            if segment is None:
+                segment = Segment(os.path.join(self.path, 'segments', x['name']), x['num_rows'], self.word_to_idx)
+            segments.append(segment)
+        doc_freq = np.load(os.path.join(self.path, meta['doc_freq']))
+        offsets = np.zeros(len(segments) + 1, dtype=np.int64)
+        np.cumsum([len(segment) for segment in segments], out=offsets[1:])
+
+        self.num_docs = meta['num_docs']
+        self.idf = idf_from_doc_freq(doc_freq, self.num_docs)
+        self.segments, self.offsets = segments, offsets
+        self.generation = meta['generation']
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def query_vector(self, tokens):
+        """ Like TfidfIndex.query_vector, with the current IDF"""
+        return _query_vector(tokens, self.word_to_idx, self.idf)
+
+    def scores(self, tokens):
+        """ :return: [num posts] cosine similarity of each post with the query, by brute force"""
+        ids, weights = self.query_vector(tokens)
+        return np.concatenate([segment.index.scores_vector(ids, weights) for segment in self.segments])
+
+    def _merge_top(self, tops, k):
+        """ :param tops: top_k results from each segment. Each one's k best, so the k best of them are the k best"""
+        rows = np.array([offset + row for offset, top in zip(self.offsets, tops) for row, _ in top], dtype=np.int64)
+        scores = np.array([score for top in tops for _, score in top], dtype=np.float64)
+        return [(int(rows[i]), float(scores[i])) for i in _top_k_rows(scores, k, rows=rows)]
+
+    def top_k(self, tokens, k=1):
+        """ Like TfidfIndex.top_k, over all the segments. :return: list of (row, score), best first"""
+        k = min(k, len(self))
+        ids, weights = self.query_vector(tokens)
+        return self._merge_top([segment.index.top_k_vector(ids, weights, k=k) for segment in self.segments], k)
+
+    def top_k_batch(self, queries_tokenized, k=1):
+        """ Like TfidfIndex.top_k_batch, over all the segments"""
+        k = min(k, len(self))
+        if len(queries_tokenized) == 0:
+            return []
+        queries = _query_matrix(queries_tokenized, self.word_to_idx, self.idf)
+        tops = [segment.index.top_k_matrix(queries, k=k) for segment in self.segments]
+        return [self._merge_top([x[i] for x in tops], k) for i in range(len(queries_tokenized))]
+
+    def best_match(self, tokens):
+        """ :return: (row, score) of the most similar post. Ties go to the lowest row"""
+        return self.top_k(tokens, k=1)[0]
+
+
+def _read_meta(index_dir):
+    with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta['version'] != INDEX_VERSION:
+        raise ValueError("{} is version {}, expected {}. Delete it to rebuild".format(index_dir, meta['version'],
+                                                                                     INDEX_VERSION))
+    return meta
+
+
+@contextlib.contextmanager
+def _locked(index_dir):
+    """ Only one process at a time gets to change which segments there are"""
+    with open(os.path.join(index_dir, 'lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _commit(index_dir, old_meta, segments, doc_freq=None, num_docs=None):
+    """
+    Writes a new meta.json, which is what readers go by, then deletes what the old one had that this one doesn't.
+    Call this with the lock held.
+    :param segments: [{'name': ..., 'num_rows': ..., 'weighted_with': ...}] for each segment, in order.
+                     weighted_with is the doc_freq file whose IDF its posts were weighted with
+    :param doc_freq: the new document frequencies, if they changed
+    """
+    # mkdtemp makes them private, but servers might run as someone else
+    for name in set(x['name'] for x in segments) - set(x['name'] for x in old_meta['segments']):
+        os.chmod(os.path.join(index_dir, 'segments', name), 0o755)
+    meta = dict(old_meta, segments=segments, generation=old_meta['generation'] + 1)
+    if num_docs is not None:
+        meta['num_docs'] = num_docs
+    if doc_freq is not None:
+        meta['doc_freq'] = _doc_freq_fn(old_meta)
+        np.save(os.path.join(index_dir, meta['doc_freq']), np.asarray(doc_freq, dtype=np.int64))
+    meta_fn = os.path.join(index_dir, 'meta.json')
+    with open(meta_fn + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_fn + '.tmp', meta_fn)
+
+    # Processes still using these have them memmapped, so it's fine to delete them
+    if meta['doc_freq'] != old_meta.get('doc_freq', meta['doc_freq']):
+        os.remove(os.path.join(index_dir, old_meta['doc_freq']))
+    for name in set(x['name'] for x in old_meta['segments']) - set(x['name'] for x in segments):
+        shutil.rmtree(os.path.join(index_dir, 'segments', name))
+    return meta
+
+
+def _doc_freq_fn(old_meta):
+    """ What _commit will call the new doc_freq file, when committing on top of old_meta"""
+    return 'doc_freq.{}.npy'.format(old_meta['generation'] + 1)
+
+
+def _new_segment_dir(index_dir):
+    """
+    A uniquely named directory to write a segment in, so that writers don't need the lock until they commit. It's
+    only readable by us until _commit
+    """
+    return tempfile.mkdtemp(prefix='seg-', dir=os.path.join(index_dir, 'segments'))
+
+
+def create_index(index_dir, word_to_idx, doc_freq, num_docs, counts, lengths, advice):
+    """
+    Writes a new index directory with one segment
+    :param doc_freq: [vocab size] how many posts each word is in. All posts count, not just the ones in counts
+    :param num_docs: how many posts that's out of
+    :param counts: [num retrievable posts, vocab size] from count_matrix
+    :param lengths: [num retrievable posts] from doc_lengths
+    :param advice: the retrievable posts, with subreddit / id / good_comments
+    """
+    os.makedirs(os.path.join(index_dir, 'segments'), exist_ok=True)
+    _write_strings(os.path.join(index_dir, 'vocab'), _idx_to_word(word_to_idx))
+    segment_dir = _new_segment_dir(index_dir)
+    Segment.write(segment_dir, counts, lengths, idf_from_doc_freq(doc_freq, num_docs), word_to_idx)
+    ResponseStore.write(segment_dir, advice)
+    with _locked(index_dir):
+        meta = {'version': INDEX_VERSION, 'generation': -1, 'vocab_size': len(word_to_idx), 'segments': []}
+        _commit(index_dir, meta, [{'name': os.path.basename(segment_dir), 'num_rows': len(advice),
+                                   'weighted_with': _doc_freq_fn(meta)}], doc_freq=doc_freq, num_docs=num_docs)
+
+
+def append_to_index(index_dir, posts, posts_tokenized):
+    """
+    Adds posts to the index as a new segment, and counts them in the document frequencies. Words that aren't in
+    the vocab yet are UNK, like they'd be for a query.
+
+    :param posts: with subreddit / id / good_comments. Only ones with good comments can be retrieved, but they all
+                  count for the IDF
+    :param posts_tokenized: tokens for each one, from tokenize
+    :return: the new segment's name, or None if none of the posts could be retrieved
+    """
+    for attempt in range(3):
+        meta = _read_meta(index_dir)
+        try:
+            doc_freq = np.load(os.path.join(index_dir, meta['doc_freq']))
+            break
+        except FileNotFoundError:
+            # Another append committed (and cleaned up the old doc_freq) after we read meta.json
+            if attempt == 2:
+                raise
+    word_to_idx = _read_vocab(index_dir, meta['vocab_size'])
+    counts = count_matrix(posts_tokenized, word_to_idx)
+    new_doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+    retrievable = [i for i, post in enumerate(posts) if len(post['good_comments']) > 0]
+
+    # Write the segment without the lock, weighted as of meta.json now. If someone else appends before we commit,
+    # it gets marked as weighted with the old IDF, so the next reweight fixes it
+    segment_dir = None
+    if retrievable:
+        segment_dir = _new_segment_dir(index_dir)
+        Segment.write(segment_dir, counts[retrievable], doc_lengths(posts_tokenized)[retrievable],
+                      idf_from_doc_freq(doc_freq + new_doc_freq, meta['num_docs'] + len(posts)), word_to_idx)
+        ResponseStore.write(segment_dir, [posts[i] for i in retrievable])
+
+    with _locked(index_dir):
+        current = _read_meta(index_dir)
+        segments = list(current['segments'])
+        if segment_dir is not None:
+            weighted_with = _doc_freq_fn(current) if current['doc_freq'] == meta['doc_freq'] else meta['doc_freq']
+            segments.append({'name': os.path.basename(segment_dir), 'num_rows': len(retrievable),
+                             'weighted_with': weighted_with})
+        _commit(index_dir, current, segments,
+                doc_freq=np.load(os.path.join(index_dir, current['doc_freq'])) + new_doc_freq,
+                num_docs=current['num_docs'] + len(posts))
+    return None if segment_dir is None else os.path.basename(segment_dir)
+
+
+def merge_segments(index_dir, max_segments=1, reweight=False):
+    """
+    Merges the smallest segments together until there are at most max_segments, weighting them with the current
+    IDF. The index can be searched (and added to) the whole time; we only hold the lock at the end.
+    :param reweight: merge everything into one segment if any of it isn't weighted with the current IDF, even if
+                     there aren't more than max_segments
+    :return: whether we merged anything
+    """
+    meta = _read_meta(index_dir)
+    stale = [x.get('weighted_with') != meta['doc_freq'] for x in meta['segments']]
+    if reweight and any(stale):
+        max_segments = 1
+    elif len(meta['segments']) <= max(max_segments, 1):
+        return False
+    by_size = sorted(range(len(meta['segments'])), key=lambda i: meta['segments'][i]['num_rows'])
+    to_merge = sorted(by_size[:max(len(meta['segments']) - max(max_segments, 1) + 1, 1)])
+    names = [meta['segments'][i]['name'] for i in to_merge]
+    merged = {'name': None, 'num_rows': sum(meta['segments'][i]['num_rows'] for i in to_merge),
+              'weighted_with': meta['doc_freq']}
+
+    segment_dir = _new_segment_dir(index_dir)
+    merged['name'] = os.path.basename(segment_dir)
+    try:
+        word_to_idx = _read_vocab(index_dir, meta['vocab_size'])
+        doc_freq = np.load(os.path.join(index_dir, meta['doc_freq']))
+        segments = [Segment(os.path.join(index_dir, 'segments', meta['segments'][i]['name']),
+                            meta['segments'][i]['num_rows'], word_to_idx) for i in to_merge]
+    except FileNotFoundError:
+        # We don't hold the lock yet, so another merge (or an append, for doc_freq) got there first and cleaned up
+        # what we read. Whatever's left to do gets done next time
+        shutil.rmtree(segment_dir)
+        return False
+    Segment.write(segment_dir, scipy.sparse.vstack([x.counts for x in segments], format='csr'),
+                  np.concatenate([x.lengths for x in segments]), idf_from_doc_freq(doc_freq, meta['num_docs']),
+                  word_to_idx)
+    ResponseStore.concat(segment_dir, [x.responses for x in segments])
+    del segments
+
+    with _locked(index_dir):
+        meta = _read_meta(index_dir)
+        current = [x['name'] for x in meta['segments']]
+        if not all(name in current for name in names):
+            # Someone else merged some of them first
+            shutil.rmtree(segment_dir)
+            return False
+        new_segments = []
+        for x in meta['segments']:
+            if x['name'] == names[0]:
+                new_segments.append(merged)
+            elif x['name'] not in names:
+                new_segments.append(x)
+        _commit(index_dir, meta, new_segments)
+    return True
+
+
+def iter_tokenized(items, spacy_model, chunk_size=2048):
+    """ Yields (item, tokens), parsing chunk_size questions at a time"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield from zip(chunk, tokenize(spacy_model, [question_text(x) for x in chunk]))
+            chunk = []
+    yield from zip(chunk, tokenize(spacy_model, [question_text(x) for x in chunk]))
+
+
+def load_or_build_index(advice_fn, spacy_model, cache_dir='.'):
+    """
+    Opens the index in cache_dir/tfidf_index, or builds it there if it isn't there yet.
+
+    Everything in there gets memmapped, so startup doesn't need to read redditadvice2019.jsonl, and the memory gets
+    shared between processes. If there's an index from before that (counts.npz, idf.npy and word_to_idx.json in
+    cache_dir), we convert that instead of building one from scratch. Add posts to it later with update_index.py.
+
+    :param advice_fn: redditadvice2019.jsonl, or a store made from it with data/advice_store.py
+    :return: (SegmentedIndex, its responses: a dict for each row of the index)
+    """
+    index_dir = os.path.join(cache_dir, 'tfidf_index')
+    if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        built = _load_old_cache(advice_fn, cache_dir)
+        if built is None:
+            built = _build_index(advice_fn, spacy_model)
+        print("DUMPING TO {}".format(index_dir), flush=True)
+        create_index(index_dir, *built)
+        del built
+
+    print("Loading from CACHE!", flush=True)
+    index = SegmentedIndex(index_dir)
+    return index, index.responses
+
+
+def _load_old_cache(advice_fn, cache_dir):
+    """
+    :return: (word_to_idx, doc_freq, num_docs, counts, lengths, posts) for create_index from counts.npz etc, or None
+             if those aren't there
+    """
+    counts_fn = os.path.join(cache_dir, 'counts.npz')
+    if not os.path.exists(counts_fn):
+        return None
+    print("Converting the index in {}".format(counts_fn), flush=True)
+    tfidf = scipy.sparse.csr_matrix(scipy.sparse.load_npz(counts_fn), dtype=np.float64)
+    tfidf.sum_duplicates()
+    idf = np.load(os.path.join(cache_dir, 'idf.npy')).astype(np.float64)
+    advice = []
+    num_docs = 0
+    # We only need enough to show the best match, and how many posts there are for the IDF
+    for item in tqdm(iter_advice(advice_fn, fields=['subreddit', 'id', 'good_comments'],
+                                 comment_fields=['id', 'body']), total=188620):
+        num_docs += 1
+        if len(item['good_comments']) == 0:
+            continue
+        advice.append(item)
+
+    # That only has the weights, count * idf / length. Dividing out the IDF gets us count / length, which is all
+    # that matters since the rows get normalized anyway
+    word_idf = idf[tfidf.indices]
+    counts = np.divide(tfidf.data, word_idf, out=np.zeros_like(tfidf.data), where=word_idf != 0)
+    counts = scipy.sparse.csr_matrix((counts, tfidf.indices, tfidf.indptr), shape=tfidf.shape)
+    doc_freq = np.rint(num_docs * np.exp(-idf) - 1).astype(np.int64)
+    doc_freq[0] = 0
+
+    with open(os.path.join(cache_dir, 'word_to_idx.json'), 'r') as f:
+        word_to_idx = json.load(f)
+    return word_to_idx, doc_freq, num_docs, counts, np.ones(tfidf.shape[0]), advice
+
+
+def _build_index(advice_fn, spacy_model):
+    """ :return: (word_to_idx, doc_freq, num_docs, counts, lengths, posts we can retrieve) for create_index"""
+    advice = []
+    # Every post counts for the vocab + IDF, but we can only retrieve ones with comments
+    docs_tokenized = []
+    retrievable = []
+    items = iter_advice(advice_fn, fields=['subreddit', 'id', 'title', 'selftext', 'good_comments'],
+                        comment_fields=['id', 'body'])
+    for item, toks in iter_tokenized(tqdm(items, total=188620), spacy_model):
+        docs_tokenized.append(toks)
+        if len(item['good_comments']) == 0:
+            continue
+        advice.append({k: item[k] for k in ['subreddit', 'id', 'good_comments']})
+        retrievable.append(len(docs_tokenized) - 1)
+
+    print("Making vocabulary + IDF", flush=True)
+    idx_to_word, word_to_idx, idf = build_vocab(docs_tokenized)
+
+    print("Turning everything into the count matrix", flush=True)
+    counts = count_matrix(docs_tokenized, word_to_idx)
+    doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+    lengths = doc_lengths(docs_tokenized)
+    return word_to_idx, doc_freq, len(docs_tokenized), counts[retrievable], lengths[retrievable], advice
+
+
+def describe_match(response, score):
+    """ What we return for a retrieved post
+    :param response: from ResponseStore
+    """
+    match = dict(response)
+    match['permalink'] = 'https://reddit.com/r/{}/comments/{}/_/{}/'.format(response['subreddit'], response['post_id'],
+                                                                          response['comment_id'])
+    match['score'] = score
+    return match
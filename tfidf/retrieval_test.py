@@ -0,0 +1,325 @@
+"""Tests for tfidf.retrieval."""
+
+import json
+import os
+import random
+import tempfile
+from collections import defaultdict, namedtuple
+
+import numpy as np
+from absl.testing import absltest
+
+from tfidf import retrieval
+from tfidf.retrieval import (build_vocab, tfidf_matrix, count_matrix, doc_lengths, idf_from_doc_freq, TfidfIndex,
+                             SegmentedIndex, create_index, append_to_index, merge_segments, load_or_build_index,
+                             question_text)
+
+_Token = namedtuple('_Token', ['lemma_'])
+
+
+class _WhitespaceModel(object):
+    """ Stands in for spaCy: splits on whitespace"""
+
+    def pipe(self, texts, batch_size=256):
+        for text in texts:
+            yield [_Token(x) for x in text.split()]
+
+
+def _make_docs(num_docs=300, seed=123456):
+    rng = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(200)]
+    weights = [1.0 / (i + 1) for i in range(len(words))]
+    return [rng.choices(words, weights, k=rng.randint(0, 60)) for _ in range(num_docs)]
+
+
+class BuildIndexTest(absltest.TestCase):
+
+    def test_same_weights_as_loop(self):
+        docs = _make_docs()
+        idx_to_word, word_to_idx, idf = build_vocab(docs)
+
+        # How run_server.py used to do it
+        word2count = defaultdict(int)
+        word2count_doc = defaultdict(int)
+        for toks in docs:
+            for tok in toks:
+                word2count[tok] += 1
+            for tok in set(toks):
+                word2count_doc[tok] += 1
+        expected_idx_to_word = ['UNK'] + [x[0] for x in sorted(word2count.items(), key=lambda x: -x[1]) if x[1] >= 10]
+        self.assertEqual(idx_to_word, expected_idx_to_word)
+        expected_idf = [np.log(1.01)] + [np.log(len(docs) / (1.0 + word2count_doc[w])) for w in idx_to_word[1:]]
+        np.testing.assert_allclose(idf, expected_idf, rtol=1e-6)
+
+        expected = np.zeros((len(docs), len(idx_to_word)))
+        for i, toks in enumerate(docs):
+            for tok in toks:
+                expected[i, word_to_idx.get(tok, 0)] += float(idf[word_to_idx.get(tok, 0)]) / len(toks)
+        tfidf = tfidf_matrix(docs, word_to_idx, idf)
+        self.assertEqual(tfidf.format, 'csr')
+        self.assertEqual(tfidf.dtype, np.float32)
+        np.testing.assert_allclose(tfidf.toarray(), expected, rtol=1e-6)
+        self.assertEqual(tfidf.nnz, np.count_nonzero(expected))
+
+
+class TfidfIndexTest(absltest.TestCase):
+
+    def setUp(self):
+        docs = _make_docs()
+        self.docs, self.queries = docs[:250], docs[250:]
+        _, self.word_to_idx, self.idf = build_vocab(self.docs)
+        self.tfidf = tfidf_matrix(self.docs, self.word_to_idx, self.idf)
+        self.index = TfidfIndex(self.tfidf, self.word_to_idx, self.idf)
+
+    def _cosine(self, query):
+        docs = self.tfidf.toarray().astype(np.float64)
+        query = tfidf_matrix([query], self.word_to_idx, self.idf).toarray().astype(np.float64)[0]
+        norms = np.linalg.norm(docs, axis=1) * np.linalg.norm(query)
+        return docs.dot(query) / np.where(norms > 0, norms, 1.0)
+
+    def test_cosine(self):
+        for query in self.queries:
+            expected = self._cosine(query)
+            np.testing.assert_allclose(self.index.scores(query), expected, atol=1e-6)
+            row, score = self.index.best_match(query)
+            self.assertAlmostEqual(score, expected.max(), places=5)
+            self.assertGreaterEqual(expected[row], expected.max() - 1e-6)
+
+    def test_top_k_same_as_brute_force(self):
+        rng = random.Random(4)
+        index = TfidfIndex(tfidf_matrix(self.docs + self.docs[:20], self.word_to_idx, self.idf), self.word_to_idx,
+                           self.idf)
+        queries = self.queries + [q[:rng.randint(1, 5)] for q in self.queries] + [[], ['never seen']]
+        for query in queries:
+            scores = index.scores(query)
+            expected = np.lexsort((np.arange(len(scores)), -scores))
+            for k in [1, 3, 50]:
+                for max_seen_fraction in [0.25, 1.0]:
+                    top = index.top_k(query, k=k, initial_postings=rng.choice([1, 4, 64]),
+                                      max_seen_fraction=max_seen_fraction)
+                    self.assertEqual([row for row, _ in top], expected[:k].tolist())
+                    self.assertEqual([score for _, score in top], scores[expected[:k]].tolist())
+
+    def test_top_k_batch(self):
+        queries = self.queries + [q[:3] for q in self.queries] + [[]]
+        for k in [1, 5]:
+            self.assertEqual(self.index.top_k_batch(queries, k=k), [self.index.top_k(q, k=k) for q in queries])
+
+    def test_ties_go_to_first_row(self):
+        index = TfidfIndex(tfidf_matrix([self.docs[3]] * 3 + self.docs, self.word_to_idx, self.idf),
+                           self.word_to_idx, self.idf)
+        self.assertEqual(index.best_match(self.docs[3])[0], 0)
+        # Cached matrices get saved normalized, loading them again shouldn't change anything
+        again = TfidfIndex(index.matrix, self.word_to_idx, self.idf)
+        self.assertEqual((again.matrix != index.matrix).nnz, 0)
+
+
+class LoadOrBuildIndexTest(absltest.TestCase):
+
+    def test_cache(self):
+        docs = _make_docs(num_docs=100)
+        posts = [{'subreddit': 'Advice', 'id': 'p{}'.format(i), 'title': 'Title', 'selftext': ' '.join(toks),
+                  'good_comments': [{'id': 'c{}'.format(i), 'body': 'Comment {}'.format(i)}] * (i % 3 > 0)}
+                 for i, toks in enumerate(docs)]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            advice_fn = os.path.join(tmp_dir, 'redditadvice2019.jsonl')
+            with open(advice_fn, 'w') as f:
+                for post in posts:
+                    f.write(json.dumps(post) + '\n')
+            index, responses = load_or_build_index(advice_fn, _WhitespaceModel(), cache_dir=tmp_dir)
+            retrievable = [x for x in posts if x['good_comments']]
+            self.assertLen(responses, len(retrievable))
+            self.assertEqual(responses[1], {'subreddit': 'Advice', 'post_id': retrievable[1]['id'],
+                                            'comment_id': retrievable[1]['good_comments'][0]['id'],
+                                            'body': retrievable[1]['good_comments'][0]['body']})
+            self.assertLen(index.segments, 1)
+            self.assertIsInstance(index.segments[0].index.postings.rows, np.memmap)
+
+            # Same thing, built in memory
+            docs_tokenized = [question_text(x).lower().split() for x in posts]
+            _, word_to_idx, idf = build_vocab(docs_tokenized)
+            in_memory = TfidfIndex(tfidf_matrix([question_text(x).lower().split() for x in retrievable], word_to_idx, idf),
+                                   word_to_idx, idf)
+            self.assertEqual(index.word_to_idx, word_to_idx)
+            np.testing.assert_array_equal(index.idf, idf)
+            self.assertEqual((in_memory.matrix != index.segments[0].index.matrix).nnz, 0)
+            query = question_text(posts[1]).lower().split()
+            self.assertEqual(index.top_k(query, k=3), in_memory.top_k(query, k=3))
+            self.assertEqual(responses[index.best_match(query)[0]]['post_id'], 'p1')
+
+            # Doesn't need spaCy or the posts the second time
+            os.remove(advice_fn)
+            cached_index, _ = load_or_build_index(advice_fn, None, cache_dir=tmp_dir)
+            self.assertEqual(cached_index.top_k(query, k=3), index.top_k(query, k=3))
+
+
+class SegmentedIndexTest(absltest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.index_dir = os.path.join(self.tmp_dir.name, 'tfidf_index')
+        self.docs = _make_docs(num_docs=400)
+        self.posts = [{'subreddit': 'Advice', 'id': 'p{}'.format(i),
+                       'good_comments': [{'id': 'c{}'.format(i), 'body': 'Comment {}'.format(i)}] * (i % 3 > 0)}
+                      for i in range(len(self.docs))]
+        self.queries = [toks[:10] for toks in self.docs[::20]]
+
+        # The first 250 posts to begin with
+        _, self.word_to_idx, _ = build_vocab(self.docs[:250])
+        counts = count_matrix(self.docs[:250], self.word_to_idx)
+        rows = self._retrievable(range(250))
+        create_index(self.index_dir, self.word_to_idx, np.bincount(counts.indices, minlength=counts.shape[1]), 250,
+                     counts[rows], doc_lengths(self.docs[:250])[rows], [self.posts[i] for i in rows])
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _retrievable(self, posts):
+        return [i for i in posts if self.posts[i]['good_comments']]
+
+    def _append(self, start, end):
+        append_to_index(self.index_dir, self.posts[start:end], self.docs[start:end])
+
+    def _rebuilt(self, num_posts):
+        """ The index we'd get by building it from scratch with the first num_posts posts (and the same vocab)"""
+        counts = count_matrix(self.docs[:num_posts], self.word_to_idx)
+        idf = idf_from_doc_freq(np.bincount(counts.indices, minlength=counts.shape[1]), num_posts)
+        return TfidfIndex(tfidf_matrix([self.docs[i] for i in self._retrievable(range(num_posts))], self.word_to_idx,
+                                       idf), self.word_to_idx, idf)
+
+    def test_append_and_merge(self):
+        self._append(250, 320)
+        self._append(320, 400)
+        index = SegmentedIndex(self.index_dir)
+        self.assertLen(index.segments, 3)
+        rebuilt = self._rebuilt(400)
+        np.testing.assert_array_equal(index.idf, rebuilt.idf)
+        responses = [index.responses[i] for i in range(len(index))]
+        self.assertEqual([x['post_id'] for x in responses], [self.posts[i]['id'] for i in self._retrievable(range(400))])
+
+        for k in [1, 5]:
+            results = [index.top_k(query, k=k) for query in self.queries]
+            for query, top in zip(self.queries, results):
+                scores = index.scores(query)
+                expected = np.lexsort((np.arange(len(scores)), -scores))[:k]
+                self.assertEqual(top, [(int(row), float(scores[row])) for row in expected])
+            self.assertEqual(index.top_k_batch(self.queries, k=k), results)
+
+        # Merging weights everything with the new IDF, same as rebuilding it
+        self.assertTrue(merge_segments(self.index_dir, max_segments=1))
+        self.assertTrue(index.refresh())
+        self.assertLen(index.segments, 1)
+        self.assertEqual((index.segments[0].index.matrix != rebuilt.matrix).nnz, 0)
+        for query in self.queries:
+            self.assertEqual(index.top_k(query, k=5), rebuilt.top_k(query, k=5))
+        self.assertEqual([index.responses[i] for i in range(len(index))], responses)
+        self.assertFalse(merge_segments(self.index_dir, max_segments=1))
+        self.assertFalse(merge_segments(self.index_dir, max_segments=1, reweight=True))
+
+    def test_queries_use_current_idf(self):
+        self._append(250, 400)
+        index = SegmentedIndex(self.index_dir)
+        rebuilt = self._rebuilt(400)
+        for query in self.queries:
+            ids, weights = index.query_vector(query)
+            expected_ids, expected_weights = rebuilt.query_vector(query)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_array_equal(weights, expected_weights)
+
+    def test_reweight(self):
+        self._append(250, 400)
+        # One big segment from before the append, and one small one, so there's nothing to merge
+        self.assertFalse(merge_segments(self.index_dir, max_segments=2))
+        self.assertTrue(merge_segments(self.index_dir, max_segments=2, reweight=True))
+        index = SegmentedIndex(self.index_dir)
+        self.assertLen(index.segments, 1)
+        self.assertEqual((index.segments[0].index.matrix != self._rebuilt(400).matrix).nnz, 0)
+        self.assertFalse(merge_segments(self.index_dir, max_segments=2, reweight=True))
+
+        # Appending posts that can't be retrieved still changes the IDF
+        self.posts[400:] = [dict(self.posts[0], good_comments=[])]
+        self.docs.append(self.docs[0])
+        self._append(400, 401)
+        self.assertLen(SegmentedIndex(self.index_dir).segments, 1)
+        self.assertTrue(merge_segments(self.index_dir, max_segments=2, reweight=True))
+
+    def test_concurrent_appends(self):
+        # Another append commits while we're writing our segment
+        write = retrieval.ResponseStore.write
+
+        def _append_first(*args, **kwargs):
+            retrieval.ResponseStore.write = write
+            self._append(320, 400)
+            return write(*args, **kwargs)
+
+        retrieval.ResponseStore.write = staticmethod(_append_first)
+        try:
+            self._append(250, 320)
+        finally:
+            retrieval.ResponseStore.write = write
+        index = SegmentedIndex(self.index_dir)
+        self.assertLen(index.segments, 3)
+        self.assertEqual(index.num_docs, 400)
+        rebuilt = self._rebuilt(400)
+        np.testing.assert_array_equal(index.idf, rebuilt.idf)
+        with open(os.path.join(self.index_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        # Ours (the last one) was weighted without counting theirs, so it's marked as weighted with the IDF from
+        # before either of them. Everything gets weighted with the current one on the next reweight
+        self.assertEqual(meta['segments'][-1]['weighted_with'], 'doc_freq.0.npy')
+        self.assertTrue(merge_segments(self.index_dir, max_segments=3, reweight=True))
+        self.assertTrue(index.refresh())
+        self.assertLen(index.segments, 1)
+        rows = {post_id: row for row, post_id in enumerate(self.posts[i]['id'] for i in self._retrievable(range(400)))}
+        order = [rows[index.responses[i]['post_id']] for i in range(len(index))]
+        self.assertEqual((index.segments[0].index.matrix != rebuilt.matrix[order]).nnz, 0)
+
+    def test_segments_are_readable(self):
+        self._append(250, 320)
+        for name in os.listdir(os.path.join(self.index_dir, 'segments')):
+            self.assertEqual(os.stat(os.path.join(self.index_dir, 'segments', name)).st_mode & 0o777, 0o755)
+
+    def test_merge_race(self):
+        for start in range(250, 400, 50):
+            self._append(start, start + 50)
+        # Another merge deletes the segments we're about to read, before we take the lock
+        segment_cls = retrieval.Segment
+
+        def _merge_first(*args, **kwargs):
+            retrieval.Segment = segment_cls
+            self.assertTrue(merge_segments(self.index_dir, max_segments=2))
+            return segment_cls(*args, **kwargs)
+
+        retrieval.Segment = _merge_first
+        try:
+            self.assertFalse(merge_segments(self.index_dir, max_segments=2))
+        finally:
+            retrieval.Segment = segment_cls
+        index = SegmentedIndex(self.index_dir)
+        self.assertLen(index.segments, 2)
+        self.assertLen(os.listdir(os.path.join(self.index_dir, 'segments')), 2)
+
+    def test_refresh(self):
+        index = SegmentedIndex(self.index_dir)
+        self.assertFalse(index.refresh())
+        base = index.segments[0]
+        for start in range(250, 400, 50):
+            self._append(start, start + 50)
+        self.assertTrue(index.refresh())
+        self.assertLen(index.segments, 4)
+        self.assertIs(index.segments[0], base)
+        before = [index.top_k(query, k=3) for query in self.queries]
+
+        # The two smallest get merged, and deleted. We can still search them until we refresh
+        sizes = [len(segment) for segment in index.segments]
+        self.assertTrue(merge_segments(self.index_dir, max_segments=3))
+        self.assertEqual([index.top_k(query, k=3) for query in self.queries], before)
+        self.assertLen(os.listdir(os.path.join(self.index_dir, 'segments')), 3)
+        self.assertTrue(index.refresh())
+        self.assertLen(index.segments, 3)
+        self.assertEqual(sum(sizes), len(index))
+        self.assertIn(sorted(sizes)[0] + sorted(sizes)[1], [len(x) for x in index.segments])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -4,6 +4,11 @@ import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-gpu', type=int, default=2)
+parser.add_argument('-advice', type=str, default='../data/redditadvice2019.jsonl',
+                    help='redditadvice2019.jsonl, or a store made from it with data/advice_store.py')
+parser.add_argument('-port', type=int, default=5003)
+parser.add_argument('-num_workers', type=int, default=1,
+                    help='Serve from this many processes. They share one (memmapped) copy of the index')
 
 args = parser.parse_args()
 GPUID = args.gpu
@@ -14,6 +19,10 @@ from flask_cors import CORS
 import tensorflow as tf
 import sys
 
+sys.path.append('../')
+from tfidf.retrieval import load_or_build_index, tokenize, question_text, describe_match
+from tfidf.prefork import bind_listener, PreforkServer
+
 import logging
 from datetime import datetime
 import click
@@ -43,96 +52,34 @@ logger = logging.getLogger(__name__)
 
 spacy_model = get_spacy_model('en_core_web_sm', pos_tags=False, parse=False, ner=False)
 
-print("You need to have the file redditadvice2019.jsonl in your data/ directory.", flush=True)
-if os.path.exists('counts.npz'):
-    print("Loading from CACHE!", flush=True)
-    tfidf_coo = scipy.sparse.load_npz('counts.npz')
-
-    # Compute the denominator
-    tfidf_coo_denom = np.sqrt(tfidf_coo.power(2).dot(np.ones(tfidf_coo.shape[1], dtype=np.float16)))
-    #
-    # tfidf_coo_denom = np.load('counts_denom.npy')
-    idf = np.load('idf.npy')
-    advice = []
-    with open('../data/redditadvice2019.jsonl', 'r') as f:
-        for l in tqdm(f, total=188620):
-            item = json.loads(l)
-            if len(item['good_comments']) == 0:
-                continue
-            advice.append(item)
-
-    with open('word_to_idx.json', 'r') as f:
-        word_to_idx = json.load(f)
-    idx_to_word = [w for w, i in sorted(word_to_idx.items(), key=lambda x: x[1])]
-
-else:
-    advice = []
-    word2count = defaultdict(int)
-    word2count_doc = defaultdict(int)
-    with open('../data/redditadvice2019.jsonl', 'r') as f:
-        for l in tqdm(f, total=188620):
-            item = json.loads(l)
-            item['ctx_tokenized'] = [x.lemma_.lower() for x in spacy_model('{} {}'.format(item['title'], item['selftext']))]
-            for tok in item['ctx_tokenized']:
-                word2count[tok] += 1
-            for tok in set(item['ctx_tokenized']):
-                word2count_doc[tok] += 1
-            if len(item['good_comments']) == 0:
-                continue
-            advice.append(item)
-
-    print("Making vocabulary + IDF", flush=True)
-    idx_to_word = ['UNK'] + [x[0] for x in sorted(word2count.items(), key=lambda x: -x[1]) if x[1] >= 10]
-    word_to_idx = {w: i for i, w in enumerate(idx_to_word)}
-    idf = np.zeros(len(word_to_idx), dtype=np.float32)
-    for idx, word in enumerate(idx_to_word):
-        if idx == 0:
-            idf[0] = np.log(1.01)
-            continue
-        idf[idx] = np.log(188620 / (1.0 + word2count_doc.get(word, 1.0)))
-
-    # def ctx_tokenized_to_vec(toks):
-    #     vec = np.zeros(len(word_to_idx), dtype=np.float32)
-    #     # toks = [x.orth_.lower() for x in spacy_model(ctx)]
-    #     for tok in toks:
-    #         vec[word_to_idx.get(tok, 0)] += 1.0
-    #     vec /= len(toks)
-    #     return vec * idf
-
-    print("Turning everything into the count matrix", flush=True)
-    tfidf = scipy.sparse.dok_matrix((len(advice), len(word_to_idx)), dtype=np.float16)
-    for i, item in enumerate(tqdm(advice)):
-
-        ind_to_count = defaultdict(int)
-        for tok in item['ctx_tokenized']:
-            ind_to_count[word_to_idx.get(tok, 0)] += 1
-        for ind, count in sorted(ind_to_count.items()):
-            tfidf[i, ind] = count * idf[ind] / len(item['ctx_tokenized'])
-    tfidf_coo = scipy.sparse.coo_matrix(tfidf)
-
-    print("DUMPING TO FILE", flush=True)
-    with open('word_to_idx.json', 'w') as f:
-        json.dump(word_to_idx, f)
-    scipy.sparse.save_npz('counts.npz', tfidf_coo)
-    np.save('idf.npy', idf)
-
+print("You need to have the file redditadvice2019.jsonl in your data/ directory (or pass -advice).", flush=True)
+index, responses = load_or_build_index(args.advice, spacy_model)
 
 
 print("READY TO GO!", flush=True)
-def gen_advice(item):
-    item_tokenized = [x.lemma_.lower() for x in spacy_model('{} {}'.format(item['title'], item['selftext']))]
-    item_vec = np.zeros(len(word_to_idx), dtype=np.float16)
-    ind_to_count = defaultdict(int)
-    for tok in item_tokenized:
-        ind_to_count[word_to_idx.get(tok, 0)] += 1
-    for ind, count in sorted(ind_to_count.items()):
-        item_vec[ind] = count * idf[ind] / len(item_tokenized)
-    sim = tfidf_coo.dot(item_vec) + (1e-5) * np.random.rand(len(advice))
-    # Divide by cosine similarity denominator, other thing is a constant
-    sim /= tfidf_coo_denom
-    most_similar = advice[int(np.argmax(sim))]
-    print('https://reddit.com/r/{}/comments/{}/_/{}/'.format(most_similar['subreddit'], most_similar['id'], most_similar['good_comments'][0]['id']), flush=True)
-    return most_similar['good_comments'][0]['body']
+def retrieve(instances, k=1):
+    """
+    :param instances: questions, each with title / selftext fields
+    :return: for each one, the k best matches as dicts (see describe_match)
+    """
+    queries = tokenize(spacy_model, [question_text(x) for x in instances])
+    # Picks up posts added with update_index.py (and merges), without a restart
+    index.refresh()
+    if len(queries) == 1:
+        # The pruned search is faster for one query, and gives the same answer
+        results = [index.top_k(queries[0], k=k)]
+    else:
+        results = index.top_k_batch(queries, k=k)
+    return [[describe_match(responses[row], score) for row, score in top] for top in results]
+
+
+def gen_advice(instances):
+    """ :return: the best match's advice for each question"""
+    gens = []
+    for matches in retrieve(instances, k=1):
+        print(matches[0]['permalink'], flush=True)
+        gens.append(matches[0]['body'])
+    return gens
 
 @app.route('/', methods=['GET'])
 def form_ask():
@@ -146,7 +93,7 @@ def api_ask():
     instance = dict(flask.request.json)
     print("GOT A REQUEST for {}".format(instance), flush=True)
 
-    gen = gen_advice(instance)
+    gen = gen_advice([instance])[0]
     return flask.jsonify({
         'instance': instance,
         'gen': gen,
@@ -160,7 +107,27 @@ def api_askbatch():
     """
     orig_instance = dict(flask.request.json)
     return flask.jsonify({
-        'gens': [gen_advice(x) for x in orig_instance.pop('instances')],
+        'gens': gen_advice(orig_instance.pop('instances')),
+    }), 200
+
+
+@app.route('/api/retrieve', methods=['POST'])
+def api_retrieve():
+    """
+    instance has fields instances, each with title / selftext fields, and optionally k (default 10)
+    :return: for each instance, the k best matches with their scores, best first. 400 if k isn't a positive integer
+    """
+    orig_instance = dict(flask.request.json)
+    try:
+        k = int(orig_instance.get('k', 10))
+    except (TypeError, ValueError):
+        k = 0
+    if k < 1:
+        return flask.jsonify({
+            'error': 'k must be a positive integer, got {!r}'.format(orig_instance.get('k')),
+        }), 400
+    return flask.jsonify({
+        'results': retrieve(orig_instance.pop('instances'), k=k),
     }), 200
 
 
@@ -173,4 +140,9 @@ def serve():
     logger.info('Running prod server on http://127.0.0.1:5000/')
 
 
-WSGIServer(('0.0.0.0', 5003), app).serve_forever()
+if args.num_workers > 1:
+    # Bind before forking so all the workers accept on the same socket. Each one starts its own gevent loop
+    listener = bind_listener(('0.0.0.0', args.port))
+    PreforkServer(lambda: WSGIServer(listener, app).serve_forever(), args.num_workers).run()
+else:
+    WSGIServer(('0.0.0.0', args.port), app).serve_forever()
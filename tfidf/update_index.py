@@ -0,0 +1,72 @@
+"""
+Adds new posts to the TF-IDF index without rebuilding it, and merges its segments (see SegmentedIndex in
+retrieval.py). Servers using the index pick up the changes on their own.
+
+python update_index.py -add new_posts.jsonl   # Adds them as a new segment, then merges if there are too many
+python update_index.py -merge_every 600       # Keeps merging in the background, every 10 minutes
+
+Merging only touches the smallest segments, so the biggest one can stay weighted with an old IDF for a long time.
+With -merge_every, we also merge everything into one segment every -reweight_every seconds (if anything was added
+since), which weights all of it with the current IDF.
+"""
+import argparse
+import os
+import sys
+import time
+
+from tqdm import tqdm
+
+sys.path.append('../')
+from data.advice_store import iter_advice
+from tfidf.retrieval import append_to_index, merge_segments, iter_tokenized
+
+parser = argparse.ArgumentParser(description='Add posts to the TF-IDF index, and merge its segments')
+parser.add_argument('-add', type=str, default=None,
+                    help='Posts to add, in the same format as redditadvice2019.jsonl (or a store made from one)')
+parser.add_argument('-cache_dir', type=str, default='.', help='Where the index is cached (same as run_server.py)')
+parser.add_argument('-max_segments', type=int, default=8,
+                    help='Merge the smallest segments once there are more than this many. 1 merges everything, '
+                         'which also weights all of it with the current IDF')
+parser.add_argument('-merge_every', type=float, default=None,
+                    help='If set, keep running and check whether to merge every this many seconds')
+parser.add_argument('-reweight_every', type=float, default=24 * 60 * 60,
+                    help='With -merge_every, weight the whole index with the current IDF this often (seconds)')
+
+
+def _merge(index_dir, max_segments, reweight=False):
+    start = time.time()
+    while merge_segments(index_dir, max_segments=max_segments, reweight=reweight):
+        print("{} segments in {:.1f}s".format("Reweighted" if reweight else "Merged", time.time() - start),
+              flush=True)
+        start = time.time()
+        reweight = False
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    index_dir = os.path.join(args.cache_dir, 'tfidf_index')
+    if not os.path.exists(os.path.join(index_dir, 'meta.json')):
+        raise ValueError("No index in {}, run run_server.py or batch_retrieve.py to build one".format(index_dir))
+
+    if args.add is not None:
+        from allennlp.common.util import get_spacy_model
+        spacy_model = get_spacy_model('en_core_web_sm', pos_tags=False, parse=False, ner=False)
+        posts = []
+        posts_tokenized = []
+        items = iter_advice(args.add, fields=['subreddit', 'id', 'title', 'selftext', 'good_comments'],
+                            comment_fields=['id', 'body'])
+        for item, toks in iter_tokenized(tqdm(items), spacy_model):
+            posts.append(item)
+            posts_tokenized.append(toks)
+        name = append_to_index(index_dir, posts, posts_tokenized)
+        print("Added {} posts ({} retrievable) as segment {}".format(
+            len(posts), sum(len(x['good_comments']) > 0 for x in posts), name), flush=True)
+
+    _merge(index_dir, args.max_segments)
+    last_reweight = time.time()
+    while args.merge_every is not None:
+        time.sleep(args.merge_every)
+        reweight = time.time() - last_reweight >= args.reweight_every
+        _merge(index_dir, args.max_segments, reweight=reweight)
+        if reweight:
+            last_reweight = time.time()